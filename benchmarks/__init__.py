@@ -0,0 +1,2 @@
+# -*- mode: python -*-
+"""performance benchmarks for nbank (run with `python -m benchmarks`)"""
@@ -0,0 +1,371 @@
+# -*- mode: python -*-
+"""run nbank benchmarks against a SQLite registry and synthetic archives
+
+Usage:
+
+    python -m benchmarks run [-s 1k -s 100k] [-l 0 -l 20] [-o results.jsonl]
+    python -m benchmarks compare baseline.jsonl results.jsonl
+
+For each combination of archive size (-s) and simulated registry latency in ms
+(-l), the runner builds a synthetic archive (see `benchmarks.synthetic`) with a
+SQLite registry that's served in-process (see `nbank.registry_server`), and
+times each benchmark. Latency is added to every registry request.
+Results are written as JSON lines with one record per benchmark, size, and
+latency. Keys are sorted and the set of fields is fixed, so result files from
+different versions can be compared with `compare` or with standard tools.
+
+Copyright (C) 2025 Dan Meliza <dan@meliza.org>
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+from benchmarks import synthetic
+from nbank import __version__, core, registry_server, script
+
+log = logging.getLogger("benchmarks")
+
+
+class Context:
+    """The state shared by the benchmarks for one archive size and latency"""
+
+    def __init__(self, registry_url, archive_path, ids, sample_ids, workdir):
+        self.registry_url = registry_url
+        self.archive_path = archive_path
+        self.ids = ids
+        self.sample_ids = sample_ids
+        self.workdir = workdir
+        self.runs = 0
+
+    def scratch(self, name: str) -> Path:
+        """Returns the path of a new scratch directory (which doesn't exist yet)"""
+        self.runs += 1
+        return self.workdir / f"{name}-{self.runs}"
+
+    def sample_files(self) -> List[Path]:
+        from nbank import archive
+
+        return [
+            archive.resource_path(self.archive_path, id, resolve_ext=True)
+            for id in self.sample_ids
+        ]
+
+
+class SlowTransport(registry_server.Transport):
+    """Delays each request to simulate a registry on another host"""
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+
+    def handle_request(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        return super().handle_request(request)
+
+
+@contextmanager
+def registry_latency(latency: float):
+    """Adds latency (in s) to requests for sqlite:// registries while active"""
+    saved = registry_server._transport
+    registry_server._transport = SlowTransport(latency)
+    try:
+        yield
+    finally:
+        registry_server._transport = saved
+
+
+@contextmanager
+def quiet():
+    """Discard the output of nbank commands"""
+    # script.main attaches a log handler to whatever stderr is, so the nbank
+    # logger is restored before the null sink is closed
+    nbank_log = logging.getLogger("nbank")
+    saved = (nbank_log.level, nbank_log.handlers[:])
+    with open(os.devnull, "w") as devnull:
+        try:
+            with redirect_stdout(devnull), redirect_stderr(devnull):
+                yield
+        finally:
+            nbank_log.setLevel(saved[0])
+            nbank_log.handlers[:] = saved[1]
+
+
+def run_script(ctx: Context, *argv: str) -> None:
+    with quiet():
+        status = script.main(["-r", ctx.registry_url, *argv])
+    if status:
+        raise RuntimeError(f"nbank {' '.join(argv[:2])} failed with status {status}")
+
+
+# Each benchmark returns the duration of each call it timed and the number of
+# items (resources) that were processed.
+Timings = Tuple[List[float], int]
+
+
+def bench_deposit(ctx: Context) -> Timings:
+    """deposit new files with hashing in one core.deposit call, timing each file
+
+    Each timing runs from when the previous file was yielded, so the first one
+    also includes looking up the archive.
+
+    """
+    path = ctx.scratch("deposit")
+    files = synthetic.make_files(path, len(ctx.sample_ids), seed=ctx.runs)
+    timings = []
+    start = time.perf_counter()
+    with quiet():
+        for _ in core.deposit(ctx.archive_path, files, hash=True):
+            now = time.perf_counter()
+            timings.append(now - start)
+            start = now
+    return timings, len(timings)
+
+
+def bench_search(ctx: Context) -> Timings:
+    """list every resource in the archive through the paginated search endpoint"""
+    start = time.perf_counter()
+    n = sum(1 for _ in core.search(ctx.registry_url, location="bench"))
+    return [time.perf_counter() - start], n
+
+
+def bench_locate(ctx: Context) -> Timings:
+    """nbank locate, one command per resource"""
+    timings = []
+    for id in ctx.sample_ids:
+        start = time.perf_counter()
+        run_script(ctx, "locate", id)
+        timings.append(time.perf_counter() - start)
+    return timings, len(timings)
+
+
+def bench_info(ctx: Context) -> Timings:
+    """nbank info, one command for all the sampled resources"""
+    start = time.perf_counter()
+    run_script(ctx, "info", *ctx.sample_ids)
+    return [time.perf_counter() - start], len(ctx.sample_ids)
+
+
+def bench_verify(ctx: Context) -> Timings:
+    """nbank verify, one command for all the sampled files"""
+    files = [str(path) for path in ctx.sample_files()]
+    start = time.perf_counter()
+    run_script(ctx, "verify", *files)
+    return [time.perf_counter() - start], len(files)
+
+
+def bench_fetch(ctx: Context) -> Timings:
+    """nbank fetch, one command for all the sampled resources"""
+    dest = ctx.scratch("fetch")
+    dest.mkdir()
+    start = time.perf_counter()
+    run_script(ctx, "fetch", "-d", str(dest), *ctx.sample_ids)
+    return [time.perf_counter() - start], len(ctx.sample_ids)
+
+
+def bench_check(ctx: Context) -> Timings:
+    """nbank archive check for the whole archive"""
+    start = time.perf_counter()
+    run_script(ctx, "archive", "check", str(ctx.archive_path))
+    return [time.perf_counter() - start], len(ctx.ids)
+
+
+# in the order they're run. deposit adds resources, so it goes last.
+benchmarks: Dict[str, Callable[[Context], Timings]] = {
+    "check": bench_check,
+    "fetch": bench_fetch,
+    "info": bench_info,
+    "locate": bench_locate,
+    "search": bench_search,
+    "verify": bench_verify,
+    "deposit": bench_deposit,
+}
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(
+    name: str, n_resources: int, latency_ms: float, repeats: List[Timings]
+) -> Dict:
+    """Combines the timings from repeated runs of a benchmark into a result record.
+
+    The total time is the median over repeats; call latencies are pooled.
+    """
+    totals = sorted(sum(timings) for timings, _ in repeats)
+    total = totals[len(totals) // 2]
+    calls = [t for timings, _ in repeats for t in timings]
+    items = repeats[0][1]
+    return {
+        "benchmark": name,
+        "resources": n_resources,
+        "latency_ms": latency_ms,
+        "repeat": len(repeats),
+        "calls": len(calls) // len(repeats),
+        "items": items,
+        "total_s": round(total, 6),
+        "items_per_s": round(items / total, 3) if total > 0 else None,
+        "call_mean_ms": round(1000 * sum(calls) / len(calls), 3),
+        "call_p50_ms": round(1000 * percentile(calls, 0.5), 3),
+        "call_p90_ms": round(1000 * percentile(calls, 0.9), 3),
+        "call_max_ms": round(1000 * max(calls), 3),
+        "nbank_version": __version__,
+        "python": platform.python_version(),
+    }
+
+
+def run(args) -> int:
+    names = [name for name in benchmarks if name in (args.benchmark or benchmarks)]
+    out = open(args.output, "a") if args.output else sys.stdout
+    try:
+        for size in args.size:
+            n = synthetic.parse_size(size)
+            for latency_ms in args.latency:
+                with tempfile.TemporaryDirectory(
+                    dir=args.workdir
+                ) as workdir, registry_latency(latency_ms / 1000):
+                    workdir = Path(workdir)
+                    registry_db = workdir / "registry.db"
+                    url = f"sqlite://{registry_db}"
+                    log.info("building archive with %d resources", n)
+                    start = time.perf_counter()
+                    ids = synthetic.make_archive(
+                        registry_db, workdir / "archive", n, file_size=args.file_size
+                    )
+                    log.info("  - done in %.1f s", time.perf_counter() - start)
+                    rng = random.Random(args.seed)
+                    ctx = Context(
+                        url,
+                        workdir / "archive",
+                        ids,
+                        rng.sample(ids, min(args.sample, n)),
+                        workdir,
+                    )
+                    for name in names:
+                        log.info(
+                            "%s (%d resources, %g ms latency)", name, n, latency_ms
+                        )
+                        repeats = [benchmarks[name](ctx) for _ in range(args.repeat)]
+                        result = summarize(name, n, latency_ms, repeats)
+                        log.info(
+                            "  - %.3f s, %s items/s",
+                            result["total_s"],
+                            result["items_per_s"],
+                        )
+                        out.write(json.dumps(result, sort_keys=True) + "\n")
+                        out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+def read_results(path: Path) -> Dict[Tuple, Dict]:
+    with open(path) as fp:
+        records = (json.loads(line) for line in fp if line.strip())
+        return {(r["benchmark"], r["resources"], r["latency_ms"]): r for r in records}
+
+
+def compare(args) -> int:
+    baseline = read_results(args.baseline)
+    results = read_results(args.results)
+    print(
+        f"{'benchmark':<10}{'resources':>10}{'latency':>9}"
+        f"{'before/s':>12}{'after/s':>12}{'change':>9}"
+    )
+    for key in sorted(baseline.keys() & results.keys()):
+        before = baseline[key]["items_per_s"] or 0.0
+        after = results[key]["items_per_s"] or 0.0
+        change = f"{after / before - 1:+.1%}" if before else ""
+        print(
+            f"{key[0]:<10}{key[1]:>10}{key[2]:>9g}{before:>12.1f}{after:>12.1f}{change:>9}"
+        )
+    return 0
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        prog="python -m benchmarks", description="benchmark nbank operations"
+    )
+    sub = p.add_subparsers(title="subcommands", required=True)
+
+    pp = sub.add_parser("run", help="run benchmarks")
+    pp.set_defaults(func=run)
+    pp.add_argument(
+        "-s",
+        "--size",
+        action="append",
+        help="number of resources in the archive, or one of "
+        f"{', '.join(synthetic.sizes)} (default 1k; use multiple times for several)",
+    )
+    pp.add_argument(
+        "-l",
+        "--latency",
+        type=float,
+        action="append",
+        help="simulated registry latency in ms (default 0; can use multiple times)",
+    )
+    pp.add_argument(
+        "-b",
+        "--benchmark",
+        action="append",
+        choices=sorted(benchmarks),
+        help="benchmark to run (default all; can use multiple times)",
+    )
+    pp.add_argument(
+        "-n",
+        "--sample",
+        type=int,
+        default=100,
+        help="number of resources used by benchmarks that work on a subset (default %(default)s)",
+    )
+    pp.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of times to repeat each benchmark (default %(default)s)",
+    )
+    pp.add_argument(
+        "--file-size",
+        type=int,
+        default=256,
+        help="size of the synthetic resources in bytes (default %(default)s)",
+    )
+    pp.add_argument("--seed", type=int, default=0, help="seed for sampling resources")
+    pp.add_argument("--workdir", type=Path, help="directory for the synthetic archives")
+    pp.add_argument(
+        "-o", "--output", type=Path, help="append results to this file (default stdout)"
+    )
+
+    pp = sub.add_parser("compare", help="compare throughput in two result files")
+    pp.set_defaults(func=compare)
+    pp.add_argument("baseline", type=Path)
+    pp.add_argument("results", type=Path)
+
+    args = p.parse_args(argv)
+    if args.func is run:
+        args.size = args.size or ["1k"]
+        args.latency = args.latency or [0.0]
+    if not log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
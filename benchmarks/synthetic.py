@@ -0,0 +1,102 @@
+# -*- mode: python -*-
+"""generators for synthetic archives and registry records
+
+Resources are written directly into the archive directory and the database of
+a SQLite registry (see `nbank.registry_server`), which is much faster than
+depositing them, so that archives with millions of resources can be built in
+reasonable time. Identifiers and contents are derived from a seed, so the same
+arguments always produce the same archive.
+
+Copyright (C) 2025 Dan Meliza <dan@meliza.org>
+"""
+
+import datetime
+import hashlib
+import json
+from pathlib import Path
+from typing import Iterator, List
+
+from nbank import archive, registry_server
+
+# named archive sizes
+sizes = {"1k": 1_000, "10k": 10_000, "100k": 100_000, "1M": 1_000_000}
+
+
+def parse_size(value: str) -> int:
+    """Parses a named size (like '100k') or a number of resources"""
+    try:
+        return sizes[value]
+    except KeyError:
+        return int(value)
+
+
+def resource_ids(n: int, seed: int = 0, prefix: str = "") -> Iterator[str]:
+    """Yields n identifiers that are spread out over the archive subdirectories"""
+    for i in range(n):
+        digest = hashlib.sha1(f"{seed}-{prefix}-{i}".encode()).hexdigest()
+        yield f"{prefix}{digest[:16]}"
+
+
+def resource_content(id: str, size: int) -> bytes:
+    """Returns size bytes of deterministic content for resource id"""
+    block = hashlib.sha256(id.encode()).digest()
+    return (block * (size // len(block) + 1))[:size]
+
+
+def make_archive(
+    registry_db: Path,
+    path: Path,
+    n: int,
+    *,
+    name: str = "bench",
+    file_size: int = 256,
+    seed: int = 0,
+) -> List[str]:
+    """Creates an archive at path with n resources registered in registry_db.
+
+    The registry URL for the database is `sqlite://{registry_db}`. Returns the
+    identifiers of the resources.
+
+    """
+    cfg = archive.create(path, f"sqlite://{registry_db}")
+    root = cfg["path"]
+    created_on = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    ids = []
+    resources = []
+    made_dirs = set()
+    for id in resource_ids(n, seed):
+        data = resource_content(id, file_size)
+        target = archive.resource_path(cfg, id).with_suffix(".dat")
+        if target.parent not in made_dirs:
+            target.parent.mkdir(exist_ok=True)
+            made_dirs.add(target.parent)
+        target.write_bytes(data)
+        metadata = json.dumps({"index": len(ids) % 10})
+        sha1 = hashlib.sha1(data).hexdigest()
+        resources.append((id, "benchmark", sha1, "benchmark", created_on, metadata))
+        ids.append(id)
+    conn = registry_server.Database(registry_db).connect()
+    with conn:
+        conn.execute("INSERT INTO datatypes VALUES ('benchmark', NULL)")
+        conn.execute(
+            "INSERT INTO archives VALUES (?, 'neurobank', ?)", (name, str(root))
+        )
+        conn.executemany("INSERT INTO resources VALUES (?, ?, ?, ?, ?, ?)", resources)
+        conn.executemany(
+            "INSERT INTO locations VALUES (?, ?)", ((id, name) for id in ids)
+        )
+    conn.close()
+    return ids
+
+
+def make_files(
+    path: Path, n: int, *, file_size: int = 256, seed: int = 1
+) -> List[Path]:
+    """Creates n files to deposit in path, which must not exist"""
+    path.mkdir(parents=True)
+    files = []
+    for id in resource_ids(n, seed, prefix="new"):
+        target = path / f"{id}.dat"
+        target.write_bytes(resource_content(id, file_size))
+        files.append(target)
+    return files
@@ -4,13 +4,20 @@
 Copyright (C) 2013--2024 Dan Meliza <dan@meliza.org>
 """
 
-try:
-    from importlib.metadata import version
 
-    __version__ = version("neurobank")
-except Exception:
-    # If package is not installed (e.g. during development)
-    __version__ = "unknown"
+def __getattr__(name):
+    # looking up the version is slow, so this is only done if it's needed
+    if name == "__version__":
+        global __version__
+        try:
+            from importlib.metadata import version
+
+            __version__ = version("neurobank")
+        except Exception:
+            # If package is not installed (e.g. during development)
+            __version__ = "unknown"
+        return __version__
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # Variables:
@@ -5,77 +5,240 @@ example, if a lot of files were deposited erroneously.
 
 """
 
+import contextlib
+import itertools
+import json
 import logging
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from pathlib import Path
+from typing import Optional, Tuple
 
 import httpx
 
-from nbank import __version__, archive, registry, util
-from nbank.script import setup_log, userpwd
+from nbank import __version__, core, registry, util
+from nbank.script import iter_ids, rate, setup_log, userpwd
 
 log = logging.getLogger("nbank")  # root logger
 
 
 def delete_resource(
-    resource_id: str, *, session: httpx.Client, registry_url: str, dry_run: bool = False
-):
-    log.info("%s:", resource_id)
-    url, params = registry.get_locations(registry_url, resource_id)
-    for loc in util.query_registry_paginated(session, url, params):
+    resource: dict,
+    *,
+    session: httpx.Client,
+    registry_url: str,
+    dry_run: bool = False,
+    tries: int = 3,
+) -> dict:
+    """Delete all the local copies of resource and then remove it from the registry.
+
+    resource is a record from the bulk locations endpoint. Returns a dict
+    summarizing what was (or in a dry run, would have been) deleted.
+
+    """
+    resource_id = resource["name"]
+    result = {"name": resource_id, "unlinked": [], "status": "deleted"}
+    for loc in resource["locations"]:
         log.debug("   - attempting to delete %s from %s", resource_id, loc)
         location = util.parse_location(loc)
         if location is None:
-            log.info("  - %s has already been deleted from %s", resource_id, loc["archive_name"])
-        elif not dry_run:
-            try:
+            log.info(
+                "  - %s has already been deleted from %s",
+                resource_id,
+                loc["archive_name"],
+            )
+        elif not hasattr(location, "unlink"):
+            log.debug("   - %s is not deletable, skipping", location)
+        else:
+            if not dry_run:
                 location.unlink()
                 log.info("  ✗ deleted %s", location.path)
-            except AttributeError:
-                log.debug("   - %s is not deletable, skipping", location)
-    url, params = registry.get_resource(args.registry_url, resource_id)
-    req = session.build_request("DELETE", url)
-    log.info("  ✗ purged %s", req.url)
-    if not dry_run:
-        r = session.send(req)
+            result["unlinked"].append(str(location.path))
+    url, _ = registry.get_resource(registry_url, resource_id)
+    if dry_run:
+        result["status"] = "dry-run"
+        return result
+    r = util.request_with_retry(session, "DELETE", url, tries=tries)
+    if r.status_code == 404:
+        result["status"] = "not-found"
+    else:
         r.raise_for_status()
+        log.info("  ✗ purged %s", url)
+    return result
 
 
 def delete_resources(args):
+    """Delete resources from local archives and the registry.
+
+    Locations are looked up in bulk and each resource is deleted in a pool of
+    worker threads. The outcome for each resource is written as a line of JSON
+    to the output file.
+
+    """
     if args.dry_run:
         log.info("DRY RUN")
+    with open(args.resources) as fp:
+        to_delete = list(iter_ids(fp))
+    counts = Counter()
+    start = time.monotonic()
 
-    with open(args.resources) as fp, httpx.Client(auth=args.auth) as session:
-        for line in fp:
-            resource_id = line.strip()
-            if len(resource_id) == 0 or resource_id.startswith("#"):
-                continue
-            try:
-                delete_resource(
-                    resource_id,
+    with contextlib.ExitStack() as stack:
+        session = stack.enter_context(core.new_client(args.auth))
+        workers = stack.enter_context(ThreadPoolExecutor(args.jobs))
+        if args.output is None:
+            output = sys.stdout
+        else:
+            output = stack.enter_context(open(args.output, "w"))
+
+        def record(result):
+            counts[result["status"]] += 1
+            json.dump(result, output)
+            output.write("\n")
+            output.flush()
+
+        futures = {}
+        for chunk in util.batched(to_delete, registry._bulk_query_size):
+            url, query = registry.get_locations_bulk(args.registry_url, chunk)
+            missing = set(chunk)
+            for resource in util.query_registry_bulk(session, url, query):
+                missing.discard(resource["name"])
+                future = workers.submit(
+                    delete_resource,
+                    resource,
                     session=session,
                     registry_url=args.registry_url,
                     dry_run=args.dry_run,
+                    tries=args.tries,
                 )
-            except httpx.HTTPStatusError as err:
-                if err.response.status_code == 404:
-                    log.error("  - not in the registry, skipping")
-                else:
-                    raise err
+                futures[future] = resource["name"]
+            for resource_id in sorted(missing):
+                log.error("  - %s: not in the registry, skipping", resource_id)
+                record({"name": resource_id, "unlinked": [], "status": "not-found"})
+
+        for future in as_completed(futures):
+            resource_id = futures.pop(future)
+            try:
+                record(future.result())
+            except (OSError, httpx.HTTPError) as err:
+                log.error("  - %s: unable to delete: %s", resource_id, err)
+                record(
+                    {
+                        "name": resource_id,
+                        "unlinked": [],
+                        "status": "error",
+                        "error": str(err),
+                    }
+                )
+
+    log.info(
+        "processed %d resources in %.1f s (%.1f/s): %s",
+        sum(counts.values()),
+        time.monotonic() - start,
+        rate(sum(counts.values()), start),
+        ", ".join(f"{n} {status}" for status, n in sorted(counts.items())),
+    )
+
+
+def local_path(resource: dict) -> Optional[Path]:
+    """Returns the path of the first local copy of resource, or None if there isn't one"""
+    for loc in resource["locations"]:
+        location = util.parse_location(loc)
+        path = getattr(location, "path", None)
+        if path is not None:
+            return path
+        log.debug("    - %s is not local, skipping", loc)
+
+
+def _hash_local(
+    item: Tuple[dict, Path],
+) -> Tuple[dict, Optional[str], Optional[OSError]]:
+    """Hashes the local copy of a resource, returning the resource, hash, and any error"""
+    resource, path = item
+    try:
+        return resource, util.hash(path), None
+    except OSError as err:
+        return resource, None, err
 
 
 def update_hashes(args):
+    """Recompute hashes for local resources and update them in the registry.
+
+    Hashes are computed in a pool of worker processes as the locations are
+    streamed from the registry, and updates are sent concurrently. If a progress
+    file is specified, the result for each resource is appended to it, and
+    resources that are already in the file are skipped, so an interrupted run
+    can be resumed.
+
+    """
     if args.dry_run:
         log.info("DRY RUN")
-    to_update = []
+    done = set()
+    if args.progress is not None and args.progress.exists():
+        with open(args.progress) as fp:
+            done = {json.loads(line)["name"] for line in fp}
+        log.info("skipping %d resources listed in %s", len(done), args.progress)
     with open(args.resources) as fp:
-        for line in fp:
-            resource_id = line.strip()
-            if len(resource_id) > 0 and not resource_id.startswith("#"):
-                to_update.append(resource_id)
+        to_update = [id for id in iter_ids(fp) if id not in done]
     n_to_update = len(to_update)
-    url, query = registry.get_locations_bulk(args.registry_url, to_update)
-    with httpx.Client(auth=args.auth) as session:
-        for i, resource in enumerate(util.query_registry_bulk(session, url, query)):
+
+    with contextlib.ExitStack() as stack:
+        session = stack.enter_context(core.new_client(args.auth))
+        jobs = args.jobs or os.cpu_count() or 1
+        hashers = stack.enter_context(ProcessPoolExecutor(jobs))
+        updaters = stack.enter_context(ThreadPoolExecutor())
+        if args.progress is not None and not args.dry_run:
+            progress = stack.enter_context(open(args.progress, "a"))
+        else:
+            progress = None
+
+        def record(name, sha1, status):
+            if progress is not None:
+                json.dump({"name": name, "sha1": sha1, "status": status}, progress)
+                progress.write("\n")
+                progress.flush()
+
+        def patch(name, sha1):
+            url, _ = registry.get_resource(args.registry_url, name)
+            r = session.patch(url, json={"sha1": sha1})
+            r.raise_for_status()
+            return name, sha1
+
+        patches = set()
+
+        def finish_patches(block=False):
+            finished, _ = wait(patches, timeout=None if block else 0)
+            for future in finished:
+                patches.remove(future)
+                try:
+                    name, sha1 = future.result()
+                    log.info("- %s: updated hash to %s", name, sha1)
+                    record(name, sha1, "updated")
+                except httpx.HTTPStatusError as err:
+                    registry.log_error(err)
+
+        def local_resources(chunk):
+            url, query = registry.get_locations_bulk(args.registry_url, chunk)
+            for resource in util.query_registry_bulk(session, url, query):
+                path = local_path(resource)
+                if path is None:
+                    log.info("- %s: no local copies, skipping", resource["name"])
+                    continue
+                yield resource, path
+
+        # each chunk is hashed while it's streamed, with a bounded number in flight
+        hashed = itertools.chain.from_iterable(
+            util.map_unordered(hashers, _hash_local, local_resources(chunk), 2 * jobs)
+            for chunk in util.batched(to_update, registry._bulk_query_size)
+        )
+        for i, (resource, hash, err) in enumerate(hashed, 1):
             log.info(
                 "- [%d/%d] %s (current hash: %s)",
                 i,
@@ -83,26 +246,18 @@ def update_hashes(args):
                 resource["name"],
                 resource["sha1"],
             )
-            for loc in resource["locations"]:
-                try:
-                    location = util.parse_location(loc)
-                    hash = util.hash(location.path)
-                    if hash == resource["sha1"]:
-                        log.info("    - already has the right hash")
-                    elif args.dry_run:
-                        log.info("    - would update hash to %s", hash)
-                    else:
-                        url, params = registry.get_resource(
-                            args.registry_url, resource["name"]
-                        )
-                        r = session.patch(url, json={"sha1": hash})
-                        r.raise_for_status()
-                        log.info("    - updated hash to %s", hash)
-                    break
-                except FileNotFoundError:
-                    log.debug("    - %s is not local, skipping", loc)
-                except httpx.HTTPStatusError as err:
-                    registry.log_error(err)
+            if err is not None:
+                log.error("    - unable to hash %s: %s", resource["name"], err)
+                continue
+            if hash == resource["sha1"]:
+                log.info("    - already has the right hash")
+                record(resource["name"], hash, "unchanged")
+            elif args.dry_run:
+                log.info("    - would update hash to %s", hash)
+            else:
+                patches.add(updaters.submit(patch, resource["name"], hash))
+            finish_patches()
+        finish_patches(block=True)
 
 
 if __name__ == "__main__":
@@ -125,7 +280,6 @@ if __name__ == "__main__":
         help="username:password to authenticate with registry. "
         "If not supplied, will attempt to use .netrc file",
         type=userpwd,
-        default=httpx.NetRCAuth(None),
     )
     sub = p.add_subparsers(title="subcommands")
 
@@ -139,6 +293,25 @@ if __name__ == "__main__":
         help="if set, don't actually delete anything",
         action="store_true",
     )
+    pp.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=8,
+        help="number of resources to delete concurrently (default %(default)s)",
+    )
+    pp.add_argument(
+        "--tries",
+        type=int,
+        default=3,
+        help="number of attempts for each registry request (default %(default)s)",
+    )
+    pp.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        help="write the result for each resource to this file (default stdout)",
+    )
     pp.add_argument(
         "resources", type=Path, help="file with a list of resources to delete"
     )
@@ -151,6 +324,17 @@ if __name__ == "__main__":
         help="if set, don't actually update anything",
         action="store_true",
     )
+    pp.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="number of worker processes to use for hashing (default is number of CPUs)",
+    )
+    pp.add_argument(
+        "--progress",
+        type=Path,
+        help="record results in this file, and skip any resources already in it",
+    )
     pp.add_argument(
         "resources", type=Path, help="file with a list of resources to update"
     )
@@ -8,8 +8,12 @@ import json
 import logging
 import os
 import shutil
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict, Iterator, NewType, Optional, Union
+from typing import Any, Dict, Iterator, NewType, Optional, Tuple, Union
+
+from nbank import instrument
 
 log = logging.getLogger("nbank")  # root logger
 
@@ -18,6 +22,10 @@ _README_fname = "README.md"
 _config_fname = "nbank.json"
 _config_schema = "https://melizalab.github.io/neurobank/config.json#"
 _resource_subdir = "resources"
+_state_subdir = ".nbank"
+_lock_fname = ".lock"
+_stub_locks: Dict[Path, threading.Lock] = {}
+_stub_locks_guard = threading.Lock()
 _default_umask = 0o002
 _README = """
 This directory contains a [neurobank](https://github.com/melizalab/neurobank)
@@ -42,10 +50,9 @@ Add notes about the contents of the data archive here. You should also edit
 
 Deposit resources: `nbank deposit archive_path file-1 [file-2 [file-3]]`
 
-Registered or deposited files are given the permissions specified in `project.json`.
-However, when entire directories are deposited, ownership and access may not be set correctly.
-If you have issues accessing files, run the following commands (usually, as root):
-`find resources -type d -exec chmod 2775 {} \\+` and `setfacl -R -d -m u::rwx,g::rwx,o::rx resources`
+Registered or deposited files are given the permissions specified in `nbank.json`.
+If you have issues accessing files, run `nbank archive fix-perms archive_path`
+(usually, as root) to reset ownership and access for the whole archive.
 
 """
 
@@ -137,7 +144,7 @@ def create(
     fname.chmod(0o666 & ~umask)
 
     fname = archive_path / ".gitignore"
-    fname.write_text("resources/\n")
+    fname.write_text(f"{_resource_subdir}/\n{_state_subdir}/\n")
     fname.chmod(0o666 & ~umask)
 
     return get_config(archive_path)
@@ -182,9 +189,16 @@ def resolve_extension(path: Path) -> Path:
 
 
 def iter_resources(path: Path) -> Iterator[Path]:
+    """Yields the path of every resource in the archive at path.
+
+    Hidden files (like the temporary files made by `stage_resource`) are skipped.
+
+    """
     base_dir = path / _resource_subdir
     for stub_dir in base_dir.iterdir():
-        yield from stub_dir.iterdir()
+        for resource in stub_dir.iterdir():
+            if not resource.name.startswith("."):
+                yield resource
 
 
 class Resource:
@@ -220,6 +234,7 @@ class Resource:
     def deletable(self) -> bool:
         return os.access(self.path.parent, os.W_OK)
 
+    @instrument.timed("copy", nbytes=instrument.result_size)
     def fetch(self, target: Path) -> Path:
         if target.is_dir():
             target = target / self.path.name
@@ -257,6 +272,7 @@ def check_permissions(cfg: ArchiveConfig, src: Path, id: Optional[str] = None) -
         return True
 
 
+@instrument.timed("store_resource", nbytes=instrument.result_size)
 def store_resource(cfg: ArchiveConfig, src: Path, id: Optional[str] = None) -> Path:
     """Stores resource (src) in the repository under a unique identifier.
 
@@ -282,52 +298,134 @@ def store_resource(cfg: ArchiveConfig, src: Path, id: Optional[str] = None) -> P
 
     if id is None:
         id = src.name
+    base_id = id
 
     if cfg["policy"]["keep_extensions"]:
-        id = Path(id).stem + src.suffix
-
-    # check for existing resource
-    try:
-        _ = resource_path(cfg, id, resolve_ext=True)
-    except FileNotFoundError:
-        pass
-    else:
-        raise KeyError("a file already exists for id %s", id)
-    log.debug("%s -> %s", src, id)
+        base_id = Path(id).stem
+        id = base_id + src.suffix
 
     # execute commands in this order to prevent data loss; source file is not
     # renamed unless it's copied
     pfix = permission_fixer(cfg)
+    tgt_dir = _make_stub_dir(cfg, id, pfix)
+    tgt_file = tgt_dir / id
+    # the check and the move have to be atomic for concurrent deposits
+    with _locked_stub(tgt_dir, pfix):
+        try:
+            _ = resource_path(cfg, base_id, resolve_ext=True)
+        except FileNotFoundError:
+            pass
+        else:
+            raise KeyError("a file already exists for id %s", id)
+        log.debug("%s -> %s", src, id)
+        move(src, tgt_file)
+    if tgt_file.is_dir():
+        failed = fix_permissions(cfg, tgt_file)["failed"]
+        if failed:
+            log.warning("unable to change uid/gid or permissions of %d files", failed)
+    else:
+        pfix(tgt_file)
+
+    return tgt_file
+
+
+def state_dir(cfg: ArchiveConfig, name: Optional[str] = None) -> Path:
+    """Returns the directory where nbank keeps journals and staged files for an archive.
+
+    If name is supplied, returns that subdirectory. Directories are created as
+    needed, with ownership and permissions set according to the archive policy.
+
+    """
+    pfix = permission_fixer(cfg)
+    path = cfg["path"] / _state_subdir
+    dirs = [path, path / name] if name else [path]
+    for d in dirs:
+        try:
+            d.mkdir()
+            pfix(d)
+        except FileExistsError:
+            pass
+    return dirs[-1]
+
+
+def stage_resource(
+    cfg: ArchiveConfig, src: Path, id: str, sha1: Optional[str] = None
+) -> Tuple[Path, str]:
+    """Copies src to a temporary file in the directory where resource id will be stored.
+
+    The file is hashed while it's copied (see `util.hash_copy`), so when src is
+    on another file system, this reads it once instead of twice. Returns the
+    path of the temporary file and its SHA1 hash. If sha1 is not None and does
+    not match, the copy is removed and ValueError is raised.
+
+    The temporary file is hidden, so it is not treated as a resource. Use
+    `store_resource` to rename it into place, which is atomic because it's in the
+    same directory. The caller is responsible for removing src.
+
+    """
+    import tempfile
+
+    from nbank.util import hash_copy
+
+    tgt_dir = _make_stub_dir(cfg, id, permission_fixer(cfg))
+    fd, tmp = tempfile.mkstemp(prefix=f".{id}.", suffix=src.suffix, dir=tgt_dir)
+    os.close(fd)
+    tmp = Path(tmp)
+    try:
+        digest = hash_copy(src, tmp)["sha1"]
+        if sha1 is not None and digest != sha1:
+            raise ValueError(f"{src} does not match its hash ({sha1})")
+    except BaseException:
+        tmp.unlink()
+        raise
+    log.debug("%s -> %s", src, tmp)
+    return tmp, digest
+
+
+@contextmanager
+def _locked_stub(tgt_dir: Path, pfix) -> Iterator[None]:
+    """Holds an exclusive lock on a resource subdirectory.
+
+    The lock is a POSIX record lock on a hidden file in the directory, which
+    excludes other processes (including ones on other hosts, if the file
+    system is NFS). POSIX locks are held by the process, so a thread lock is
+    also used to exclude other threads.
+
+    """
+    import fcntl
+
+    with _stub_locks_guard:
+        thread_lock = _stub_locks.setdefault(tgt_dir, threading.Lock())
+    path = tgt_dir / _lock_fname
+    with thread_lock:
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+            pfix(path)
+        except FileExistsError:
+            fd = os.open(path, os.O_RDWR)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # closing the file releases the lock
+            os.close(fd)
+
+
+def _make_stub_dir(cfg: ArchiveConfig, id: str, pfix) -> Path:
     tgt_dir = cfg["path"] / _resource_subdir / id_stub(id)
     try:
         tgt_dir.mkdir(parents=True)
         pfix(tgt_dir)
     except FileExistsError:
         pass
-
-    tgt_file = tgt_dir / id
-    move(src, tgt_file)
-    pfix(tgt_file)
-    if tgt_file.is_dir():
-        for f in tgt_file.rglob("*"):
-            pfix(f)
-
-    return tgt_file
+    return tgt_dir
 
 
 def permission_fixer(cfg: ArchiveConfig):
     """Returns a function that will fix ownership/permissions for a resource or containing directory."""
-    import grp
-    import pwd
-    from os import chown, getuid
+    from os import chown
 
-    myuid = getuid()
-    if myuid == 0:
-        uid = pwd.getpwnam(cfg["policy"]["access"]["user"]).pw_uid
-    else:
-        uid = -1
-    gid = grp.getgrnam(cfg["policy"]["access"]["group"]).gr_gid
-    umask = cfg["policy"]["access"]["umask"]
+    uid, gid, umask = _access_ids(cfg)
 
     def fix(p: Path) -> None:
         try:
@@ -339,11 +437,107 @@ def permission_fixer(cfg: ArchiveConfig):
     return fix
 
 
+def _access_ids(cfg: ArchiveConfig) -> Tuple[int, int, int]:
+    """Returns the uid, gid, and umask for files in the archive (uid is -1 unless we are root)"""
+    import grp
+    import pwd
+
+    if os.getuid() == 0:
+        uid = pwd.getpwnam(cfg["policy"]["access"]["user"]).pw_uid
+    else:
+        uid = -1
+    gid = grp.getgrnam(cfg["policy"]["access"]["group"]).gr_gid
+    return uid, gid, cfg["policy"]["access"]["umask"]
+
+
+def fix_permissions(
+    cfg: ArchiveConfig,
+    path: Optional[Path] = None,
+    *,
+    max_workers: int = 4,
+    dry_run: bool = False,
+) -> Dict[str, int]:
+    """Sets the ownership and access mode of path and everything under it.
+
+    If path is None, the entire resources directory of the archive is fixed.
+    Ownership and access are set according to the archive policy: files and
+    directories are assigned to the archive group (and user, if running as
+    root), the umask is applied to the mode, and the setgid bit is set on
+    directories. Entries that are already correct are not changed, and
+    symbolic links are skipped.
+
+    The tree is traversed with `os.fwalk`, and each subdirectory of path is
+    handled by one of `max_workers` threads. If dry_run is True, nothing is
+    changed. Returns the number of entries that were `checked`, `changed` (or
+    would be changed), and `failed` (usually because of insufficient
+    privileges).
+
+    """
+    import stat
+    from concurrent.futures import ThreadPoolExecutor
+
+    from nbank.util import map_unordered
+
+    uid, gid, umask = _access_ids(cfg)
+
+    def fix(name: str, dir_fd: Optional[int], dirpath: str, counts: Dict) -> None:
+        counts["checked"] += 1
+        try:
+            st = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+            if stat.S_ISLNK(st.st_mode):
+                return
+            mode = stat.S_IMODE(st.st_mode) & ~umask
+            if stat.S_ISDIR(st.st_mode):
+                mode |= stat.S_ISGID
+            chown = st.st_gid != gid or uid not in (-1, st.st_uid)
+            chmod = mode != stat.S_IMODE(st.st_mode)
+            if chown or chmod:
+                counts["changed"] += 1
+            if dry_run:
+                return
+            if chown:
+                os.chown(name, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
+            if chmod:
+                os.chmod(name, mode, dir_fd=dir_fd)
+        except OSError as err:
+            log.debug("unable to fix %s: %s", os.path.join(dirpath, name), err)
+            counts["failed"] += 1
+
+    def walk(top: str) -> Dict[str, int]:
+        counts = {"checked": 0, "changed": 0, "failed": 0}
+        fix(top, None, "", counts)
+        for dirpath, dirnames, filenames, dir_fd in os.fwalk(top):
+            for name in dirnames + filenames:
+                fix(name, dir_fd, dirpath, counts)
+        return counts
+
+    if path is None:
+        path = cfg["path"] / _resource_subdir
+    totals = {"checked": 0, "changed": 0, "failed": 0}
+    fix(str(path), None, "", totals)
+    if not path.is_dir() or path.is_symlink():
+        return totals
+    with os.scandir(path) as it:
+        entries = list(it)
+    subdirs = (e.path for e in entries if e.is_dir(follow_symlinks=False))
+    for e in entries:
+        if not e.is_dir(follow_symlinks=False):
+            fix(e.path, None, "", totals)
+    with ThreadPoolExecutor(max_workers) as executor:
+        for counts in map_unordered(executor, walk, subdirs, 2 * max_workers):
+            for key, value in counts.items():
+                totals[key] += value
+    return totals
+
+
 __all__ = [
     "check_permissions",
     "create",
+    "fix_permissions",
     "get_config",
     "id_stub",
     "resolve_extension",
+    "stage_resource",
+    "state_dir",
     "store_resource",
 ]
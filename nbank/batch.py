@@ -0,0 +1,232 @@
+# -*- mode: python -*-
+"""execute many nbank operations in a single process
+
+Operations are described by JSON records with an `op` field and the arguments
+for the operation. For example:
+
+    {"op": "locate", "id": "st1107_1"}
+    {"op": "info", "id": "st1107_1"}
+    {"op": "modify", "id": "st1107_1", "metadata": {"experimenter": "dmeliza"}}
+    {"op": "deposit", "archive": "/home/data/starlings", "file": "st1107_1.pprox"}
+    {"op": "search", "params": {"dtype": "vocalization-wav"}}
+    {"op": "verify", "file": "st1107_1.wav"}
+
+Records may include a `rid` field to identify the request; if not given, the
+line number is used. The operations are run concurrently using the functions in
+`nbank.core`, which share a pooled client (see `core.shared_session`), and the
+result of each is yielded as a dict with the `rid`, `op`, and either `result`
+or `error`.
+
+Copyright (C) 2025 Dan Meliza <dan@meliza.org>
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, TextIO, Tuple
+
+from nbank import core
+
+log = logging.getLogger("nbank")  # root logger
+
+
+def _registry(record: Dict, registry_url: Optional[str]) -> str:
+    url = record.get("registry", registry_url)
+    if url is None:
+        raise ValueError("no registry url")
+    return url
+
+
+def locate(record: Dict, registry_url: Optional[str]) -> Dict:
+    alt_base = record.get("alt_base")
+    resources = core.find(
+        _registry(record, registry_url),
+        record["id"],
+        alt_base=Path(alt_base) if alt_base else None,
+    )
+    return {
+        "id": record["id"],
+        "locations": [str(resource) for resource in resources if resource is not None],
+    }
+
+
+def info(record: Dict, registry_url: Optional[str]) -> Dict:
+    result = core.describe(_registry(record, registry_url), record["id"])
+    if result is None:
+        raise LookupError(f"{record['id']} not found")
+    return result
+
+
+def modify(record: Dict, registry_url: Optional[str]) -> Dict:
+    (result,) = core.update_many(
+        _registry(record, registry_url),
+        [{"name": record["id"], "metadata": record.get("metadata", {})}],
+    )
+    if "error" in result:
+        raise LookupError(result["error"])
+    return result
+
+
+def deposit(record: Dict, registry_url: Optional[str]) -> Dict:
+    files = record.get("files", [record["file"]] if "file" in record else [])
+    results = core.deposit(
+        Path(record["archive"]),
+        [Path(f) for f in files],
+        dtype=record.get("dtype"),
+        hash=record.get("hash", False),
+        auto_id=record.get("auto_id", False),
+        **record.get("metadata", {}),
+    )
+    return {
+        "deposited": [
+            {"source": str(item["source"]), "id": item["id"]} for item in results
+        ]
+    }
+
+
+def search(record: Dict, registry_url: Optional[str]) -> Dict:
+    return {
+        "resources": list(
+            core.search(_registry(record, registry_url), **record.get("params", {}))
+        )
+    }
+
+
+def verify(record: Dict, registry_url: Optional[str]) -> Dict:
+    (result,) = core.verify_many(
+        _registry(record, registry_url), [Path(record["file"])], max_workers=1
+    )
+    return result
+
+
+operations: Dict[str, Callable[[Dict, Optional[str]], Dict]] = {
+    "deposit": deposit,
+    "info": info,
+    "locate": locate,
+    "modify": modify,
+    "search": search,
+    "verify": verify,
+}
+
+
+# fields that each operation requires
+_required_fields: Dict[str, Tuple[str, ...]] = {
+    "deposit": ("archive",),
+    "info": ("id",),
+    "locate": ("id",),
+    "modify": ("id",),
+    "search": (),
+    "verify": ("file",),
+}
+# JSON types of the fields used by operations
+_field_types: Dict[str, Tuple[type, str]] = {
+    "id": (str, "a string"),
+    "file": (str, "a string"),
+    "files": (list, "an array"),
+    "archive": (str, "a string"),
+    "registry": (str, "a string"),
+    "alt_base": (str, "a string"),
+    "dtype": (str, "a string"),
+    "hash": (bool, "true or false"),
+    "auto_id": (bool, "true or false"),
+    "metadata": (dict, "an object"),
+    "params": (dict, "an object"),
+}
+
+
+def check_record(record: Dict[str, Any]) -> Optional[str]:
+    """Returns a description of what's wrong with the fields in record, or None if ok"""
+    op = record.get("op")
+    if not isinstance(op, str) or op not in operations:
+        return f"unknown operation: {op}"
+    for field in _required_fields[op]:
+        if field not in record:
+            return f"missing field: {field}"
+    if op == "deposit" and "file" not in record and "files" not in record:
+        return "missing field: file or files"
+    for field, (field_type, name) in _field_types.items():
+        if field in record and not isinstance(record[field], field_type):
+            return f"{field} must be {name}"
+    if not all(isinstance(f, str) for f in record.get("files", [])):
+        return "files must be an array of strings"
+    return None
+
+
+def execute(record: Dict[str, Any], registry_url: Optional[str] = None) -> Dict:
+    """Execute the operation in record and return a dict with the result or error"""
+    import httpx
+
+    response = {"rid": record.get("rid"), "op": record.get("op")}
+    error = check_record(record)
+    if error is not None:
+        return {**response, "error": error}
+    operation = operations[record["op"]]
+    try:
+        response["result"] = operation(record, registry_url)
+    except httpx.HTTPStatusError as err:
+        if err.response.status_code == 404:
+            response["error"] = "not found"
+        else:
+            response["error"] = f"registry error: {err.response.status_code}"
+    except httpx.RequestError:
+        response["error"] = "registry error: unable to contact server"
+    except KeyError as err:
+        # the record has been checked, so this is a problem in the operation
+        log.debug("%s failed", response["rid"], exc_info=True)
+        response["error"] = f"KeyError: {err}"
+    except (LookupError, OSError, ValueError, RuntimeError) as err:
+        response["error"] = str(err)
+    except Exception as err:
+        log.debug("%s failed", response["rid"], exc_info=True)
+        response["error"] = f"{type(err).__name__}: {err}"
+    return response
+
+
+def read_records(fp: TextIO) -> Iterator[Dict]:
+    """Yields operation records from a file of line-delimited JSON.
+
+    Records without a `rid` are assigned their line number. Lines that can't be
+    parsed are yielded as records with an `error` field.
+
+    """
+    for lineno, line in enumerate(fp, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as err:
+            yield {"rid": lineno, "error": f"invalid JSON: {err}"}
+            continue
+        if not isinstance(record, dict):
+            yield {"rid": lineno, "error": "record is not a JSON object"}
+            continue
+        record.setdefault("rid", lineno)
+        yield record
+
+
+def run(
+    records: Iterable[Dict],
+    registry_url: Optional[str] = None,
+    *,
+    auth: core.RegistryAuth = None,
+    max_workers: int = 8,
+) -> Iterator[Dict]:
+    """Execute operation records concurrently, yielding results as they complete"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from nbank.util import map_unordered
+
+    def run_one(record):
+        if "error" in record:
+            return {"op": record.get("op"), **record}
+        log.debug("%s: %s", record["rid"], record.get("op"))
+        return execute(record, registry_url)
+
+    with core.shared_session(auth), ThreadPoolExecutor(max_workers) as executor:
+        yield from map_unordered(executor, run_one, records, 2 * max_workers)
+
+
+__all__ = ["check_record", "execute", "operations", "read_records", "run"]
+
+# Variables:
+# End:
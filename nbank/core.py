@@ -5,22 +5,47 @@ Copyright (C) 2013-2025 Dan Meliza <dan@meliza.org>
 Created Mon Nov 25 08:52:28 2013
 """
 
+import json
 import logging
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict, Iterable, Iterator, Optional, Tuple, Union
-
-import httpx
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 from nbank.util import FetchableResource
 
+if TYPE_CHECKING:
+    import httpx
+
+    from nbank.journal import Journal
+
 # types that can be turned into authentication for httpx
-RegistryAuth = Union[Tuple[str, str], httpx.Auth, None]
+RegistryAuth = Union[Tuple[str, str], "httpx.Auth", None]
 
 log = logging.getLogger("nbank")  # root logger
 
+# pooled client and lookup cache used by long-running processes; see shared_session
+_shared_client: Optional["httpx.Client"] = None
+_archive_cache: Dict[Path, Tuple[float, Dict, str]] = {}
+# deposit journals, relative to the archive state directory (see archive.state_dir)
+_queue_fname = "queue.ndjson"
+_deposit_fname = "deposits.ndjson"
+_staging_subdir = "staging"
+
 
-def make_auth(auth: RegistryAuth) -> Optional[httpx.Auth]:
+def make_auth(auth: RegistryAuth) -> Optional["httpx.Auth"]:
     """Convert a RegistryAuth to an actual httpx Auth. If auth is None, tries to use netrc"""
+    import httpx
+
     if isinstance(auth, httpx.Auth):
         return auth
     if isinstance(auth, tuple):
@@ -31,6 +56,98 @@ def make_auth(auth: RegistryAuth) -> Optional[httpx.Auth]:
         pass
 
 
+def new_client(auth: RegistryAuth = None) -> "httpx.Client":
+    """Returns a new client for making requests to the registry.
+
+    Requests for sqlite:// registry URLs are handled in-process (see
+    `nbank.registry_server`).
+
+    """
+    import httpx
+
+    from nbank import instrument, registry_server
+
+    return httpx.Client(
+        auth=make_auth(auth),
+        event_hooks=instrument.event_hooks(),
+        mounts={"sqlite://": registry_server.transport()},
+    )
+
+
+@contextmanager
+def shared_session(auth: RegistryAuth = None) -> Iterator["httpx.Client"]:
+    """Open a pooled registry client that is reused by the functions in this module.
+
+    This is intended for long-running processes (like `nbank daemon`) that make
+    many calls, so that connections can be kept alive between them. While the
+    shared client is open, archive configurations and registry lookups for
+    archives are also cached. Functions that are called with an explicit `auth`
+    argument will still use their own client.
+
+    """
+    global _shared_client
+    with new_client(auth) as client:
+        _shared_client = client
+        try:
+            yield client
+        finally:
+            _shared_client = None
+            _archive_cache.clear()
+
+
+@contextmanager
+def open_session(auth: RegistryAuth = None) -> Iterator["httpx.Client"]:
+    """Yields a client for making requests to the registry.
+
+    If a shared client is open (see `shared_session`) and auth is None, it is
+    used. Otherwise a new client is created and closed on exit.
+
+    """
+    if _shared_client is not None and auth is None:
+        yield _shared_client
+        return
+    with new_client(auth) as client:
+        yield client
+
+
+def lookup_archive(session: "httpx.Client", archive_path: Path) -> Tuple[Dict, str]:
+    """Returns the configuration of the archive at archive_path and its name in the registry.
+
+    Raises ValueError if archive_path is not an archive and RuntimeError if the
+    archive is not in the registry. If a shared client is open, the results are
+    cached until the archive configuration file is modified.
+
+    """
+    from nbank import util
+    from nbank.archive import _config_fname, get_config
+    from nbank.registry import find_archive_by_path
+
+    try:
+        mtime = (archive_path / _config_fname).stat().st_mtime
+        key = archive_path.resolve()
+    except FileNotFoundError as err:
+        raise ValueError(f"{archive_path} is not a valid archive") from err
+    cached = _archive_cache.get(key)
+    if cached is not None and cached[0] == mtime:
+        log.debug("using cached configuration for %s", key)
+        return cached[1:]
+    try:
+        archive_cfg = get_config(archive_path)
+    except FileNotFoundError as err:
+        raise ValueError(f"{archive_path} is not a valid archive") from err
+    # check that archive exists for this path
+    url, params = find_archive_by_path(archive_cfg["registry"], archive_cfg["path"])
+    try:
+        archive = util.query_registry_first(session, url, params)["name"]
+    except TypeError as err:
+        raise RuntimeError(
+            f"archive '{archive_cfg['path']}' not in registry. did it move?"
+        ) from err
+    if _shared_client is not None:
+        _archive_cache[key] = (mtime, archive_cfg, archive)
+    return archive_cfg, archive
+
+
 def deposit(
     archive_path: Path,
     files: Iterable[Path],
@@ -38,6 +155,9 @@ def deposit(
     hash: bool = False,
     auto_id: bool = False,
     auth: RegistryAuth = None,
+    resume: bool = False,
+    dedupe: Optional[str] = None,
+    hashes: Optional[Dict[Path, str]] = None,
     **metadata: Any,
 ) -> Iterator[Dict]:
     """Main entry point to deposit resources into an archive
@@ -59,37 +179,541 @@ def deposit(
     registry. These are currently hairy enough problems that the user is going
     to have to fix them herself for now.
 
+    If a file needs to be hashed and it's on a different file system from the
+    archive, it is hashed while it's copied into the archive (see
+    `archive.stage_resource`), and the source is removed once the copy has
+    been moved into place.
+
+    If `resume` is True, the progress of each file (`hashed`, `registered`,
+    `moved`) is recorded in a journal in the archive (see `nbank.journal`). If
+    the deposit is interrupted, call this function again with the same files and
+    `resume=True` to pick up where it left off: files that were deposited are
+    skipped, hashes are reused for files that have not changed since they were
+    hashed, and files that were registered are moved without registering them
+    again (if the registry assigned the id, the registration is found by hash).
+    Entries for deposited files are removed from the journal when a call
+    finishes. If the journal can't be written (for example, because the archive
+    is read-only for this user), the deposit continues without one.
+
+    If `dedupe` is `skip` or `link`, all the files are hashed before they are
+    deposited (see `find_duplicates`), and files with the same contents as a
+    resource in the registry or as a file deposited earlier in the call are not
+    stored. With `skip`, the file is left where it is; with `link`, it's replaced
+    by a symbolic link to the existing resource if it's in a local archive. For
+    these files, the yielded dict has `id` set to None and the name of the
+    existing resource in `duplicate_of`, and the path of the resource in `link`
+    if the file was linked. The hashes of the other files are stored in the
+    registry.
+
+    `hashes` maps files to SHA1 hashes that are already known (for example,
+    from `find_duplicates`). These files are not hashed again, and their hashes
+    are stored in the registry.
+
     """
     import uuid
 
+    from nbank import instrument, util
+    from nbank.archive import (
+        check_permissions,
+        resource_path,
+        stage_resource,
+        store_resource,
+    )
+    from nbank.registry import add_resource, find_resource, full_url, get_resource
+
+    def unchanged(src, record):
+        stat = src.stat()
+        return (stat.st_size, stat.st_mtime_ns) == (record["size"], record["mtime_ns"])
+
+    def register(record):
+        id, sha1 = record["id"], record["sha1"]
+        if resume and sha1 is not None:
+            # the last attempt may have died before this was journaled
+            if id is not None:
+                url, params = get_resource(registry_url, id)
+                existing = util.query_registry(session, url, params)
+            else:
+                # the registry assigned the id, so it can only be found by hash
+                url, params = find_resource(registry_url, sha1=sha1, location=archive)
+                existing = util.query_registry_first(session, url, params)
+            if (
+                existing is not None
+                and existing["sha1"] == sha1
+                and archive in existing["locations"]
+            ):
+                return existing["name"]
+        url, params = add_resource(registry_url, id, dtype, archive, sha1, **metadata)
+        log.debug("POST %s: %s", url, params)
+        r = session.post(url, json=params)
+        r.raise_for_status()
+        return r.json()["name"]
+
+    with open_session(auth) as session:
+        archive_cfg, archive = lookup_archive(session, archive_path)
+        archive_path = archive_cfg["path"]  # this will resolve the path
+        log.info("archive: %s", archive_path)
+        registry_url = archive_cfg["registry"]
+        log.info("   registry: %s", registry_url)
+        auto_id = archive_cfg["policy"]["auto_identifiers"] or auto_id
+        auto_id_type = archive_cfg["policy"].get("auto_id_type", None)
+        allow_dirs = archive_cfg["policy"]["allow_directories"]
+        log.info("   archive name: %s", archive)
+
+        hashes = hashes or {}
+        if dedupe is not None:
+            items = find_duplicates(registry_url, files, hashes=hashes)
+        else:
+            items = ({"path": src, "sha1": hashes.get(src)} for src in files)
+        deposited = {}
+
+        with _deposit_journal(archive_cfg, resume) as journal:
+
+            def note(record):
+                if journal is not None:
+                    journal.append(record)
+
+            journaled = journal.load() if journal is not None else {}
+            for item in items:
+                src = item["path"]
+                log.info("processing '%s':", src)
+                record = journaled.get(str(src.resolve()))
+                if record is not None and record["state"] == "moved":
+                    log.info("   already deposited as %s; skipping", record["id"])
+                    continue
+                if not src.exists():
+                    if record is not None and record["state"] == "registered":
+                        # interrupted after the move but before it was journaled
+                        try:
+                            tgt = resource_path(
+                                archive_cfg, record["id"], resolve_ext=True
+                            )
+                        except FileNotFoundError:
+                            pass
+                        else:
+                            note({**record, "state": "moved"})
+                            log.info("   already deposited in %s", tgt)
+                            yield {"source": src, "id": record["id"]}
+                            continue
+                    log.info("   does not exist; skipping")
+                    continue
+                if not allow_dirs and src.is_dir():
+                    log.info("   is a directory; skipping")
+                    continue
+                if dedupe is not None and record is None:
+                    matches = item["matches"]
+                    if item["sha1"] in deposited:
+                        matches = [deposited[item["sha1"]], *matches]
+                    if matches:
+                        yield _skip_duplicate(registry_url, src, matches, dedupe)
+                        continue
+                # the span is closed before yielding so it only covers this file
+                with instrument.span("deposit", source=str(src)):
+                    staged = tgt = None
+                    if record is not None and unchanged(src, record):
+                        log.info("   resuming (%s)", record["state"])
+                        id = record["id"]
+                        sha1 = record["sha1"]
+                        if record.get("staged") is not None:
+                            staged = Path(record["staged"])
+                    else:
+                        record = None
+                        if auto_id:
+                            if auto_id_type == "uuid":
+                                id = str(uuid.uuid4())
+                            else:
+                                id = None
+                        else:
+                            id = util.id_from_fname(src)
+                    if not check_permissions(archive_cfg, src, id):
+                        raise OSError("unable to write to archive, aborting")
+                    if record is None:
+                        sha1 = item["sha1"]
+                        if (
+                            hash
+                            or archive_cfg["policy"]["require_hash"]
+                            or sha1 is not None
+                        ):
+                            if sha1 is not None:
+                                # already hashed; store_resource copies the file
+                                pass
+                            elif (
+                                id is not None
+                                and src.is_file()
+                                and _other_filesystem(archive_cfg, src)
+                            ):
+                                # hash while copying so the source is only read once
+                                staged, sha1 = stage_resource(archive_cfg, src, id)
+                            else:
+                                sha1 = util.hash(src)
+                            log.info("   sha1: %s", sha1)
+                        else:
+                            sha1 = None
+                        stat = src.stat()
+                        record = {
+                            "source": str(src.resolve()),
+                            "id": id,
+                            "sha1": sha1,
+                            "size": stat.st_size,
+                            "mtime_ns": stat.st_mtime_ns,
+                            "staged": None if staged is None else str(staged),
+                            "state": "hashed",
+                        }
+                        note(record)
+                    elif staged is not None and not staged.exists():
+                        try:
+                            # interrupted after the copy was moved into place
+                            tgt = resource_path(archive_cfg, id, resolve_ext=True)
+                        except FileNotFoundError:
+                            staged, _ = stage_resource(archive_cfg, src, id, sha1)
+                            record = {**record, "staged": str(staged)}
+                    if record["state"] == "hashed":
+                        try:
+                            id = register(record)
+                        except Exception:
+                            if staged is not None and tgt is None:
+                                staged.unlink()
+                            raise
+                        record = {**record, "id": id, "state": "registered"}
+                        note(record)
+                        log.info("   registered as %s", full_url(registry_url, id))
+                    if tgt is None:
+                        tgt = store_resource(archive_cfg, staged or src, id=id)
+                    if staged is not None:
+                        src.unlink()
+                    note({**record, "state": "moved"})
+                    log.info("   deposited in %s", tgt)
+                if record["sha1"] is not None:
+                    deposited[record["sha1"]] = id
+                yield {"source": src, "id": id}
+            if journal is not None:
+                journal.compact(lambda record: record["state"] != "moved")
+
+
+def deposit_parallel(
+    archive_path: Path,
+    files: Iterable[Path],
+    jobs: int = 4,
+    *,
+    chunk_size: int = 16,
+    **kwargs: Any,
+) -> Iterator[Dict]:
+    """Deposit resources into an archive using `jobs` worker processes
+
+    The files are split into chunks of `chunk_size`, and each chunk is deposited
+    by calling `deposit` with the remaining arguments in a worker process. Files
+    are hashed, registered, and moved in parallel; `archive.store_resource` locks
+    the resource subdirectories, so workers (including workers in other
+    processes or on other hosts) can't store resources with the same id. Results
+    are yielded as chunks finish. If a chunk raises an error, it's re-raised
+    after the chunks that already started are finished.
+
+    If `dedupe` is set, duplicates are found once for all the files before they
+    are split into chunks (see `find_duplicates`), and the workers are given the
+    hashes. Files that duplicate a resource in the registry are handled right
+    away. Only the first of the files with the same contents is sent to the
+    workers; the others are checked against the registry (without hashing them
+    again) after the workers finish, so they're handled as duplicates of that
+    file if it was deposited.
+
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+
+    from nbank.util import batched, map_unordered
+
+    dedupe = kwargs.pop("dedupe", None)
+    known: Dict[Path, str] = {}
+    later: List[Path] = []
+    duplicates: List[Dict] = []
+
+    def unique(registry_url):
+        first = set()
+        for item in find_duplicates(registry_url, files):
+            src, sha1 = item["path"], item["sha1"]
+            if sha1 is not None:
+                known[src] = sha1
+            if item["matches"]:
+                log.info("processing '%s':", src)
+                duplicates.append(
+                    _skip_duplicate(registry_url, src, item["matches"], dedupe)
+                )
+            elif sha1 is not None and sha1 in first:
+                later.append(src)
+            else:
+                first.add(sha1)
+                yield src, sha1
+
+    if dedupe is None:
+        items = ((src, None) for src in files)
+    else:
+        with open_session(kwargs.get("auth")) as session:
+            archive_cfg, _ = lookup_archive(session, archive_path)
+        items = unique(archive_cfg["registry"])
+    deposit_chunk = partial(_deposit_chunk, archive_path, kwargs)
+    # workers are started while other threads may be running (e.g. hashing files
+    # for dedupe), so they can't be forked from this process
+    context = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(jobs, mp_context=context) as executor:
+        for results in map_unordered(
+            executor, deposit_chunk, batched(items, chunk_size), 2 * jobs
+        ):
+            yield from results
+            yield from duplicates
+            duplicates.clear()
+    yield from duplicates
+    if later:
+        yield from deposit(archive_path, later, dedupe=dedupe, hashes=known, **kwargs)
+
+
+def _deposit_chunk(
+    archive_path: Path, kwargs: Dict, items: List[Tuple[Path, Optional[str]]]
+) -> List[Dict]:
+    files = [src for src, _ in items]
+    hashes = {src: sha1 for src, sha1 in items if sha1 is not None}
+    return list(deposit(archive_path, files, hashes=hashes, **kwargs))
+
+
+def plan_deposit(
+    archive_path: Path,
+    files: Iterable[Path],
+    dtype: Optional[str] = None,
+    hash: bool = False,
+    auto_id: bool = False,
+    auth: RegistryAuth = None,
+) -> Dict:
+    """Check whether files can be deposited into an archive, without changing anything
+
+    This catches most of the problems that `deposit` would otherwise discover
+    one file at a time, often after hashing: files that don't exist or are
+    directories (if not allowed by the archive policy), invalid or duplicate
+    identifiers, identifiers that are already in the archive or in the registry,
+    files that can't be read or resource directories that can't be written, and
+    unknown datatypes. No files are read, and the registry is checked for all
+    the identifiers in bulk.
+
+    Returns a dict with the archive, its name in the registry, a list of
+    problems that affect the whole deposit (`errors`), and the plan for each of
+    the `files` (a dict with `source`, `id`, `size`, whether it will be hashed
+    and copied to another file system, and `error` if it can't be deposited).
+    Also includes the number of files that can be deposited (`n_files`) and
+    that can't (`n_errors`), and the total bytes to hash, move, and copy.
+
+    """
+    from functools import partial
+
     from nbank import util
-    from nbank.archive import check_permissions, get_config, store_resource
-    from nbank.registry import add_resource, find_archive_by_path, full_url
+    from nbank.archive import check_permissions, resource_path
+    from nbank.instrument import path_size
+    from nbank.registry import _bulk_query_size, get_datatypes, get_resource_bulk
+
+    def check(item: Dict) -> Optional[str]:
+        src = item["source"]
+        if not src.exists():
+            return "does not exist"
+        if src.is_dir() and not policy["allow_directories"]:
+            return "is a directory"
+        if not auto_id:
+            try:
+                item["id"] = id = util.id_from_fname(src)
+            except ValueError:
+                return f"'{src.stem}' is not a valid identifier"
+            if id in ids:
+                return f"has the same identifier as {ids[id]}"
+            ids[id] = src
+        if not check_permissions(archive_cfg, src, item["id"]):
+            return "unable to read the file or write to the archive"
+        if item["id"] is not None:
+            try:
+                resource_path(archive_cfg, item["id"], resolve_ext=True)
+                return "identifier is already in the archive"
+            except FileNotFoundError:
+                pass
+        item["size"] = path_size(src)
+        item["copy"] = _other_filesystem(archive_cfg, src)
+        return None
+
+    with open_session(auth) as session:
+        archive_cfg, archive = lookup_archive(session, archive_path)
+        registry_url = archive_cfg["registry"]
+        policy = archive_cfg["policy"]
+        auto_id = policy["auto_identifiers"] or auto_id
+        hash = hash or policy["require_hash"]
+        errors = []
+        if dtype is not None:
+            url, params = get_datatypes(registry_url)
+            dtypes = util.query_registry_paginated(session, url, params)
+            if dtype not in {d["name"] for d in dtypes}:
+                errors.append(f"unknown dtype '{dtype}'")
+
+        items = []
+        ids: Dict[str, Path] = {}
+        for src in files:
+            item = {"source": src, "id": None, "size": 0, "hash": hash, "copy": False}
+            error = check(item)
+            if error is not None:
+                item["error"] = error
+            items.append(item)
+        if ids:
+            taken = {
+                record["name"]
+                for record in util.query_registry_bulk_chunked(
+                    session,
+                    partial(get_resource_bulk, registry_url),
+                    list(ids),
+                    chunk_size=_bulk_query_size,
+                )
+            }
+            for item in items:
+                if "error" not in item and item["id"] in taken:
+                    item["error"] = "identifier is already registered"
 
+    ok = [item for item in items if "error" not in item]
+    return {
+        "archive": archive_cfg["path"],
+        "archive_name": archive,
+        "registry": registry_url,
+        "errors": errors,
+        "files": items,
+        "n_files": len(ok),
+        "n_errors": len(items) - len(ok),
+        "bytes_to_hash": sum(item["size"] for item in ok if hash),
+        "bytes_to_move": sum(item["size"] for item in ok),
+        "bytes_to_copy": sum(item["size"] for item in ok if item["copy"]),
+    }
+
+
+def _journal(archive_cfg: Dict, fname: str, **kwargs: Any) -> "Journal":
+    """Returns a journal in the state directory of an archive.
+
+    The journal file is created with the ownership and permissions of the
+    archive policy, so that other users can add to it.
+
+    """
+    from nbank.archive import permission_fixer, state_dir
+    from nbank.journal import Journal
+
+    pfix = permission_fixer(archive_cfg)
+
+    def fix(path: Path) -> None:
+        # start from rw for everyone so the result doesn't depend on our umask
+        path.chmod(0o666)
+        pfix(path)
+
+    return Journal(state_dir(archive_cfg) / fname, fix=fix, **kwargs)
+
+
+@contextmanager
+def _deposit_journal(archive_cfg: Dict, resume: bool) -> Iterator[Optional["Journal"]]:
+    """Opens the deposit journal of an archive if resume is True.
+
+    Yields None if resume is False or the journal can't be opened (usually
+    because the state directory is missing and can't be created, or is
+    read-only).
+
+    """
+    journal = None
+    if resume:
+        try:
+            journal = _journal(archive_cfg, _deposit_fname, key="source")
+            journal.open()
+        except OSError as err:
+            log.warning(
+                "unable to open deposit journal; progress won't be saved (%s)", err
+            )
+            journal = None
     try:
-        archive_cfg = get_config(archive_path)
+        yield journal
+    finally:
+        if journal is not None:
+            journal.close()
+
+
+def _other_filesystem(archive_cfg: Dict, src: Path) -> bool:
+    """True if src is not on the same file system as the resources in the archive"""
+    from nbank.archive import _resource_subdir
+
+    resources = archive_cfg["path"] / _resource_subdir
+    return src.stat().st_dev != resources.stat().st_dev
+
+
+def _skip_duplicate(
+    registry_url: str, src: Path, matches: List[str], dedupe: Optional[str]
+) -> Dict:
+    """Handles a file with the same contents as matches, returning the deposit result"""
+    log.info("   same contents as %s", ", ".join(matches))
+    link = None
+    if dedupe == "link":
+        link = _link_duplicate(registry_url, src, matches)
+    return {"source": src, "id": None, "duplicate_of": matches[0], "link": link}
+
+
+def _link_duplicate(registry_url: str, src: Path, ids: List[str]) -> Optional[Path]:
+    """Replaces src with a symbolic link to the first of ids in a local archive.
+
+    Returns the path of the resource, or None if none of the resources are local.
+
+    """
+    import os
+    import shutil
+
+    for id in ids:
+        for resource in find(registry_url, id):
+            path = getattr(resource, "path", None)
+            if path is None:
+                continue
+            if src.is_dir() and not src.is_symlink():
+                shutil.rmtree(src)
+                src.symlink_to(path)
+            else:
+                tmp = src.with_name(f".{src.name}.link")
+                tmp.symlink_to(path)
+                os.replace(tmp, src)
+            log.info("   replaced with a link to %s", path)
+            return path
+    log.info("   no local copies of %s; leaving in place", ", ".join(ids))
+    return None
+
+
+def queue_deposit(
+    archive_path: Path,
+    files: Iterable[Path],
+    dtype: Optional[str] = None,
+    auto_id: bool = False,
+    **metadata: Any,
+) -> Iterator[Dict]:
+    """Stage resources in an archive to be registered later by `flush_deposits`
+
+    This function does not contact the registry, so it can be used when the
+    registry is slow or unavailable. Each file is checked and hashed as in
+    `deposit`, then moved into a staging area inside the archive, and the
+    information needed to register it is recorded in a journal (see
+    `nbank.journal`). If the archive policy calls for automatic identifiers, a
+    random UUID is used for each file.
+
+    Yields the source path and id of each queued item. Files that do not exist,
+    directories (unless allowed by the archive policy), and ids that are already
+    in the queue are skipped. Raises ValueError if archive_path is not an archive
+    and OSError if the archive is not writable.
+
+    """
+    import uuid
+    from shutil import move
+
+    from nbank import archive, util
+
+    try:
+        archive_cfg = archive.get_config(archive_path)
     except FileNotFoundError as err:
         raise ValueError(f"{archive_path} is not a valid archive") from err
-    archive_path = archive_cfg["path"]  # this will resolve the path
-    log.info("archive: %s", archive_path)
-    registry_url = archive_cfg["registry"]
-    log.info("   registry: %s", registry_url)
+    log.info("archive: %s", archive_cfg["path"])
     auto_id = archive_cfg["policy"]["auto_identifiers"] or auto_id
-    auto_id_type = archive_cfg["policy"].get("auto_id_type", None)
     allow_dirs = archive_cfg["policy"]["allow_directories"]
+    staging = archive.state_dir(archive_cfg, _staging_subdir)
+    pfix = archive.permission_fixer(archive_cfg)
 
-    with httpx.Client() as session:
-        session.auth = make_auth(auth)
-        # check that archive exists for this path
-        url, params = find_archive_by_path(registry_url, archive_path)
-        try:
-            archive = util.query_registry_first(session, url, params)["name"]
-        except TypeError as err:
-            raise RuntimeError(
-                f"archive '{archive_path}' not in registry. did it move?"
-            ) from err
-        log.info("   archive name: %s", archive)
-
+    with _journal(archive_cfg, _queue_fname) as journal:
+        queued = {record["id"] for record in journal.records()}
         for src in files:
             log.info("processing '%s':", src)
             if not src.exists():
@@ -98,66 +722,182 @@ def deposit(
             if not allow_dirs and src.is_dir():
                 log.info("   is a directory; skipping")
                 continue
-            if auto_id:
-                if auto_id_type == "uuid":
-                    id = str(uuid.uuid4())
-                else:
-                    id = None
-            else:
-                id = util.id_from_fname(src)
-            if not check_permissions(archive_cfg, src, id):
+            id = str(uuid.uuid4()) if auto_id else util.id_from_fname(src)
+            if id in queued:
+                log.info("   %s is already queued; skipping", id)
+                continue
+            if not archive.check_permissions(archive_cfg, src, id):
                 raise OSError("unable to write to archive, aborting")
-            if hash or archive_cfg["policy"]["require_hash"]:
-                sha1 = util.hash(src)
-                log.info("   sha1: %s", sha1)
-            else:
-                sha1 = None
-            url, params = add_resource(
-                registry_url, id, dtype, archive, sha1, **metadata
-            )
-            log.debug("POST %s: %s", url, params)
-            r = session.post(url, json=params)
-            r.raise_for_status()
-            result = r.json()
+            sha1 = util.hash(src)
+            log.info("   sha1: %s", sha1)
+            record = {
+                "id": id,
+                "source": str(src.resolve()),
+                "staged": str(staging / f"{id}{src.suffix}"),
+                "dtype": dtype,
+                "sha1": sha1,
+                "metadata": metadata,
+            }
+            # if this process dies during the move, flush_deposits can finish it
+            journal.append({**record, "state": "staging"})
+            move(src, record["staged"])
+            pfix(Path(record["staged"]))
+            journal.append({**record, "state": "queued"})
+            queued.add(id)
+            log.info("   queued as %s", id)
+            yield {"source": src, "id": id}
 
-            log.info("   registered as %s", full_url(registry_url, result["name"]))
-            tgt = store_resource(archive_cfg, src, id=result["name"])
-            log.info("   deposited in %s", tgt)
-            yield {"source": src, "id": result["name"]}
+
+def flush_deposits(
+    archive_path: Path,
+    auth: RegistryAuth = None,
+    *,
+    max_workers: int = 4,
+    chunk_size: int = 100,
+) -> Iterator[Dict]:
+    """Register the resources queued by `queue_deposit` and move them into the archive
+
+    The queue is read from the journal in chunks of `chunk_size`, so the queued
+    records are not all held in memory at once. The registry is checked for
+    the ids in each chunk with a single bulk request, and then the resources are
+    registered and moved into the archive concurrently in `max_workers` threads.
+    Items that were registered by an earlier flush that did not finish (i.e.,
+    with the same hash) are not registered again; if the existing record doesn't
+    list this archive as a location, the location is added. The state of each item is
+    recorded in the journal as it progresses, and items that are finished are
+    removed from the journal at the end.
+
+    Yields a dict with the `source` and `id` of each item, plus an `error` field
+    if the item could not be deposited. Items with errors stay in the queue.
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from functools import partial
+    from shutil import move
+
+    import httpx
+
+    from nbank import archive, util
+    from nbank.registry import add_location, add_resource, get_resource_bulk
+
+    def finish(record, registered):
+        id = record["id"]
+        staged = Path(record["staged"])
+        result = {"source": Path(record["source"]), "id": id}
+        try:
+            if record["state"] == "staging" and not staged.exists():
+                move(record["source"], staged)
+            if record["state"] in ("staging", "queued"):
+                existing = registered.get(id)
+                if existing is None:
+                    url, params = add_resource(
+                        registry_url,
+                        id,
+                        record["dtype"],
+                        archive_name,
+                        record["sha1"],
+                        **record["metadata"],
+                    )
+                    r = session.post(url, json=params)
+                    r.raise_for_status()
+                elif existing["sha1"] != record["sha1"]:
+                    raise ValueError(f"a different resource is registered as {id}")
+                elif archive_name not in existing["locations"]:
+                    # registered with the same contents in another archive
+                    url, params = add_location(registry_url, id, archive_name)
+                    r = session.post(url, json=params)
+                    r.raise_for_status()
+                log.info("   %s registered", id)
+                journal.append({**record, "state": "registered"})
+            tgt = archive.store_resource(archive_cfg, staged, id=id)
+            journal.append({**record, "state": "deposited"})
+            log.info("   %s deposited in %s", id, tgt)
+        except httpx.HTTPStatusError as err:
+            log.info("   %s failed to register: %s", id, err.response.text)
+            result["error"] = err.response.text
+        except (KeyError, OSError, ValueError) as err:
+            log.info("   %s failed to deposit: %s", id, err)
+            result["error"] = str(err)
+        return result
+
+    with open_session(auth) as session:
+        archive_cfg, archive_name = lookup_archive(session, archive_path)
+        registry_url = archive_cfg["registry"]
+        log.info("archive: %s", archive_cfg["path"])
+        log.info("   registry: %s", registry_url)
+        journal = _journal(archive_cfg, _queue_fname)
+        with journal, ThreadPoolExecutor(max_workers) as executor:
+            # the queue is streamed, so records for items that finish are appended
+            # while it's being read
+            pending = (r for r in journal.latest() if r["state"] != "deposited")
+            n_pending = 0
+            for chunk in util.batched(pending, chunk_size):
+                n_pending += len(chunk)
+                url, query = get_resource_bulk(registry_url, [r["id"] for r in chunk])
+                registered = {
+                    record["name"]: record
+                    for record in util.query_registry_bulk(session, url, query)
+                }
+                yield from util.map_unordered(
+                    executor,
+                    partial(finish, registered=registered),
+                    chunk,
+                    2 * max_workers,
+                )
+            log.info("   %d queued resources processed", n_pending)
+            journal.compact(lambda record: record["state"] != "deposited")
 
 
 def search(registry_url: str, **params) -> Iterator[Dict]:
     """Searches the registry for resources that match query params, yielding a sequence of hits"""
+
     from nbank.registry import find_resource
     from nbank.util import query_registry_paginated
 
     url, _ = find_resource(registry_url)
-    with httpx.Client() as session:
+    with open_session() as session:
         yield from query_registry_paginated(session, url, params)
 
 
 def describe(registry_url: str, id: str) -> Optional[Dict]:
     """Returns the database record for a resource, or None if it does not exist in the registry"""
+
     from nbank.registry import get_resource
     from nbank.util import query_registry
 
     url, params = get_resource(registry_url, id)
-    with httpx.Client() as session:
+    with open_session() as session:
         return query_registry(session, url, params)
 
 
-def describe_many(registry_url: str, *ids: str) -> Iterator[Dict]:
+def describe_many(
+    registry_url: str,
+    *ids: str,
+    chunk_size: Optional[int] = None,
+    max_workers: int = 4,
+) -> Iterator[Dict]:
     """Returns the database record(s) for one or more resources.
 
-    Yields one record for each resource that was located in the registry.
+    Yields one record for each resource that was located in the registry. The
+    ids are split into chunks of `chunk_size` (default is
+    `registry._bulk_query_size`), and up to `max_workers` chunks are requested
+    concurrently. Records are yielded as they arrive, so they may not be in the
+    same order as ids.
 
     """
-    from nbank.registry import get_resource_bulk
-    from nbank.util import query_registry_bulk
+    from functools import partial
+
+    from nbank.registry import _bulk_query_size, get_resource_bulk
+    from nbank.util import query_registry_bulk_chunked
 
-    url, query = get_resource_bulk(registry_url, ids)
-    with httpx.Client() as session:
-        yield from query_registry_bulk(session, url, query)
+    with open_session() as session:
+        yield from query_registry_bulk_chunked(
+            session,
+            partial(get_resource_bulk, registry_url),
+            ids,
+            chunk_size=chunk_size or _bulk_query_size,
+            max_workers=max_workers,
+        )
 
 
 def find(
@@ -169,11 +909,12 @@ def find(
     to be used with temporary copies of archives on other hosts.
 
     """
+
     from nbank.registry import get_locations
     from nbank.util import parse_location, query_registry_paginated
 
     url, params = get_locations(registry_url, id)
-    with httpx.Client() as session:
+    with open_session() as session:
         for loc in query_registry_paginated(session, url, params):
             yield parse_location(loc, alt_base=alt_base, http_session=session)
 
@@ -219,6 +960,187 @@ def verify(
             raise ValueError(f"{id} does not exist") from err
 
 
+def verify_many(
+    registry_url: str,
+    files: Iterable[Path],
+    *,
+    max_workers: int = 4,
+    chunk_size: int = 100,
+) -> Iterator[Dict]:
+    """Compute hashes for files and check them against the registry.
+
+    Files are hashed concurrently in `max_workers` threads. The identifier for
+    each file is taken from its name, and the records for these identifiers are
+    looked up in bulk for each chunk of `chunk_size` hashed files. If a file's
+    identifier is not in the registry (or the name is not a valid identifier),
+    the registry is searched for resources with the same hash.
+
+    Yields a dict for each file as it is checked, with `path`, `id`, `sha1` and
+    `status` fields. The status is one of `ok` (hash matches the record for the
+    id), `mismatch` (hash does not match the record for the id), `matched`
+    (the id is not in the registry, but the hash matches the resources listed in
+    `matches`), `unmatched` (no resources with the hash), `missing` (the file
+    does not exist), or `error` (the file could not be read).
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from nbank.registry import find_resource, get_resource_bulk
+    from nbank.util import (
+        batched,
+        hash,
+        id_from_fname,
+        map_unordered,
+        query_registry_bulk,
+        query_registry_paginated,
+    )
+
+    def hash_file(path):
+        result = {"path": str(path), "id": None, "sha1": None}
+        try:
+            result["id"] = id_from_fname(path)
+        except ValueError:
+            pass
+        log.debug("verifying %s", path)
+        try:
+            result["sha1"] = hash(path)
+        except FileNotFoundError:
+            result["status"] = "missing"
+        except OSError as err:
+            result.update(status="error", error=str(err))
+        return result
+
+    def search_hash(result):
+        log.debug("  searching by hash (%s)", result["sha1"])
+        url, _ = find_resource(registry_url)
+        params = {"sha1": result["sha1"]}
+        matches = [r["name"] for r in query_registry_paginated(session, url, params)]
+        return {
+            **result,
+            "status": "matched" if matches else "unmatched",
+            "matches": matches,
+        }
+
+    with open_session() as session, ThreadPoolExecutor(
+        max_workers
+    ) as hashers, ThreadPoolExecutor(max_workers) as searchers:
+        hashed = map_unordered(hashers, hash_file, files, 2 * max_workers)
+        for chunk in batched(hashed, chunk_size):
+            yield from (result for result in chunk if "status" in result)
+            chunk = [result for result in chunk if "status" not in result]
+            ids = {result["id"] for result in chunk if result["id"] is not None}
+            records = {}
+            if ids:
+                url, query = get_resource_bulk(registry_url, sorted(ids))
+                for record in query_registry_bulk(session, url, query):
+                    records[record["name"]] = record
+            to_search = []
+            for result in chunk:
+                record = records.get(result["id"])
+                if record is None:
+                    to_search.append(result)
+                elif record["sha1"] == result["sha1"]:
+                    yield {**result, "status": "ok"}
+                else:
+                    yield {
+                        **result,
+                        "status": "mismatch",
+                        "registry_sha1": record["sha1"],
+                    }
+            yield from map_unordered(searchers, search_hash, to_search, 2 * max_workers)
+
+
+def find_duplicates(
+    registry_url: str,
+    files: Iterable[Path],
+    *,
+    max_workers: int = 4,
+    hashes: Optional[Dict[Path, str]] = None,
+) -> Iterator[Dict]:
+    """Compute hashes for files and search the registry for resources with the same hash.
+
+    Files are hashed concurrently in `max_workers` threads, and the registry is
+    searched for each hash as soon as it's computed, also concurrently, so the
+    files are checked in roughly the time it takes to read them. Yields a dict
+    for each file as it is checked, with `path`, `sha1` (None if the file could
+    not be read), and the names of the resources with the same hash in
+    `matches`. The results are not in the same order as files. Files in `hashes`
+    are not hashed again.
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from nbank.registry import find_resource
+    from nbank.util import hash, map_unordered, query_registry_paginated
+
+    def hash_file(path):
+        if path in hashes:
+            return {"path": path, "sha1": hashes[path]}
+        log.debug("hashing %s", path)
+        try:
+            return {"path": path, "sha1": hash(path)}
+        except OSError as err:
+            log.debug("  unable to hash %s: %s", path, err)
+            return {"path": path, "sha1": None}
+
+    def search_hash(result):
+        if result["sha1"] is None:
+            return {**result, "matches": []}
+        url, _ = find_resource(registry_url)
+        params = {"sha1": result["sha1"]}
+        matches = [r["name"] for r in query_registry_paginated(session, url, params)]
+        return {**result, "matches": matches}
+
+    hashes = hashes or {}
+    with open_session() as session, ThreadPoolExecutor(
+        max_workers
+    ) as hashers, ThreadPoolExecutor(max_workers) as searchers:
+        hashed = map_unordered(hashers, hash_file, files, 2 * max_workers)
+        yield from map_unordered(searchers, search_hash, hashed, 2 * max_workers)
+
+
+def archive_duplicates(
+    archive_path: Path, auth: RegistryAuth = None, *, max_workers: int = 4
+) -> Dict[str, List[str]]:
+    """Find resources in an archive that have the same contents.
+
+    The hashes of the resources are taken from the registry. Resources that
+    were deposited without a hash are hashed in `max_workers` threads. Returns
+    a dict mapping each hash shared by more than one resource to a sorted list
+    of the resource names.
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from nbank.archive import resource_path
+    from nbank.registry import find_resource
+    from nbank.util import hash, map_unordered, query_registry_paginated
+
+    def hash_resource(id):
+        try:
+            return id, hash(resource_path(archive_cfg, id, resolve_ext=True))
+        except FileNotFoundError:
+            log.info("%s: missing from the archive", id)
+            return id, None
+
+    with open_session(auth) as session:
+        archive_cfg, archive = lookup_archive(session, archive_path)
+        url, _ = find_resource(archive_cfg["registry"])
+        hashes = {
+            record["name"]: record["sha1"]
+            for record in query_registry_paginated(session, url, {"location": archive})
+        }
+    unhashed = [id for id, sha1 in hashes.items() if sha1 is None]
+    log.debug("hashing %d resources without hashes in the registry", len(unhashed))
+    with ThreadPoolExecutor(max_workers) as executor:
+        hashes.update(map_unordered(executor, hash_resource, unhashed, 2 * max_workers))
+    groups: Dict[str, List[str]] = {}
+    for id, sha1 in hashes.items():
+        if sha1 is not None:
+            groups.setdefault(sha1, []).append(id)
+    return {sha1: sorted(ids) for sha1, ids in groups.items() if len(ids) > 1}
+
+
 def fetch(
     base_url: str,
     id: str,
@@ -233,13 +1155,13 @@ def fetch(
     Raises FileExistsError if `target` already exists.
 
     """
+
     from nbank.registry import get_locations
     from nbank.util import download_to_file, parse_location, query_registry
 
     # query the database for the URL
     url, _ = get_locations(base_url, id)
-    with httpx.Client() as session:
-        session.auth = make_auth(auth)
+    with open_session(auth) as session:
         for loc in query_registry(session, url):
             if loc["scheme"] in ("https", "http"):
                 res_url = parse_location(loc)
@@ -248,33 +1170,173 @@ def fetch(
         raise ValueError(f"resource '{id}' does not exist or is not downloadable")
 
 
+def plan_recall(
+    registry_url: str, ids: Iterable[str], index_dir: Optional[Path] = None
+) -> Dict[str, Any]:
+    """Plan the order for recalling resources from tape.
+
+    Locations are looked up in bulk, and the resources that are only available
+    on tape are grouped by tape and sorted by file index and (if index_dir
+    contains member indices for the tape files) by offset in the tar file. See
+    `tape_archive.plan_recall` for details on the return value. Any ids that
+    are not in the registry are listed in the `missing` field.
+
+    """
+
+    from nbank.registry import _bulk_query_size, get_locations_bulk
+    from nbank.tape_archive import plan_recall
+    from nbank.util import batched, query_registry_bulk
+
+    requested = list(dict.fromkeys(ids))
+    records = []
+    with open_session() as session:
+        for chunk in batched(requested, _bulk_query_size):
+            url, query = get_locations_bulk(registry_url, chunk)
+            records.extend(query_registry_bulk(session, url, query))
+    plan = plan_recall(records, index_dir)
+    found = {record["name"] for record in records}
+    plan["missing"] = [id for id in requested if id not in found]
+    return plan
+
+
 def update(
     base_url: str, *ids: str, auth: RegistryAuth = None, **metadata: Any
 ) -> Iterator[Dict]:
-    """Update metadata for one or more resources. Set a key to None to delete."""
-    from nbank.registry import update_resource_metadata
-
-    with httpx.Client(headers={"Accept": "application/json"}) as session:
-        session.auth = make_auth(auth)
-        for id in ids:
-            url, params = update_resource_metadata(base_url, id, **metadata)
-            r = session.patch(url, json=params)
-            if r.status_code == 404:
-                yield {"name": id, "error": "not found"}
+    """Update metadata for one or more resources. Set a key to None to delete.
+
+    See `update_many` for details.
+    """
+    return update_many(base_url, ids, auth=auth, **metadata)
+
+
+def update_many(
+    base_url: str,
+    records: Iterable[Union[str, Dict]],
+    *,
+    auth: RegistryAuth = None,
+    max_workers: int = 8,
+    **metadata: Any,
+) -> Iterator[Dict]:
+    """Update metadata for many resources concurrently. Set a key to None to delete.
+
+    records can be resource ids or dicts with a `name` (or `id`) field and an
+    optional `metadata` field, which is merged with any keyword arguments. The
+    first chunk of records is sent to the bulk update endpoint. If the registry
+    rejects that request with a client error other than 400 (for example, because
+    it doesn't have the endpoint or the user isn't allowed to use it), each
+    resource is updated in a separate request. If a bulk request fails with 400,
+    the resources in that chunk are updated one at a time so that only the
+    invalid ones fail. At most `max_workers` requests are made concurrently.
+
+    Yields the updated registry records in the order they are completed. If a
+    resource could not be updated (for example, because it does not exist), yields
+    a dict with `name` and `error` fields instead. Raises HTTPStatusError for
+    authentication and permission errors.
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from itertools import chain
+
+    from nbank.registry import (
+        _bulk_query_size,
+        update_resource_metadata,
+        update_resource_metadata_bulk,
+    )
+    from nbank.util import batched, map_unordered
+
+    def normalize(record):
+        if isinstance(record, str):
+            return (record, metadata)
+        id = record.get("name", record.get("id"))
+        if id is None:
+            raise ValueError(f"record {record} does not have a name")
+        return (id, {**metadata, **record.get("metadata", {})})
+
+    def check_error(id, r):
+        if r.status_code in (401, 403):
             r.raise_for_status()
-            yield r.json()
+        if r.status_code == 404:
+            return {"name": id, "error": "not found"}
+        if r.is_error:
+            try:
+                error = r.json()
+            except ValueError:
+                error = r.reason_phrase
+            return {"name": id, "error": error}
+
+    def update_one(record):
+        id, data = record
+        url, params = update_resource_metadata(base_url, id, **data)
+        r = session.patch(url, json=params, headers={"Accept": "application/json"})
+        return check_error(id, r) or r.json()
+
+    def update_chunk(chunk):
+        url, params = update_resource_metadata_bulk(base_url, chunk)
+        results = []
+        with session.stream(
+            "PATCH", url, json=params, headers={"Accept": "application/json"}
+        ) as r:
+            if r.status_code == 400:
+                # find the records that the registry won't accept
+                return list(map(update_one, chunk))
+            if r.is_client_error:
+                # registry does not support (or won't allow) bulk updates
+                return None
+            r.read()
+            error = check_error(None, r)
+            if error is not None:
+                return [{**error, "name": id} for id, _ in chunk]
+            results.extend(json.loads(line) for line in r.iter_lines() if line)
+        updated = {result["name"] for result in results}
+        results.extend(
+            {"name": id, "error": "not found"} for id, _ in chunk if id not in updated
+        )
+        return results
+
+    chunks = batched(map(normalize, records), _bulk_query_size)
+    first = next(chunks, None)
+    if first is None:
+        return
+    with open_session(auth) as session, ThreadPoolExecutor(max_workers) as executor:
+        results = update_chunk(first) if len(first) > 1 else None
+        if results is not None:
+            yield from results
+            for results in map_unordered(
+                executor,
+                lambda chunk: update_chunk(chunk) or list(map(update_one, chunk)),
+                chunks,
+                max_workers,
+            ):
+                yield from results
+        else:
+            log.debug("updating resources individually")
+            yield from map_unordered(
+                executor,
+                update_one,
+                chain(first, chain.from_iterable(chunks)),
+                2 * max_workers,
+            )
 
 
 __all__ = [
+    "archive_duplicates",
     "deposit",
+    "deposit_parallel",
     "describe",
     "describe_many",
     "fetch",
     "find",
+    "find_duplicates",
+    "flush_deposits",
     "get",
+    "plan_deposit",
+    "plan_recall",
+    "queue_deposit",
     "search",
     "update",
+    "update_many",
     "verify",
+    "verify_many",
 ]
 
 # Variables:
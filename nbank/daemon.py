@@ -0,0 +1,249 @@
+# -*- mode: python -*-
+"""local daemon that runs nbank commands for the command-line client
+
+The daemon keeps a pooled registry client open and caches archive lookups (see
+`core.shared_session`), so that shell loops and pipelines calling `nbank` many
+times don't pay for new connections and lookups on every call. It listens on a
+Unix domain socket that is only accessible to the user who started it. The
+`nbank` script forwards commands to the daemon when it is running and falls
+back to running them in-process otherwise.
+
+Each request is a JSON object with the command-line arguments, the working
+directory, and any NBANK_* environment variables of the client. The daemon runs
+the command with `script.main` and responds with a JSON object containing the
+exit status and the captured stdout and stderr. Requests are handled one at a
+time.
+
+Copyright (C) 2025 Dan Meliza <dan@meliza.org>
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+log = logging.getLogger("nbank")  # root logger
+
+_env_socket = "NBANK_SOCKET"
+_env_disable = "NBANK_NO_DAEMON"
+# commands that can be forwarded. Others need access to the terminal or stdin,
+# make changes that should not depend on the daemon's state, or run long enough
+# that buffering their output and blocking other clients would be a problem
+# (like deposit).
+_forwarded_commands = (
+    "fetch",
+    "info",
+    "locate",
+    "modify",
+    "registry-info",
+    "search",
+    "verify",
+)
+# options that can't be forwarded because they need stdin, change credentials, or
+# collect statistics about the process
+_local_options = ("-a", "-@", "-", "--stats", "--stats-json", "--trace")
+# seconds to wait for a client to send a request or read the response
+_client_timeout = 10.0
+
+
+def socket_path() -> Path:
+    """Returns the path of the daemon socket.
+
+    This is taken from the NBANK_SOCKET environment variable if set. Otherwise the
+    socket is placed in XDG_RUNTIME_DIR, or in /tmp if that is not set.
+
+    """
+    path = os.environ.get(_env_socket)
+    if path:
+        return Path(path)
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return Path(runtime_dir) / "nbank.sock"
+    return Path("/tmp") / f"nbank-{os.getuid()}.sock"
+
+
+def can_forward(argv: Sequence[str]) -> bool:
+    """Returns True if the command in argv can be run by the daemon"""
+    if os.environ.get(_env_disable):
+        return False
+    if any(arg in _local_options for arg in argv):
+        return False
+    args = iter(argv)
+    for arg in args:
+        if arg == "-r":
+            # skip the value
+            next(args, None)
+        elif not arg.startswith("-"):
+            return arg in _forwarded_commands
+    return False
+
+
+def _client_env() -> Dict[str, str]:
+    return {k: v for k, v in os.environ.items() if k.startswith("NBANK_")}
+
+
+def _send(sock, message: Dict[str, Any]) -> None:
+    sock.sendall(json.dumps(message).encode("utf-8"))
+
+
+def _receive(sock) -> Dict[str, Any]:
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        chunks.append(data)
+    return json.loads(b"".join(chunks))
+
+
+def request(message: Dict[str, Any], path: Optional[Path] = None) -> Optional[Dict]:
+    """Send a request to the daemon and return the response.
+
+    Returns None if the daemon is not running or the socket is not owned by the
+    current user.
+
+    """
+    import socket
+
+    path = path or socket_path()
+    try:
+        if path.stat().st_uid != os.getuid():
+            log.debug("daemon socket %s is owned by another user, ignoring", path)
+            return None
+    except FileNotFoundError:
+        return None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except OSError:
+            return None
+        _send(sock, message)
+        sock.shutdown(socket.SHUT_WR)
+        return _receive(sock)
+
+
+def forward(argv: List[str], path: Optional[Path] = None) -> Optional[int]:
+    """Run the command in argv through the daemon, if it's running.
+
+    Writes the output of the command to stdout and stderr and returns the exit
+    status, or returns None if the command could not be forwarded.
+
+    """
+    import sys
+
+    if not can_forward(argv):
+        return None
+    response = request(
+        {"argv": argv, "cwd": os.getcwd(), "env": _client_env()}, path=path
+    )
+    if response is None:
+        return None
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    return response["status"]
+
+
+def run_command(argv: List[str], cwd: str, env: Dict[str, str]) -> Dict[str, Any]:
+    """Run an nbank command in the daemon process, capturing its output"""
+    import io
+    import traceback
+    from contextlib import redirect_stderr, redirect_stdout
+
+    from nbank import script
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    saved_cwd = os.getcwd()
+    saved_env = _client_env()
+    # script.main will set up logging to the captured stderr
+    saved_log = (log.level, log.handlers[:])
+    try:
+        os.chdir(cwd)
+        for key in saved_env:
+            del os.environ[key]
+        os.environ.update(env)
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                status = script.main(argv)
+            except SystemExit as err:
+                status = err.code
+            except Exception:
+                traceback.print_exc()
+                status = 1
+    except OSError as err:
+        stderr.write(f"nbank daemon: {err}\n")
+        status = 1
+    finally:
+        os.chdir(saved_cwd)
+        for key in _client_env():
+            del os.environ[key]
+        os.environ.update(saved_env)
+        log.setLevel(saved_log[0])
+        log.handlers[:] = saved_log[1]
+    if isinstance(status, str):
+        stderr.write(f"{status}\n")
+        status = 1
+    return {
+        "status": status or 0,
+        "stdout": stdout.getvalue(),
+        "stderr": stderr.getvalue(),
+    }
+
+
+def serve(path: Optional[Union[str, Path]] = None, auth=None) -> None:
+    """Listen for requests on the socket at path until a stop request is received"""
+    import socket
+
+    from nbank import core
+
+    path = Path(path or socket_path())
+    if request({"command": "ping"}, path=path) is not None:
+        raise RuntimeError(f"a daemon is already listening on {path}")
+    if path.exists() or path.is_symlink():
+        log.debug("removing stale socket %s", path)
+        path.unlink()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # create the socket with the right permissions to avoid a race
+    umask = os.umask(0o177)
+    try:
+        sock.bind(str(path))
+    finally:
+        os.umask(umask)
+    sock.listen()
+    log.info("nbank daemon listening on %s", path)
+    try:
+        with sock, core.shared_session(auth):
+            while True:
+                conn, _ = sock.accept()
+                # a stalled or vanished client shouldn't hang the daemon
+                conn.settimeout(_client_timeout)
+                with conn:
+                    try:
+                        message = _receive(conn)
+                        command = message.get("command")
+                        if command == "stop":
+                            _send(conn, {"status": 0})
+                            break
+                        elif command == "ping":
+                            _send(conn, {"status": 0, "pid": os.getpid()})
+                        else:
+                            log.debug("running %s", message["argv"])
+                            _send(
+                                conn,
+                                run_command(
+                                    message["argv"], message["cwd"], message["env"]
+                                ),
+                            )
+                    except ValueError:
+                        log.debug("ignoring malformed request")
+                    except OSError as err:
+                        log.debug("lost connection to client: %s", err)
+    finally:
+        path.unlink()
+        log.info("nbank daemon stopped")
+
+
+__all__ = ["can_forward", "forward", "request", "serve", "socket_path"]
+
+# Variables:
+# End:
@@ -0,0 +1,394 @@
+# -*- mode: python -*-
+"""instrumentation for registry requests and file operations
+
+Instrumentation is disabled by default and costs one flag check per call when
+it's off. Once enabled (with `enable()`, or the `--stats` option of the nbank
+script), every call to a function decorated with `timed`, every block wrapped
+in `span`, and every request made through a client with `event_hooks()` is
+recorded under an operation name, such as "hash" or "http GET". For each
+operation, the number of calls, errors, bytes processed, and a histogram of
+latencies are collected. Use `summary()` to get the statistics as a dict or
+`format_summary()` for a table.
+
+Tracing (`start_trace()`, or the `--trace` option) records the same operations
+as individual spans with their start time, duration, thread, and parent span.
+Spans are nested using context variables, so a span started inside another in
+the same thread is its child. Use `write_trace()` to save the spans in the
+Chrome trace event format.
+
+Copyright (C) 2025 Dan Meliza <dan@meliza.org>
+"""
+
+import functools
+import itertools
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional
+
+# upper bounds of the latency histogram buckets, in seconds
+buckets = (
+    0.001,
+    0.002,
+    0.005,
+    0.01,
+    0.02,
+    0.05,
+    0.1,
+    0.2,
+    0.5,
+    1.0,
+    2.0,
+    5.0,
+    10.0,
+    float("inf"),
+)
+
+_enabled = False
+_tracing = False
+_lock = threading.Lock()
+_stats: Dict[str, "OperationStats"] = {}
+_trace_events: List[Dict[str, Any]] = []
+_trace_start = 0.0
+_span_ids = itertools.count(1)
+_current_span: ContextVar[Optional[int]] = ContextVar("nbank_span", default=None)
+_pid = os.getpid()
+
+
+class OperationStats:
+    """Accumulates counts, bytes, and latencies for an operation"""
+
+    __slots__ = ("bytes", "count", "errors", "histogram", "max", "min", "total")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+        self.histogram = [0] * len(buckets)
+
+    def add(self, elapsed: float, nbytes: int = 0, error: bool = False) -> None:
+        self.count += 1
+        self.errors += error
+        self.bytes += nbytes
+        self.total += elapsed
+        self.min = min(self.min, elapsed)
+        self.max = max(self.max, elapsed)
+        self.histogram[bisect_left(buckets, elapsed)] += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate a latency quantile, as the upper bound of the bucket it falls in"""
+        target = q * self.count
+        n = 0
+        for bound, count in zip(buckets, self.histogram):
+            n += count
+            if n >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "total_s": self.total,
+            "mean_s": self.total / self.count if self.count else 0.0,
+            "min_s": self.min if self.count else 0.0,
+            "max_s": self.max,
+            "p50_s": self.quantile(0.5),
+            "p90_s": self.quantile(0.9),
+            "p99_s": self.quantile(0.99),
+            "histogram": {
+                str(bound): count
+                for bound, count in zip(buckets, self.histogram)
+                if count
+            },
+        }
+
+
+def enable() -> None:
+    """Start recording operations"""
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    """Stop recording operations. Statistics that were already collected are kept."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    """Discard all collected statistics"""
+    with _lock:
+        _stats.clear()
+
+
+def record(name: str, elapsed: float, nbytes: int = 0, error: bool = False) -> None:
+    """Record a call to operation `name` that took `elapsed` seconds"""
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = OperationStats()
+        stats.add(elapsed, nbytes, error)
+
+
+class Span:
+    """Context manager that measures the time spent in its body.
+
+    The time is recorded under `name` in the statistics (if enabled) and as a
+    span in the trace (if tracing). Set the `bytes` attribute to record the number
+    of bytes processed. Exceptions raised in the body are counted as errors. If
+    `nest` is True, spans started in the body (in the same thread or context)
+    will be children of this one.
+
+    """
+
+    __slots__ = ("attrs", "bytes", "id", "name", "nest", "parent", "start", "token")
+
+    def __init__(self, name: str, nest: bool = True, **attrs: Any):
+        self.name = name
+        self.nest = nest
+        self.attrs = attrs
+        self.bytes = 0
+        self.id = None
+        self.token = None
+
+    def __enter__(self) -> "Span":
+        if _tracing:
+            self.id = next(_span_ids)
+            self.parent = _current_span.get()
+            if self.nest:
+                self.token = _current_span.set(self.id)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        end = time.perf_counter()
+        if _enabled:
+            record(self.name, end - self.start, self.bytes, error=exc_type is not None)
+        if self.token is not None:
+            _current_span.reset(self.token)
+        if self.id is not None:
+            args = {**self.attrs, "span_id": self.id, "parent_id": self.parent}
+            if self.bytes:
+                args["bytes"] = self.bytes
+            if exc_type is not None:
+                args["error"] = exc_type.__name__
+            _add_event(self.name, self.start, end, args)
+
+
+class _NullSpan:
+    """Stands in for Span when instrumentation and tracing are off"""
+
+    __slots__ = ()
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+    def __setattr__(self, name, value) -> None:
+        pass
+
+
+_null_span = _NullSpan()
+
+
+def span(name: str, nest: bool = True, **attrs: Any):
+    """Returns a context manager that measures the time spent in its body.
+
+    See `Span` for details. Returns a no-op context manager if neither statistics
+    nor tracing are enabled. Use `nest=False` in generators, which may be
+    suspended while the caller does other things.
+
+    """
+    if not (_enabled or _tracing):
+        return _null_span
+    return Span(name, nest, **attrs)
+
+
+def timed(name: str, nbytes: Optional[Callable[..., int]] = None) -> Callable:
+    """Decorator that records calls to the function under `name`.
+
+    If nbytes is supplied, it's called with the return value and the arguments
+    of the function to get the number of bytes processed.
+
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not (_enabled or _tracing):
+                return fn(*args, **kwargs)
+            with Span(name) as s:
+                result = fn(*args, **kwargs)
+                if nbytes is not None:
+                    s.bytes = nbytes(result, *args, **kwargs)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def path_size(path) -> int:
+    """Returns the size of a file, or the total size of the files under a directory"""
+    try:
+        if path.is_dir():
+            return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+        return path.stat().st_size
+    except (AttributeError, OSError):
+        return 0
+
+
+def result_size(result, *args, **kwargs) -> int:
+    """Returns the size of the path returned by a function (for use with `timed`)"""
+    return path_size(result)
+
+
+def _on_request(request) -> None:
+    request.extensions["nbank_start"] = time.perf_counter()
+    if _tracing:
+        request.extensions["nbank_span"] = (next(_span_ids), _current_span.get())
+
+
+def _on_response(response) -> None:
+    request = response.request
+    start = request.extensions.get("nbank_start")
+    if start is None:
+        return
+    end = time.perf_counter()
+    name = f"http {request.method}"
+    nbytes = int(request.headers.get("content-length", 0)) + int(
+        response.headers.get("content-length", 0)
+    )
+    if _enabled:
+        record(name, end - start, nbytes, error=response.status_code >= 400)
+    span_ids = request.extensions.get("nbank_span")
+    if span_ids is not None:
+        args = {
+            "url": str(request.url),
+            "status": response.status_code,
+            "span_id": span_ids[0],
+            "parent_id": span_ids[1],
+        }
+        if nbytes:
+            args["bytes"] = nbytes
+        _add_event(name, start, end, args)
+
+
+def event_hooks() -> Dict[str, list]:
+    """Returns event hooks for an httpx Client that record the latency of requests.
+
+    The latency is measured to when the response headers are received. Returns
+    an empty dict if neither statistics nor tracing are enabled.
+
+    """
+    if not (_enabled or _tracing):
+        return {}
+    return {"request": [_on_request], "response": [_on_response]}
+
+
+def start_trace() -> None:
+    """Start recording spans. Any previously recorded spans are discarded."""
+    global _tracing, _trace_start
+    with _lock:
+        _trace_events.clear()
+    _trace_start = time.perf_counter()
+    _tracing = True
+
+
+def stop_trace() -> List[Dict[str, Any]]:
+    """Stop recording spans and return the trace events that were recorded"""
+    global _tracing
+    _tracing = False
+    with _lock:
+        events = _trace_events[:]
+        _trace_events.clear()
+    return events
+
+
+def is_tracing() -> bool:
+    return _tracing
+
+
+def _add_event(name: str, start: float, end: float, args: Dict[str, Any]) -> None:
+    event = {
+        "name": name,
+        "cat": "nbank",
+        "ph": "X",
+        "ts": (start - _trace_start) * 1e6,
+        "dur": (end - start) * 1e6,
+        "pid": _pid,
+        "tid": threading.get_native_id(),
+        "args": args,
+    }
+    with _lock:
+        _trace_events.append(event)
+
+
+def write_trace(path, events: List[Dict[str, Any]]) -> None:
+    """Write trace events to path in the Chrome trace event format.
+
+    The file can be loaded in chrome://tracing, Perfetto, or speedscope.
+    """
+    import json
+
+    with open(path, "w") as fp:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
+
+
+def summary() -> Dict[str, Dict[str, Any]]:
+    """Returns the statistics for each recorded operation"""
+    with _lock:
+        return {name: stats.to_dict() for name, stats in sorted(_stats.items())}
+
+
+def format_summary() -> str:
+    """Returns the statistics for each operation as a table"""
+    lines = [
+        f"{'operation':<24}{'count':>8}{'errors':>8}{'MB':>10}{'total s':>10}"
+        f"{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'MB/s':>10}"
+    ]
+    for name, stats in summary().items():
+        mb = stats["bytes"] / 1e6
+        rate = mb / stats["total_s"] if stats["total_s"] > 0 else 0.0
+        lines.append(
+            f"{name:<24}{stats['count']:>8}{stats['errors']:>8}{mb:>10.2f}"
+            f"{stats['total_s']:>10.3f}{stats['mean_s'] * 1000:>10.2f}"
+            f"{stats['p50_s'] * 1000:>10.2f}{stats['p90_s'] * 1000:>10.2f}"
+            f"{stats['p99_s'] * 1000:>10.2f}{rate:>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+__all__ = [
+    "Span",
+    "disable",
+    "enable",
+    "event_hooks",
+    "format_summary",
+    "is_enabled",
+    "is_tracing",
+    "record",
+    "reset",
+    "span",
+    "start_trace",
+    "stop_trace",
+    "summary",
+    "timed",
+    "write_trace",
+]
+
+# Variables:
+# End:
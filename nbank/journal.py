@@ -0,0 +1,192 @@
+# -*- mode: python -*-
+"""durable journals of deposit operations
+
+A journal is an append-only file of JSON records, one per line. Each record
+describes the state of one item, identified by a key field (`id` by default),
+and later records for an item supersede earlier ones, so the current state of
+every item can be recovered by reading the file from the start (`load`).
+Records are flushed and synced to disk before `append` returns, and the file is
+locked while it is being written, so several threads or processes can append to
+the same journal. If a process dies in the middle of writing a record, the
+incomplete line is ignored.
+
+Journals grow without bound unless they are compacted, which rewrites the file
+with only the latest record of the items that are still of interest.
+
+Copyright (C) 2025 Dan Meliza <dan@meliza.org>
+"""
+
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Callable, Dict, Iterator, Optional
+
+log = logging.getLogger("nbank")  # root logger
+
+
+class Journal:
+    """An append-only journal of item states stored in a file.
+
+    The journal must be opened (or used as a context manager) before records
+    can be appended. The file and its parent directory are created if needed.
+    If `fix` is supplied, it's called with the path of the file whenever the
+    journal creates or replaces it (e.g., to set ownership and permissions).
+
+    """
+
+    def __init__(
+        self, path: Path, key: str = "id", fix: Optional[Callable[[Path], None]] = None
+    ):
+        self.path = Path(path)
+        self.key = key
+        self.fix = fix
+        self._fp: Optional[IO[bytes]] = None
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "Journal":
+        self.open()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def open(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fp = self._open_file()
+        with self._locked() as fp:
+            # terminate any record that was cut off so the next one starts on a new line
+            if fp.tell() > 0:
+                with open(self.path, "rb") as rfp:
+                    rfp.seek(-1, os.SEEK_END)
+                    if rfp.read(1) != b"\n":
+                        fp.write(b"\n")
+                        fp.flush()
+
+    def _open_file(self) -> IO[bytes]:
+        """Opens the journal file for appending, creating it (and calling fix) if needed"""
+        flags = os.O_WRONLY | os.O_APPEND
+        try:
+            fd = os.open(self.path, flags | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            fd = os.open(self.path, flags)
+        else:
+            if self.fix is not None:
+                self.fix(self.path)
+        return os.fdopen(fd, "ab")
+
+    def close(self) -> None:
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    @contextmanager
+    def _locked(self) -> Iterator[IO[bytes]]:
+        """Acquires an exclusive lock on the journal file, yielding the open file.
+
+        If another process replaced the file (by compacting it) while we were
+        waiting for the lock, the new file is opened and locked instead.
+
+        """
+        import fcntl
+
+        if self._fp is None:
+            raise ValueError(f"journal {self.path} is not open")
+        with self._lock:
+            while True:
+                fcntl.flock(self._fp, fcntl.LOCK_EX)
+                try:
+                    current = os.stat(self.path).st_ino
+                except FileNotFoundError:
+                    current = None
+                if current == os.fstat(self._fp.fileno()).st_ino:
+                    break
+                fcntl.flock(self._fp, fcntl.LOCK_UN)
+                self._fp.close()
+                self._fp = self._open_file()
+            try:
+                yield self._fp
+            finally:
+                fcntl.flock(self._fp, fcntl.LOCK_UN)
+
+    def append(self, record: Dict) -> None:
+        """Adds record to the journal. Returns after the record is on disk."""
+        data = json.dumps(record, default=str).encode("utf-8") + b"\n"
+        with self._locked() as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def records(self) -> Iterator[Dict]:
+        """Yields all the records in the journal, skipping any incomplete lines"""
+        try:
+            fp = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with fp:
+            yield from self._read(fp)
+
+    def _read(self, fp: IO[bytes]) -> Iterator[Dict]:
+        for lineno, line in enumerate(fp, start=1):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                log.debug("%s:%d: skipping incomplete record", self.path, lineno)
+                continue
+            if isinstance(record, dict) and self.key in record:
+                yield record
+
+    def latest(self) -> Iterator[Dict]:
+        """Yields the latest record for each item, in the order of those records.
+
+        Unlike `load`, this only keeps the position of each item's latest record
+        in memory, not the records themselves, so it can be used on very large
+        journals. The file is read twice. Records that are appended after the
+        first pass are not yielded.
+
+        """
+        try:
+            fp = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with fp:
+            positions = {record[self.key]: i for i, record in enumerate(self._read(fp))}
+            fp.seek(0)
+            for i, record in enumerate(self._read(fp)):
+                if positions.get(record[self.key]) == i:
+                    yield record
+
+    def load(self) -> Dict[str, Dict]:
+        """Returns the latest record for each item, in the order items were added"""
+        state = {}
+        for record in self.records():
+            state[record[self.key]] = record
+        return state
+
+    def compact(self, keep: Callable[[Dict], bool]) -> int:
+        """Rewrites the journal with the latest record of each item where keep is True.
+
+        The file is replaced atomically, and removed if there are no items to
+        keep. Returns the number of items that were kept.
+
+        """
+        with self._locked():
+            records = [record for record in self.load().values() if keep(record)]
+            if not records:
+                self.path.unlink()
+                return 0
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp, "wb") as fp:
+                for record in records:
+                    fp.write(json.dumps(record, default=str).encode("utf-8") + b"\n")
+                fp.flush()
+                os.fsync(fp.fileno())
+            if self.fix is not None:
+                self.fix(tmp)
+            os.replace(tmp, self.path)
+            return len(records)
+
+
+__all__ = ["Journal"]
@@ -17,6 +17,10 @@ from typing import Any, Dict, Optional, Sequence, Tuple, Union
 _env_registry = "NBANK_REGISTRY"
 _neurobank_scheme = "neurobank"
 _local_schemes = (_neurobank_scheme,)
+# registry URLs with this scheme are handled by nbank.registry_server
+_sqlite_scheme = "sqlite"
+# maximum number of names to send in a single bulk request
+_bulk_query_size = 1000
 log = logging.getLogger("nbank")
 
 
@@ -48,7 +52,7 @@ def parse_resource_url(url: str) -> Tuple[str, str]:
 
 def full_url(base_url: str, id: str) -> str:
     """Returns the full URL of the resource"""
-    return f"{base_url.rstrip('/')}/resources/{id}/"
+    return url_join(base_url, "resources", f"{id}/")
 
 
 def get_info(base_url: str) -> Tuple[str, None]:
@@ -161,6 +165,19 @@ def update_resource_metadata(base_url: str, id: str, **metadata) -> Tuple[str, D
     return (full_url(base_url, id), {"metadata": metadata})
 
 
+def update_resource_metadata_bulk(
+    base_url: str, records: Sequence[Tuple[str, Dict]]
+) -> Tuple[str, Dict]:
+    """Constructs URL to update metadata for multiple resources (use patch).
+
+    records is a sequence of (id, metadata) pairs. Set a key to None to delete.
+    """
+    return (
+        url_join(base_url, "bulk", "resources/"),
+        {"resources": [{"name": id, "metadata": metadata} for id, metadata in records]},
+    )
+
+
 def url_join(base: str, *path: str) -> str:
     """Construct a URL by joining parts to a base"""
     import posixpath as pp
@@ -169,6 +186,9 @@ def url_join(base: str, *path: str) -> str:
     if any(p.startswith("/") for p in path):
         raise ValueError("components of the path must not start with a slash")
     parts = urlparse(base)
+    if parts.scheme == _sqlite_scheme and not parts.netloc:
+        # sqlite:///path/to/db: httpx needs a host to keep the scheme
+        parts = parts._replace(netloc="localhost")
     return urlunparse(parts._replace(path=pp.join(parts.path, *path)))
 
 
@@ -217,4 +237,5 @@ __all__ = [
     "log_error",
     "parse_resource_url",
     "update_resource_metadata",
+    "update_resource_metadata_bulk",
 ]
@@ -0,0 +1,667 @@
+# -*- mode: python -*-
+"""a minimal neurobank registry backed by SQLite
+
+This module implements the registry endpoints that `nbank.registry` constructs
+URLs for, including the bulk endpoints that stream line-delimited JSON, as a
+WSGI application that stores records in a SQLite database. It can be used in
+two ways:
+
+- in-process, by using a registry URL of the form `sqlite:///path/to/registry.db`.
+  Sessions opened by `nbank.core` route requests for these URLs through
+  `Transport`, so no server needs to be running. The database file name must
+  end in `.db`, `.sqlite`, or `.sqlite3`, and the database is created on first
+  use.
+- as a small HTTP server, with `nbank registry-server path/to/registry.db`.
+  Other hosts (or processes) can then use `http://host:port/` as the registry
+  URL.
+
+This is intended for computers that can't reach the central registry and for
+testing. There is no authentication or access control. The name of the user in
+the Authorization header (if any) is recorded as the creator of each resource.
+
+Copyright (C) 2025 Dan Meliza <dan@meliza.org>
+"""
+
+import json
+import logging
+import re
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import httpx
+
+log = logging.getLogger("nbank")  # root logger
+
+api_version = "1.0"
+page_size = 100
+# suffixes that mark the end of the database path in a sqlite:// URL
+db_suffixes = (".db", ".sqlite", ".sqlite3")
+_name_re = re.compile(r"^[-_~0-9a-zA-Z]+$")
+
+_schema = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS datatypes (
+    name TEXT PRIMARY KEY,
+    content_type TEXT
+);
+CREATE TABLE IF NOT EXISTS archives (
+    name TEXT PRIMARY KEY,
+    scheme TEXT NOT NULL,
+    root TEXT NOT NULL,
+    UNIQUE (scheme, root)
+);
+CREATE TABLE IF NOT EXISTS resources (
+    name TEXT PRIMARY KEY,
+    dtype TEXT REFERENCES datatypes (name),
+    sha1 TEXT,
+    created_by TEXT,
+    created_on TEXT,
+    metadata TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS resources_sha1 ON resources (sha1);
+CREATE INDEX IF NOT EXISTS resources_dtype ON resources (dtype);
+CREATE TABLE IF NOT EXISTS locations (
+    resource TEXT NOT NULL REFERENCES resources (name) ON DELETE CASCADE,
+    archive TEXT NOT NULL REFERENCES archives (name),
+    PRIMARY KEY (resource, archive)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS locations_archive ON locations (archive);
+"""
+
+_resource_columns = """
+    r.name, r.dtype, r.sha1, r.created_by, r.created_on, r.metadata,
+    (SELECT json_group_array(archive) FROM locations WHERE resource = r.name)
+"""
+# local locations first, because clients try them in order
+_location_query = """
+    SELECT l.archive, a.scheme, a.root FROM locations l
+    JOIN archives a ON a.name = l.archive
+    WHERE l.resource = ? ORDER BY a.scheme != 'neurobank', l.archive
+"""
+
+
+class HTTPError(Exception):
+    """Raised by request handlers to send an error response"""
+
+    def __init__(self, status: int, body: Dict):
+        super().__init__(status, body)
+        self.status = status
+        self.body = body
+
+
+def not_found() -> HTTPError:
+    return HTTPError(404, {"detail": "Not found."})
+
+
+def invalid(field: str, message: str) -> HTTPError:
+    return HTTPError(400, {field: [message]})
+
+
+class Database:
+    """A registry database. Each thread gets its own connection."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._local = threading.local()
+
+    def connect(self):
+        import sqlite3
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA foreign_keys = ON")
+            conn.executescript(_schema)
+            self._local.conn = conn
+        return conn
+
+    # records
+
+    def resource(self, row: Tuple) -> Dict:
+        name, dtype, sha1, created_by, created_on, metadata, locations = row
+        return {
+            "name": name,
+            "dtype": dtype,
+            "sha1": sha1,
+            "created_by": created_by,
+            "created_on": created_on,
+            "locations": json.loads(locations),
+            "metadata": json.loads(metadata),
+        }
+
+    def get_resource(self, name: str) -> Dict:
+        row = (
+            self.connect()
+            .execute(
+                f"SELECT {_resource_columns} FROM resources r WHERE name = ?", (name,)
+            )
+            .fetchone()
+        )
+        if row is None:
+            raise not_found()
+        return self.resource(row)
+
+    def get_resources(self, names: Iterable[str]) -> Iterator[Dict]:
+        cursor = self.connect().execute(
+            f"SELECT {_resource_columns} FROM resources r "
+            "WHERE name IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(names)),),
+        )
+        return map(self.resource, cursor)
+
+    def find_resources(self, params: Dict[str, str], after: str, limit: int) -> List:
+        where = ["r.name > ?"]
+        args: List[Any] = [after]
+        for key, value in params.items():
+            if key == "name":
+                where.append("instr(r.name, ?) > 0")
+            elif key in ("dtype", "sha1"):
+                where.append(f"r.{key} = ?")
+            elif key == "location":
+                where.append(
+                    "EXISTS (SELECT 1 FROM locations l "
+                    "WHERE l.resource = r.name AND l.archive = ?)"
+                )
+            elif key.startswith("metadata__"):
+                field = key[len("metadata__") :]
+                if field.endswith("__neq"):
+                    where.append(
+                        "coalesce(CAST(json_extract(r.metadata, ?) AS TEXT), '') != ?"
+                    )
+                    field = field[: -len("__neq")]
+                else:
+                    where.append("CAST(json_extract(r.metadata, ?) AS TEXT) = ?")
+                args.append(f'$."{field}"')
+            else:
+                continue
+            args.append(value)
+        cursor = self.connect().execute(
+            f"SELECT {_resource_columns} FROM resources r "
+            f"WHERE {' AND '.join(where)} ORDER BY r.name LIMIT ?",
+            (*args, limit),
+        )
+        return [self.resource(row) for row in cursor]
+
+    def add_resource(self, data: Dict, user: Optional[str]) -> Dict:
+        import datetime
+        import sqlite3
+        import uuid
+
+        name = data.get("name") or str(uuid.uuid4())
+        if not _name_re.match(name):
+            raise invalid("name", "Enter a valid name.")
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO resources VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        name,
+                        data.get("dtype"),
+                        data.get("sha1"),
+                        user,
+                        datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                        json.dumps(data.get("metadata") or {}),
+                    ),
+                )
+                for archive in data.get("locations", []):
+                    self.add_location(name, archive)
+        except sqlite3.IntegrityError as err:
+            if "UNIQUE" in str(err):
+                raise invalid(
+                    "name", "resource with this name already exists."
+                ) from err
+            raise invalid(
+                "dtype", f"Object with name={data.get('dtype')} does not exist."
+            ) from err
+        return self.get_resource(name)
+
+    def update_resource(self, name: str, data: Dict) -> Optional[Dict]:
+        """Updates the resource. Returns None if it doesn't exist"""
+        conn = self.connect()
+        row = conn.execute(
+            "SELECT metadata FROM resources WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return None
+        metadata = json.loads(row[0])
+        for key, value in data.get("metadata", {}).items():
+            if value is None:
+                metadata.pop(key, None)
+            else:
+                metadata[key] = value
+        conn.execute(
+            "UPDATE resources SET metadata = ? WHERE name = ?",
+            (json.dumps(metadata), name),
+        )
+        for field in ("dtype", "sha1"):
+            if field in data:
+                conn.execute(
+                    f"UPDATE resources SET {field} = ? WHERE name = ?",
+                    (data[field], name),
+                )
+        return self.get_resource(name)
+
+    def delete_resource(self, name: str) -> None:
+        conn = self.connect()
+        with conn:
+            if (
+                conn.execute("DELETE FROM resources WHERE name = ?", (name,)).rowcount
+                == 0
+            ):
+                raise not_found()
+
+    def get_locations(self, name: str) -> List[Dict]:
+        return [
+            {
+                "archive_name": archive,
+                "scheme": scheme,
+                "root": root,
+                "resource_name": name,
+            }
+            for archive, scheme, root in self.connect().execute(
+                _location_query, (name,)
+            )
+        ]
+
+    def add_location(self, name: str, archive: str) -> Dict:
+        conn = self.connect()
+        row = conn.execute(
+            "SELECT scheme, root FROM archives WHERE name = ?", (archive,)
+        ).fetchone()
+        if row is None:
+            raise invalid("archive_name", f"Object with name={archive} does not exist.")
+        conn.execute("INSERT OR IGNORE INTO locations VALUES (?, ?)", (name, archive))
+        return {
+            "archive_name": archive,
+            "scheme": row[0],
+            "root": row[1],
+            "resource_name": name,
+        }
+
+    def delete_location(self, name: str, archive: str) -> None:
+        conn = self.connect()
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM locations WHERE resource = ? AND archive = ?",
+                (name, archive),
+            )
+            if cursor.rowcount == 0:
+                raise not_found()
+
+
+def _archive(row: Tuple) -> Dict:
+    return {"name": row[0], "scheme": row[1], "root": row[2]}
+
+
+class RegistryApp:
+    """WSGI application implementing the registry API.
+
+    prefix is stripped from the path of each request before routing.
+
+    """
+
+    def __init__(self, path: Path, prefix: str = "/"):
+        self.db = Database(path)
+        self.prefix = prefix.rstrip("/") + "/"
+
+    def __call__(self, environ: Dict, start_response: Callable) -> Iterable[bytes]:
+        method = environ["REQUEST_METHOD"]
+        path = environ.get("PATH_INFO", "")
+        if path.startswith(self.prefix):
+            path = path[len(self.prefix) :]
+        parts = [part for part in path.split("/") if part]
+        handler = getattr(self, f"{method.lower()}_{'_'.join(_route(parts))}", None)
+        try:
+            if handler is None:
+                if not any(
+                    hasattr(self, f"{m}_{'_'.join(_route(parts))}")
+                    for m in ("get", "post", "patch", "delete")
+                ):
+                    raise not_found()
+                raise HTTPError(405, {"detail": f'Method "{method}" not allowed.'})
+            request = Request(environ, parts)
+            status, body = handler(request)
+        except HTTPError as err:
+            status, body = err.status, err.body
+        except KeyError as err:
+            status, body = 400, {err.args[0]: ["This field is required."]}
+        except ValueError:
+            status, body = 400, {"detail": "JSON parse error"}
+        if status == 204:
+            start_response("204 No Content", [])
+            return []
+        if isinstance(body, Iterator):
+            start_response("200 OK", [("Content-Type", "application/x-ndjson")])
+            return (json.dumps(record).encode("utf-8") + b"\n" for record in body)
+        headers = [("Content-Type", "application/json")]
+        if isinstance(body, Page):
+            if body.next is not None:
+                headers.append(("Link", f'<{body.next}>; rel="next"'))
+            body = body.records
+        data = json.dumps(body).encode("utf-8")
+        headers.append(("Content-Length", str(len(data))))
+        start_response(f"{status} {_reasons.get(status, '')}", headers)
+        return [data]
+
+    # handlers return (status, body). Paths are matched by _route.
+
+    def get_info(self, request):
+        from nbank import __version__
+
+        return 200, {
+            "name": "neurobank-sqlite",
+            "version": __version__,
+            "api_version": api_version,
+        }
+
+    def get_datatypes(self, request):
+        rows = self.db.connect().execute(
+            "SELECT name, content_type FROM datatypes ORDER BY name"
+        )
+        return 200, [{"name": name, "content_type": ct} for name, ct in rows]
+
+    def post_datatypes(self, request):
+        import sqlite3
+
+        data = request.json()
+        conn = self.db.connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO datatypes VALUES (?, ?)",
+                    (data["name"], data.get("content_type")),
+                )
+        except sqlite3.IntegrityError as err:
+            raise invalid("name", "datatype with this name already exists.") from err
+        return 201, {"name": data["name"], "content_type": data.get("content_type")}
+
+    def get_archives(self, request):
+        where, args = [], []
+        for key in ("name", "scheme", "root"):
+            if key in request.params:
+                where.append(f"{key} = ?")
+                args.append(request.params[key])
+        query = "SELECT name, scheme, root FROM archives"
+        if where:
+            query += f" WHERE {' AND '.join(where)}"
+        rows = self.db.connect().execute(f"{query} ORDER BY name", args)
+        return 200, [_archive(row) for row in rows]
+
+    def post_archives(self, request):
+        import sqlite3
+
+        data = request.json()
+        archive = {k: data.get(k) for k in ("name", "scheme", "root")}
+        if not all(archive.values()):
+            raise invalid("name", "name, scheme, and root are required.")
+        conn = self.db.connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO archives VALUES (?, ?, ?)", tuple(archive.values())
+                )
+        except sqlite3.IntegrityError as err:
+            raise invalid(
+                "name", "archive with this name or root already exists."
+            ) from err
+        return 201, archive
+
+    def get_archive(self, request):
+        row = (
+            self.db.connect()
+            .execute(
+                "SELECT name, scheme, root FROM archives WHERE name = ?",
+                (request.parts[1],),
+            )
+            .fetchone()
+        )
+        if row is None:
+            raise not_found()
+        return 200, _archive(row)
+
+    def get_resources(self, request):
+        params = dict(request.params)
+        after = params.pop("after", "")
+        records = self.db.find_resources(params, after, page_size + 1)
+        next_url = None
+        if len(records) > page_size:
+            records = records[:page_size]
+            next_url = request.url_with(after=records[-1]["name"])
+        return 200, Page(records, next_url)
+
+    def post_resources(self, request):
+        return 201, self.db.add_resource(request.json(), request.user)
+
+    def get_resource(self, request):
+        return 200, self.db.get_resource(request.parts[1])
+
+    def patch_resource(self, request):
+        import sqlite3
+
+        data = request.json()
+        conn = self.db.connect()
+        try:
+            with conn:
+                record = self.db.update_resource(request.parts[1], data)
+        except sqlite3.IntegrityError as err:
+            raise invalid(
+                "dtype", f"Object with name={data.get('dtype')} does not exist."
+            ) from err
+        if record is None:
+            raise not_found()
+        return 200, record
+
+    def delete_resource(self, request):
+        self.db.delete_resource(request.parts[1])
+        return 204, None
+
+    def get_locations(self, request):
+        name = request.parts[1]
+        self.db.get_resource(name)
+        return 200, self.db.get_locations(name)
+
+    def post_locations(self, request):
+        name = request.parts[1]
+        self.db.get_resource(name)
+        conn = self.db.connect()
+        with conn:
+            location = self.db.add_location(name, request.json().get("archive_name"))
+        return 201, location
+
+    def get_location(self, request):
+        _, name, _, archive = request.parts
+        for location in self.db.get_locations(name):
+            if location["archive_name"] == archive:
+                return 200, location
+        raise not_found()
+
+    def delete_location(self, request):
+        _, name, _, archive = request.parts
+        self.db.delete_location(name, archive)
+        return 204, None
+
+    def post_bulk_resources(self, request):
+        return 200, self.db.get_resources(request.json().get("names", []))
+
+    def patch_bulk_resources(self, request):
+        conn = self.db.connect()
+        with conn:
+            results = [
+                self.db.update_resource(record["name"], record)
+                for record in request.json().get("resources", [])
+            ]
+        return 200, iter([record for record in results if record is not None])
+
+    def post_bulk_locations(self, request):
+        db = self.db
+        return 200, (
+            {"name": name, "locations": db.get_locations(name)}
+            for name in (
+                record["name"]
+                for record in db.get_resources(request.json().get("names", []))
+            )
+        )
+
+
+_reasons = {
+    200: "OK",
+    201: "Created",
+    204: "No Content",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+}
+
+
+def _route(parts: List[str]) -> List[str]:
+    """Maps the components of a request path to the name of a handler"""
+    if len(parts) == 2 and parts[0] == "archives":
+        return ["archive"]
+    if len(parts) == 2 and parts[0] == "resources":
+        return ["resource"]
+    if len(parts) == 3 and parts[0] == "resources" and parts[2] == "locations":
+        return ["locations"]
+    if len(parts) == 4 and parts[0] == "resources" and parts[2] == "locations":
+        return ["location"]
+    return parts
+
+
+class Page:
+    """A page of records, with the URL of the next page if there is one"""
+
+    def __init__(self, records: List[Dict], next: Optional[str]):
+        self.records = records
+        self.next = next
+
+
+class Request:
+    """The parts of a WSGI request that the handlers need"""
+
+    def __init__(self, environ: Dict, parts: List[str]):
+        from urllib.parse import parse_qsl
+
+        self.environ = environ
+        self.parts = parts
+        self.params = dict(parse_qsl(environ.get("QUERY_STRING", "")))
+
+    def json(self) -> Dict:
+        stream = self.environ["wsgi.input"]
+        length = int(self.environ.get("CONTENT_LENGTH") or 0)
+        return json.loads(stream.read(length)) if length else {}
+
+    @property
+    def user(self) -> Optional[str]:
+        import base64
+
+        auth = self.environ.get("HTTP_AUTHORIZATION", "")
+        if not auth.startswith("Basic "):
+            return None
+        try:
+            return base64.b64decode(auth[6:]).decode("utf-8").split(":")[0]
+        except ValueError:
+            return None
+
+    def url_with(self, **params) -> str:
+        """Returns the URL of the request with updated query parameters"""
+        from urllib.parse import urlencode
+
+        environ = self.environ
+        host = environ.get("HTTP_HOST") or environ.get("SERVER_NAME", "localhost")
+        path = environ.get("SCRIPT_NAME", "") + environ.get("PATH_INFO", "")
+        query = urlencode({**self.params, **params})
+        return f"{environ['wsgi.url_scheme']}://{host}{path}?{query}"
+
+
+def split_url_path(path: str) -> Tuple[str, str]:
+    """Splits the path of a sqlite:// URL into the database path and the API path"""
+    parts = path.split("/")
+    for i, part in enumerate(parts):
+        if part.endswith(db_suffixes):
+            return "/".join(parts[: i + 1]), "/" + "/".join(parts[i + 1 :])
+    raise ValueError(f"no database file (ending in {', '.join(db_suffixes)}) in {path}")
+
+
+class Transport(httpx.BaseTransport):
+    """Sends requests for sqlite:// URLs to an in-process RegistryApp"""
+
+    def __init__(self):
+        self._apps: Dict[str, RegistryApp] = {}
+        self._lock = threading.Lock()
+
+    def app(self, db_path: str) -> RegistryApp:
+        with self._lock:
+            app = self._apps.get(db_path)
+            if app is None:
+                log.debug("opening registry database %s", db_path)
+                app = self._apps[db_path] = RegistryApp(Path(db_path), prefix="/")
+            return app
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        import io
+
+        try:
+            db_path, path = split_url_path(request.url.path)
+        except ValueError as err:
+            raise httpx.ConnectError(str(err), request=request) from err
+        body = request.read()
+        environ = {
+            "wsgi.url_scheme": request.url.scheme,
+            "wsgi.input": io.BytesIO(body),
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": db_path,
+            "PATH_INFO": path,
+            "QUERY_STRING": request.url.query.decode("ascii"),
+            "SERVER_NAME": request.url.host,
+            "CONTENT_LENGTH": str(len(body)),
+        }
+        for key, value in request.headers.items():
+            key = key.upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[f"HTTP_{key}"] = value
+        status_headers = []
+
+        def start_response(status, headers, exc_info=None):
+            status_headers[:] = [int(status.split()[0]), headers]
+
+        content = b"".join(self.app(db_path)(environ, start_response))
+        status, headers = status_headers
+        return httpx.Response(status, headers=headers, content=content, request=request)
+
+
+_transport: Optional[Transport] = None
+
+
+def transport() -> Transport:
+    """Returns the transport for sqlite:// URLs, which is shared by all clients"""
+    global _transport
+    if _transport is None:
+        _transport = Transport()
+    return _transport
+
+
+def serve(path: Path, host: str = "127.0.0.1", port: int = 8000) -> None:
+    """Serves the registry in path over HTTP until interrupted"""
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+    class Server(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    class Handler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            log.debug("%s - %s", self.address_string(), format % args)
+
+    httpd = make_server(
+        host, port, RegistryApp(path), server_class=Server, handler_class=Handler
+    )
+    log.info("serving registry %s on http://%s:%d/", path, host, httpd.server_port)
+    with httpd:
+        httpd.serve_forever()
+
+
+__all__ = ["Database", "RegistryApp", "Transport", "serve", "transport"]
+
+# Variables:
+# End:
@@ -6,20 +6,16 @@ Created Tue Nov 26 22:48:58 2013
 """
 
 import argparse
-import concurrent.futures
-import datetime
+import contextlib
+import itertools
 import json
 import logging
 import os
-import shutil
 import sys
-import tarfile
+import time
 from pathlib import Path
-from urllib.parse import urlunparse
 
-import httpx
-
-from nbank import __version__, archive, core, registry, util
+from nbank import archive, core, registry, util
 
 log = logging.getLogger("nbank")  # root logger
 
@@ -31,6 +27,12 @@ def setup_log(log, debug=False):
     log.setLevel(loglevel)
     ch.setLevel(loglevel)
     ch.setFormatter(formatter)
+    # replace the handler from any previous call, which may be writing to a
+    # different stream (main can be called many times in the daemon)
+    for handler in log.handlers[:]:
+        if getattr(handler, "_nbank_script", False):
+            log.removeHandler(handler)
+    ch._nbank_script = True
     log.addHandler(ch)
 
 
@@ -40,6 +42,53 @@ def userpwd(arg):
     return tuple(ret) if len(ret) == 2 else None
 
 
+def iter_ids(fp):
+    """Yields resource ids from a file with one per line, skipping blanks and comments"""
+    for line in fp:
+        resource_id = line.strip()
+        if len(resource_id) > 0 and not resource_id.startswith("#"):
+            yield resource_id
+
+
+def iter_paths(fp, sep=b"\n"):
+    """Yields paths from a binary stream as they are read.
+
+    Names are separated by sep. With the default (newline), surrounding
+    whitespace is stripped; with other separators (like NUL) names are used
+    exactly as given. Blank names are skipped.
+
+    """
+    buf = b""
+    while True:
+        chunk = fp.read1(65536)
+        if not chunk:
+            break
+        *names, buf = (buf + chunk).split(sep)
+        for name in names:
+            if sep == b"\n":
+                name = name.strip()
+            if name:
+                yield Path(os.fsdecode(name))
+    if sep == b"\n":
+        buf = buf.strip()
+    if buf:
+        yield Path(os.fsdecode(buf))
+
+
+def error_detail(r) -> str:
+    """Returns the detail of an error response from the registry, or its text if it has none"""
+    try:
+        return r.json()["detail"]
+    except (ValueError, KeyError, TypeError):
+        return r.text
+
+
+def rate(n, start):
+    """Returns the number of items processed per second since start (from time.monotonic)"""
+    elapsed = time.monotonic() - start
+    return n / elapsed if elapsed > 0 else 0.0
+
+
 def octalint(arg):
     """Parse arg as an octal literal"""
     return int(arg, base=8)
@@ -66,10 +115,36 @@ class ParseKeyVal(argparse.Action):
         setattr(namespace, self.dest, kv)
 
 
+class ShowVersion(argparse.Action):
+    """Prints the version and exits. Looking up the version of the installed package
+    is relatively slow, so this is deferred until the option is actually used."""
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, help=None):
+        super().__init__(
+            option_strings, dest, default=argparse.SUPPRESS, nargs=0, help=help
+        )
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from nbank import __version__
+
+        parser.exit(message=f"{parser.prog} {__version__}\n")
+
+
 def main(argv=None):
+    if argv is None:
+        # use the daemon if it's running
+        from nbank import daemon
+
+        status = daemon.forward(sys.argv[1:])
+        if status is not None:
+            return status
+
     p = argparse.ArgumentParser(description="manage source files and collected data")
     p.add_argument(
-        "-v", "--version", action="version", version="%(prog)s " + __version__
+        "-v",
+        "--version",
+        action=ShowVersion,
+        help="show program's version number and exit",
     )
     p.add_argument(
         "-r",
@@ -84,9 +159,27 @@ def main(argv=None):
         help="username:password to authenticate with registry. "
         "If not supplied, will attempt to use .netrc file",
         type=userpwd,
-        default=httpx.NetRCAuth(None),
     )
     p.add_argument("--debug", help="show verbose log messages", action="store_true")
+    p.add_argument(
+        "--stats",
+        action="store_true",
+        help="collect timing statistics for registry requests and file operations "
+        "and print a summary at exit",
+    )
+    p.add_argument(
+        "--stats-json",
+        type=Path,
+        metavar="FILE",
+        help="collect timing statistics and write them to FILE as JSON at exit",
+    )
+    p.add_argument(
+        "--trace",
+        type=Path,
+        metavar="FILE",
+        help="record spans for registry requests and file operations and write "
+        "them to FILE in Chrome trace format at exit",
+    )
 
     sub = p.add_subparsers(title="subcommands")
 
@@ -153,10 +246,71 @@ def main(argv=None):
         "-@",
         dest="read_stdin",
         action="store_true",
-        help="read additional file names from stdin",
+        help="read additional file names from stdin (one per line, or see -0). "
+        "Files are deposited as the names are read. If all the names come from "
+        "stdin, use '-' as the file name.",
+    )
+    pp.add_argument(
+        "-0",
+        "--null",
+        action="store_true",
+        help="with -@, file names are separated by null characters (e.g. from find -print0)",
+    )
+    pp.add_argument(
+        "--jobs",
+        type=int,
+        help="number of worker processes for depositing files (default 1)",
+    )
+    pp.add_argument(
+        "--dedupe",
+        choices=("skip", "link"),
+        help="hash the files first and don't deposit files with the same contents "
+        "as a resource in the registry: leave them in place (skip) or replace them "
+        "with links to the existing resources (link)",
+    )
+    group = pp.add_mutually_exclusive_group()
+    group.add_argument(
+        "-Q",
+        "--queue",
+        action="store_true",
+        help="hash and stage the files in the archive without contacting the registry. "
+        "Use 'nbank flush' to register and deposit them later.",
+    )
+    group.add_argument(
+        "--plan",
+        action="store_true",
+        help="check whether the files can be deposited and report how much data "
+        "will be hashed and moved, without changing anything",
+    )
+    group.add_argument(
+        "--resume",
+        action="store_true",
+        help="resume an interrupted deposit of the same files, skipping files that "
+        "were deposited and reusing hashes",
+    )
+    pp.add_argument(
+        "file",
+        nargs="+",
+        type=Path,
+        help="path of file(s) to add to the repository ('-' to read names from stdin)",
+    )
+
+    pp = sub.add_parser(
+        "flush", help="register and deposit resources queued with 'deposit --queue'"
+    )
+    pp.set_defaults(func=flush_resources)
+    pp.add_argument("directory", type=Path, help="path of the archive")
+    pp.add_argument(
+        "-j",
+        "--json-out",
+        action="store_true",
+        help="output each deposited file to stdout as line-deliminated JSON",
     )
     pp.add_argument(
-        "file", nargs="+", type=Path, help="path of file(s) to add to the repository"
+        "--jobs",
+        type=int,
+        default=4,
+        help="number of concurrent registry requests (default %(default)s)",
     )
 
     pp = sub.add_parser("locate", help="locate local resource(s)")
@@ -214,6 +368,18 @@ def main(argv=None):
         help="compute sha1 hash and check that it matches a record in the database",
     )
     pp.set_defaults(func=verify_file_hash)
+    pp.add_argument(
+        "-j",
+        "--json-out",
+        action="store_true",
+        help="output the result for each file to stdout as line-delimited JSON",
+    )
+    pp.add_argument(
+        "--jobs",
+        type=int,
+        default=4,
+        help="number of files to hash concurrently (default %(default)s)",
+    )
     pp.add_argument(
         "files", nargs="+", type=Path, help="the files or directories to verify"
     )
@@ -239,7 +405,22 @@ def main(argv=None):
         metavar="KEY",
         dest="metadata_remove",
     )
-    pp.add_argument("id", nargs="+", help="identifier(s) of the resource(s)")
+    pp.add_argument(
+        "-f",
+        "--records",
+        type=Path,
+        help="read line-delimited JSON records with 'name' and 'metadata' fields "
+        "from FILE ('-' for stdin). Values set with -k and -K apply to all records",
+        metavar="FILE",
+    )
+    pp.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=8,
+        help="maximum number of concurrent requests (default %(default)s)",
+    )
+    pp.add_argument("id", nargs="*", help="identifier(s) of the resource(s)")
 
     pp = sub.add_parser(
         "fetch",
@@ -256,6 +437,12 @@ def main(argv=None):
     pp.add_argument(
         "-e", "--extension", help="add an extension to downloaded file names"
     )
+    pp.add_argument(
+        "--alt-base",
+        type=Path,
+        help="location of local copies of archives. For tape archives, this can "
+        "be a tar file or a directory with tar files named TAPE-INDEX.tar",
+    )
     pp.add_argument(
         "ids",
         nargs="+",
@@ -291,6 +478,40 @@ def main(argv=None):
     )
     pp.add_argument("path", type=Path, help="path of the archive to check")
 
+    pp = ppsub.add_parser(
+        "fix-perms",
+        help="set ownership and access mode of resources according to archive policy",
+    )
+    pp.set_defaults(func=fix_archive_permissions)
+    pp.add_argument(
+        "-y",
+        "--dry-run",
+        help="count the files that need to be fixed without changing them",
+        action="store_true",
+    )
+    pp.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="number of subdirectories to fix concurrently (default %(default)s)",
+    )
+    pp.add_argument("path", type=Path, help="path of the archive to fix")
+
+    pp = ppsub.add_parser(
+        "dupes", help="find resources in an archive with the same contents"
+    )
+    pp.set_defaults(func=find_archive_duplicates)
+    pp.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="number of resources without registered hashes to hash concurrently "
+        "(default %(default)s)",
+    )
+    pp.add_argument("path", type=Path, help="path of the archive to check")
+
     pp = ppsub.add_parser(
         "register-tar",
         help="register a tar file as an archive in the registry",
@@ -303,6 +524,12 @@ def main(argv=None):
         action="store_true",
     )
     pp.add_argument("--archive-name", "-n", help="name of the archive")
+    pp.add_argument(
+        "--index",
+        type=Path,
+        help="where to write the member offset index "
+        "(default is next to the tar file, if it is a regular file)",
+    )
     pp.add_argument(
         "tape_name", type=str, help="name of the tape where the tar file was written"
     )
@@ -313,6 +540,36 @@ def main(argv=None):
     )
     pp.add_argument("tar", type=Path, help="tar file with the resources to transfer")
 
+    pp = ppsub.add_parser(
+        "export-tar",
+        help="write resources from a neurobank archive to a tar file",
+    )
+    pp.set_defaults(func=export_tar)
+    pp.add_argument(
+        "--index",
+        type=Path,
+        help="where to write the member offset index (default is next to the tar file)",
+    )
+    pp.add_argument(
+        "--register",
+        nargs=2,
+        metavar=("TAPE_NAME", "FILE_NUMBER"),
+        help="after writing the tar file, register it in the registry as a tape archive",
+    )
+    pp.add_argument(
+        "--archive-name", "-n", help="name of the tape archive (with --register)"
+    )
+    pp.add_argument(
+        "-f",
+        "--file",
+        dest="resources",
+        type=Path,
+        help="file with list of resources to export (default is the whole archive)",
+    )
+    pp.add_argument("path", type=Path, help="path of the neurobank archive")
+    pp.add_argument("tar", type=Path, help="tar file (or tape device) to write")
+    pp.add_argument("id", nargs="*", help="identifier(s) of the resource(s) to export")
+
     pp = ppsub.add_parser(
         "prune",
         help="remove files from a neurobank archive that are stored somewhere else",
@@ -324,6 +581,12 @@ def main(argv=None):
         help="don't delete any files or make any changes to the registry",
         action="store_true",
     )
+    pp.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="maximum number of concurrent registry requests and deletions",
+    )
     pp.add_argument("archive_name", type=str, help="name of the archive to prune")
     pp.add_argument("resources", type=Path, help="file with list of resources to prune")
 
@@ -341,6 +604,104 @@ def main(argv=None):
     pp.add_argument("tar", type=Path, help="tar file with the resources to import")
     pp.add_argument("dest", type=Path, help="path of the destination neurobank archive")
 
+    pp = sub.add_parser("tape", help="plan access to resources stored on tape")
+    ppsub = pp.add_subparsers(title="subcommands")
+
+    pp = ppsub.add_parser(
+        "plan", help="plan the order for recalling resources from tape"
+    )
+    pp.set_defaults(func=plan_tape_recall)
+    pp.add_argument(
+        "-j",
+        "--json-out",
+        action="store_true",
+        help="output the plan as line-delimited JSON, one record per resource",
+    )
+    pp.add_argument(
+        "--index-dir",
+        type=Path,
+        help="directory with member indices for the tape files (TAPE-INDEX.tar.idx), "
+        "used to sort resources by their position on the tape",
+    )
+    pp.add_argument(
+        "-f",
+        "--file",
+        dest="resources",
+        type=Path,
+        help="file with a list of resources to recall",
+    )
+    pp.add_argument("id", nargs="*", help="identifier(s) of the resource(s) to recall")
+
+    pp = sub.add_parser(
+        "batch",
+        help="execute operations from line-delimited JSON",
+        description="Read operation records from line-delimited JSON and execute "
+        "them concurrently. Each record has an 'op' field (deposit, info, locate, "
+        "modify, search, or verify) and the arguments for the operation, e.g. "
+        '{"op": "modify", "id": "st11", "metadata": {"sex": "F"}}. '
+        "The result of each operation is written to stdout as a line of JSON, "
+        "tagged with the 'rid' field of the record (or its line number).",
+    )
+    pp.set_defaults(func=run_batch)
+    pp.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=8,
+        help="maximum number of operations to run at once (default %(default)s)",
+    )
+    pp.add_argument(
+        "input",
+        nargs="?",
+        type=Path,
+        default=Path("-"),
+        help="file with the operations (default stdin)",
+    )
+
+    pp = sub.add_parser(
+        "daemon",
+        help="run a local server that speeds up repeated nbank commands",
+        description="Run a local server that holds open a connection to the registry "
+        "and caches archive lookups. While the daemon is running, nbank commands "
+        "that query the registry or deposit files are forwarded to it. "
+        "Set NBANK_NO_DAEMON=1 to disable forwarding.",
+    )
+    pp.set_defaults(func=run_daemon)
+    pp.add_argument(
+        "--socket",
+        type=Path,
+        help="path of the socket (default from NBANK_SOCKET or XDG_RUNTIME_DIR)",
+    )
+    pp.add_argument(
+        "--stop", action="store_true", help="stop the daemon if it's running"
+    )
+    pp.add_argument(
+        "--status", action="store_true", help="check whether the daemon is running"
+    )
+
+    pp = sub.add_parser(
+        "registry-server",
+        help="serve a local SQLite registry over HTTP",
+        description="Serve a registry stored in a SQLite database, for computers "
+        "that can't reach the central registry. Processes on the same computer can "
+        "also use the database directly with a sqlite:///path/to/registry.db "
+        "registry URL.",
+    )
+    pp.set_defaults(func=run_registry_server)
+    pp.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="address to listen on (default %(default)s)",
+    )
+    pp.add_argument(
+        "--port", type=int, default=8000, help="port to listen on (default %(default)s)"
+    )
+    pp.add_argument(
+        "database",
+        type=Path,
+        help="path of the database (created if it doesn't exist)",
+    )
+
     args = p.parse_args(argv)
 
     if not hasattr(args, "func"):
@@ -348,13 +709,24 @@ def main(argv=None):
         return 0
 
     setup_log(log, args.debug)
-    log.debug("version: %s", __version__)
-    log.debug("run time: %s", datetime.datetime.now())
+    if args.debug:
+        import datetime
+
+        from nbank import __version__
+
+        log.debug("version: %s", __version__)
+        log.debug("run time: %s", datetime.datetime.now())
 
     # most commands requre a registry, so check it here once
     if args.registry_url is None and args.func not in (
         store_resources,
+        flush_resources,
         locate_resources,
+        run_batch,
+        run_daemon,
+        run_registry_server,
+        fix_archive_permissions,
+        find_archive_duplicates,
     ):
         log.error(
             "error: supply a registry url with '-r' or %s environment variable",
@@ -362,12 +734,28 @@ def main(argv=None):
         )
         return
 
+    if args.stats or args.stats_json:
+        from nbank import instrument
+
+        instrument.enable()
+    if args.trace:
+        from nbank import instrument
+
+        instrument.start_trace()
+
     # some of the error handling is common; sub-funcs should only catch specific errors
     try:
-        args.func(args)
-    except httpx.RequestError:
-        log.error("registry error: unable to contact server")
-    except httpx.HTTPStatusError as e:
+        return args.func(args)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        import httpx
+
+        if isinstance(e, httpx.RequestError):
+            log.error("registry error: unable to contact server")
+            return 1
+        if not isinstance(e, httpx.HTTPStatusError):
+            raise
         if e.response.status_code == 403:
             log.error(
                 "authentication error: Authenticate with '-a username:password' or .netrc file."
@@ -377,19 +765,99 @@ def main(argv=None):
             )
         else:
             registry.log_error(e)
+        return 1
+    finally:
+        if args.stats or args.stats_json:
+            write_stats(args)
+        if args.trace:
+            write_trace(args)
+
+
+def write_stats(args):
+    from nbank import instrument
+
+    instrument.disable()
+    if args.stats:
+        sys.stderr.write(instrument.format_summary() + "\n")
+    if args.stats_json:
+        with open(args.stats_json, "w") as fp:
+            json.dump(instrument.summary(), fp, indent=2)
+    instrument.reset()
+
+
+def write_trace(args):
+    from nbank import instrument
+
+    events = instrument.stop_trace()
+    instrument.write_trace(args.trace, events)
+    log.debug("wrote %d trace events to %s", len(events), args.trace)
+
+
+def run_batch(args):
+    from nbank import batch
+
+    n_failed = 0
+    with contextlib.ExitStack() as stack:
+        if str(args.input) == "-":
+            fp = sys.stdin
+        else:
+            fp = stack.enter_context(open(args.input))
+        for result in batch.run(
+            batch.read_records(fp),
+            args.registry_url,
+            auth=args.auth,
+            max_workers=args.jobs,
+        ):
+            if "error" in result:
+                n_failed += 1
+            json.dump(result, fp=sys.stdout)
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+    return 1 if n_failed else 0
+
+
+def run_daemon(args):
+    from nbank import daemon
+
+    if args.stop or args.status:
+        command = "stop" if args.stop else "ping"
+        response = daemon.request({"command": command}, path=args.socket)
+        if response is None:
+            log.info("daemon is not running")
+            return 1
+        if args.stop:
+            log.info("daemon stopped")
+        else:
+            log.info("daemon is running (pid %d)", response["pid"])
+        return 0
+    daemon.serve(args.socket, auth=args.auth)
+
+
+def run_registry_server(args):
+    from nbank import registry_server
+
+    try:
+        registry_server.serve(args.database, host=args.host, port=args.port)
     except KeyboardInterrupt:
-        pass
+        log.info("registry server stopped")
 
 
 def registry_info(args):
     log.info("registry info:")
     log.info("  - address: %s", args.registry_url)
     url, params = registry.get_info(args.registry_url)
-    for k, v in util.query_registry(httpx, url, params, auth=args.auth).items():
-        log.info("  - %s: %s", k, v)
+    with core.open_session(args.auth) as session:
+        for k, v in util.query_registry(session, url, params).items():
+            log.info("  - %s: %s", k, v)
 
 
 def init_archive(args):
+    import datetime
+
+    import httpx
+
+    from nbank import __version__
+
     log.debug("version: %s", __version__)
     log.debug("run time: %s", datetime.datetime.now())
     args.directory = args.directory.resolve()
@@ -403,7 +871,8 @@ def init_archive(args):
         args.directory,
     )
     try:
-        r = httpx.post(url, json=params, auth=args.auth)
+        with core.open_session(args.auth) as session:
+            r = session.post(url, json=params)
         r.raise_for_status()
     except httpx.HTTPStatusError as e:
         registry.log_error(e)
@@ -414,28 +883,119 @@ def init_archive(args):
 
 
 def store_resources(args):
-    if args.read_stdin:
-        args.file.extend(line.strip() for line in sys.stdin)
-    try:
-        for res in core.deposit(
+    stdin = Path("-")
+    files = [path for path in args.file if path != stdin]
+    if args.read_stdin or stdin in args.file:
+        # names are read as they're needed so deposits can start right away
+        sep = b"\0" if args.null else b"\n"
+        files = itertools.chain(files, iter_paths(sys.stdin.buffer, sep))
+    if args.dedupe and (args.plan or args.queue):
+        log.error("error: --dedupe cannot be used with --plan or --queue")
+        return 1
+    elif args.plan:
+        return plan_deposit(args, files)
+    elif args.queue:
+        deposited = core.queue_deposit(
+            args.directory,
+            files,
+            dtype=args.dtype,
+            auto_id=args.auto_id,
+            **args.metadata,
+        )
+    elif args.jobs and args.jobs > 1:
+        deposited = core.deposit_parallel(
             args.directory,
-            args.file,
+            files,
+            args.jobs,
             dtype=args.dtype,
             hash=args.hash,
             auto_id=args.auto_id,
             auth=args.auth,
+            resume=args.resume,
+            dedupe=args.dedupe,
             **args.metadata,
-        ):
+        )
+    else:
+        deposited = core.deposit(
+            args.directory,
+            files,
+            dtype=args.dtype,
+            hash=args.hash,
+            auto_id=args.auto_id,
+            auth=args.auth,
+            resume=args.resume,
+            dedupe=args.dedupe,
+            **args.metadata,
+        )
+    return report_deposits(args, deposited)
+
+
+def report_deposits(args, deposited):
+    """Logs errors and (with --json-out) outputs each item as it is deposited"""
+    status = 0
+    try:
+        for res in deposited:
+            if "error" in res:
+                log.error("error: %s: %s", res["source"], res["error"])
+                status = 1
             if args.json_out:
-                json.dump(res, fp=sys.stdout)
+                json.dump(res, fp=sys.stdout, default=str)
                 sys.stdout.write("\n")
+                sys.stdout.flush()
     except ValueError as e:
         log.error("error: %s", e)
+        return 1
+    return status
+
+
+def flush_resources(args):
+    deposited = core.flush_deposits(
+        args.directory, auth=args.auth, max_workers=args.jobs
+    )
+    return report_deposits(args, deposited)
+
+
+def plan_deposit(args, files):
+    try:
+        plan = core.plan_deposit(
+            args.directory,
+            files,
+            dtype=args.dtype,
+            hash=args.hash,
+            auto_id=args.auto_id,
+            auth=args.auth,
+        )
+    except ValueError as e:
+        log.error("error: %s", e)
+        return 1
+    log.info("archive: %s (%s)", plan["archive"], plan["archive_name"])
+    for item in plan["files"]:
+        if "error" in item:
+            log.error("  - %s: %s", item["source"], item["error"])
+        if args.json_out:
+            json.dump(item, fp=sys.stdout, default=str)
+            sys.stdout.write("\n")
+    for error in plan["errors"]:
+        log.error("error: %s", error)
+    log.info(
+        "files to deposit: %d (%d bytes); with errors: %d",
+        plan["n_files"],
+        plan["bytes_to_move"],
+        plan["n_errors"],
+    )
+    log.info(
+        "bytes to hash: %d; to copy from other file systems: %d",
+        plan["bytes_to_hash"],
+        plan["bytes_to_copy"],
+    )
+    return 1 if plan["errors"] or plan["n_errors"] else 0
 
 
 def locate_resources(args):
+    import httpx
+
     # This subcommand can handle IDs or full neurobank URLs
-    with httpx.Client() as session:
+    with core.open_session(args.auth) as session:
         for id in args.id:
             try:
                 base, id = registry.parse_resource_url(id)
@@ -505,31 +1065,57 @@ def search_resources(args):
 
 def get_resource_info(args):
     # missing ids just get skipped by the server, so we track which have not
-    # been returned
-    results = {id: {"id": id, "error": "not found"} for id in args.id}
-    for result in core.describe_many(args.registry_url, *args.id):
-        results[result["name"]] = result
-    for _, result in results.items():
+    # been returned and report them at the end
+    missing = dict.fromkeys(args.id)
+    for result in core.describe_many(args.registry_url, *missing):
+        missing.pop(result["name"], None)
         json.dump(result, fp=sys.stdout, indent=2)
         sys.stdout.write("\n")
+        sys.stdout.flush()
+    for id in missing:
+        json.dump({"id": id, "error": "not found"}, fp=sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+def iter_records(fp):
+    """Yields records from a file of line-delimited JSON, skipping blank lines"""
+    for line in fp:
+        if line.strip():
+            yield json.loads(line)
 
 
 def set_resource_metadata(args):
     for key in args.metadata_remove:
         args.metadata[key] = None
-    for result in core.update(
-        args.registry_url, *args.id, auth=args.auth, **args.metadata
-    ):
-        json.dump(result, fp=sys.stdout, indent=2)
-        sys.stdout.write("\n")
+    if not (args.id or args.records):
+        log.error("error: no resources specified")
+        return
+    with contextlib.ExitStack() as stack:
+        records = iter(args.id)
+        if args.records is not None:
+            if str(args.records) == "-":
+                fp = sys.stdin
+            else:
+                fp = stack.enter_context(open(args.records))
+            records = itertools.chain(records, iter_records(fp))
+        for result in core.update_many(
+            args.registry_url,
+            records,
+            auth=args.auth,
+            max_workers=args.jobs,
+            **args.metadata,
+        ):
+            json.dump(result, fp=sys.stdout, indent=2)
+            sys.stdout.write("\n")
 
 
 def fetch_resources(args):
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
     dest = args.dest or Path()
     to_fetch = set(args.ids)
     url, query = registry.get_locations_bulk(args.registry_url, to_fetch)
-    with httpx.Client() as session, concurrent.futures.ThreadPoolExecutor() as executor:
-        session.auth = core.make_auth(args.auth)
+    with core.open_session(args.auth) as session, ThreadPoolExecutor() as executor:
         response = tuple(util.query_registry_bulk(session, url, query))
         to_fetch -= {resource["name"] for resource in response}
         future_to_name = {
@@ -541,10 +1127,11 @@ def fetch_resources(args):
                 (dest / resource.get("filename", resource["name"])),
                 extension=args.extension,
                 force=args.force,
+                alt_base=args.alt_base,
             ): resource["name"]
             for resource in response
         }
-        for future in concurrent.futures.as_completed(future_to_name):
+        for future in as_completed(future_to_name):
             resource_id = future_to_name[future]
             print(f"{resource_id:<20}\t-> {future.result()}")
     for resource_id in to_fetch:
@@ -553,15 +1140,17 @@ def fetch_resources(args):
 
 def list_datatypes(args):
     url, params = registry.get_datatypes(args.registry_url)
-    for dtype in util.query_registry_paginated(httpx, url, params):
-        print(f"{dtype['name']:<25}\t({dtype['content_type']})")
+    with core.open_session(args.auth) as session:
+        for dtype in util.query_registry_paginated(session, url, params):
+            print(f"{dtype['name']:<25}\t({dtype['content_type']})")
 
 
 def add_datatype(args):
     url, params = registry.add_datatype(
         args.registry_url, args.dtype_name, args.content_type
     )
-    resp = httpx.post(url, json=params, auth=args.auth)
+    with core.open_session(args.auth) as session:
+        resp = session.post(url, json=params)
     resp.raise_for_status()
     data = resp.json()
     log.info(f"added datatype {data['name']} (content-type: {data['content_type']})")
@@ -569,6 +1158,8 @@ def add_datatype(args):
 
 def list_archives(args):
     # parse commandline args to query dict
+    from urllib.parse import urlunparse
+
     argmap = [
         ("name", "name"),
         ("scheme", "scheme"),
@@ -579,7 +1170,9 @@ def list_archives(args):
         if getattr(args, argname) is not None
     }
     url, params = registry.get_archives(args.registry_url, **params)
-    for arch in util.query_registry_paginated(httpx, url, params):
+    with core.open_session(args.auth) as session:
+        archives = list(util.query_registry_paginated(session, url, params))
+    for arch in archives:
         if arch["scheme"] == "neurobank":
             print(f"{arch['name']:<25}\t{arch['root']}")
         else:
@@ -597,6 +1190,7 @@ def check_archive(args):
 
     TODO support non-neurobank archives
     """
+
     try:
         archive_cfg = archive.get_config(args.path)
     except FileNotFoundError:
@@ -606,7 +1200,7 @@ def check_archive(args):
     log.info("archive: %s", archive_path)
     registry_url = archive_cfg["registry"]
     log.info("registry: %s", registry_url)
-    with httpx.Client(auth=args.auth) as session:
+    with core.open_session(args.auth) as session:
         # check that archive exists for this path
         url, params = registry.find_archive_by_path(registry_url, archive_path)
         archive_info = util.query_registry_first(session, url, params)
@@ -665,144 +1259,469 @@ def check_archive(args):
         )
 
 
-def register_tar(args):
-    archive_root = f"{args.tape_name}:{args.file_number}"
-    archive_name = args.archive_name or f"{args.tape_name}-{args.file_number}"
+def fix_archive_permissions(args):
+    try:
+        archive_cfg = archive.get_config(args.path)
+    except FileNotFoundError:
+        log.error(f"error: {args.path} is not a valid neurobank archive")
+        return 1
+    log.info("archive: %s", archive_cfg["path"])
+    if args.dry_run:
+        log.info("DRY RUN")
+    counts = archive.fix_permissions(
+        archive_cfg, max_workers=args.jobs, dry_run=args.dry_run
+    )
+    log.info(
+        " - checked: %d; fixed: %d; failed: %d",
+        counts["checked"],
+        counts["changed"],
+        counts["failed"],
+    )
+    if counts["failed"]:
+        log.error("unable to fix some files (try running as root)")
+        return 1
+    return 0
+
+
+def find_archive_duplicates(args):
+    try:
+        dupes = core.archive_duplicates(
+            args.path, auth=args.auth, max_workers=args.jobs
+        )
+    except (ValueError, RuntimeError) as e:
+        log.error("error: %s", e)
+        return 1
+    n_extra = 0
+    for sha1, ids in dupes.items():
+        print(f"{sha1}\t{' '.join(ids)}")
+        n_extra += len(ids) - 1
+    log.info(
+        "\nHashes with duplicates: %d; redundant resources: %d", len(dupes), n_extra
+    )
+    return 0
+
+
+def create_tape_archive(
+    session, registry_url, tape_name, file_number, archive_name=None, dry_run=False
+):
+    """Creates a tape archive in the registry. Returns the name or None if there was an error"""
+
+    import httpx
+
+    archive_root = f"{tape_name}:{file_number}"
+    archive_name = archive_name or f"{tape_name}-{file_number}"
     url, params = registry.add_archive(
-        args.registry_url,
+        registry_url,
         name=archive_name,
         scheme="tape",
         root=archive_root,
         accessibility="offline",
     )
-    with httpx.Client(auth=args.auth) as session, tarfile.open(args.tar) as tarf:
-        log.info(
-            "- creating '%s' archive in the registry with root '%s'",
-            archive_name,
-            archive_root,
+    log.info(
+        "- creating '%s' archive in the registry with root '%s'",
+        archive_name,
+        archive_root,
+    )
+    if not dry_run:
+        try:
+            r = session.post(url, json=params)
+            r.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            registry.log_error(e)
+            return None
+    return archive_name
+
+
+def register_tar(args):
+    import tarfile
+
+    from nbank import tape_archive
+
+    index = args.index
+    if index is None and args.tar.is_file():
+        index = tape_archive.index_path(args.tar)
+    with contextlib.ExitStack() as stack:
+        session = stack.enter_context(core.open_session(args.auth))
+        tarf = stack.enter_context(tarfile.open(args.tar))
+        archive_name = create_tape_archive(
+            session,
+            args.registry_url,
+            args.tape_name,
+            args.file_number,
+            args.archive_name,
+            args.dry_run,
         )
-        if not args.dry_run:
-            try:
-                r = session.post(url, json=params)
-                r.raise_for_status()
-            except httpx.HTTPStatusError as e:
-                registry.log_error(e)
-                return
+        if archive_name is None:
+            return
+        if index is not None and not args.dry_run:
+            index_writer = stack.enter_context(tape_archive.IndexWriter(index))
+        else:
+            index_writer = None
         log.info("- scanning contents of %s", args.tar)
         last_path = None
-        for tarinfo in tarf:
-            path = Path(tarinfo.name)
-            # don't check contents in directories that are resources
-            if last_path and path.is_relative_to(last_path):
-                log.debug("  - %s -> in a directory resource, skipping", tarinfo.name)
-                continue
-            # look up the resource
-            url, params = registry.get_resource(
-                args.registry_url, Path(tarinfo.name).stem
+        for members in util.batched(tarf, registry._bulk_query_size):
+            if index_writer is not None:
+                for tarinfo in members:
+                    index_writer.add(tarinfo)
+            # look up all the members in this chunk with a single request
+            url, query = registry.get_resource_bulk(
+                args.registry_url, {Path(tarinfo.name).stem for tarinfo in members}
             )
-            result = util.query_registry(session, url, params)
-            if result is None:
-                if tarinfo.isreg():
-                    log.info("  - %s -> no match in registry, skipping", tarinfo.name)
-                continue
-            if archive_name in result["locations"]:
-                log.info(
-                    "  - %s -> already associated with '%s' location",
-                    tarinfo.name,
-                    archive_name,
-                )
-            elif args.dry_run:
-                log.info(
-                    "  - %s -> added location in '%s' (dry run)",
-                    tarinfo.name,
-                    archive_name,
-                )
-            else:
-                url, params = registry.add_location(
-                    args.registry_url, result["name"], archive_name
-                )
-                try:
-                    r = session.post(url, json=params)
-                    r.raise_for_status()
+            known = {
+                result["name"]: result
+                for result in util.query_registry_bulk(session, url, query)
+            }
+            to_add = []
+            for tarinfo in members:
+                path = Path(tarinfo.name)
+                # don't check contents in directories that are resources
+                if last_path and path.is_relative_to(last_path):
+                    log.debug(
+                        "  - %s -> in a directory resource, skipping", tarinfo.name
+                    )
+                    continue
+                result = known.get(path.stem)
+                if result is None:
+                    if tarinfo.isreg():
+                        log.info(
+                            "  - %s -> no match in registry, skipping", tarinfo.name
+                        )
+                    continue
+                if archive_name in result["locations"]:
                     log.info(
-                        "  - %s -> added location in '%s'",
+                        "  - %s -> already associated with '%s' location",
                         tarinfo.name,
                         archive_name,
                     )
-                except httpx.HTTPStatusError as e:
-                    registry.log_error(e)
-                    return
-            last_path = path
+                elif args.dry_run:
+                    log.info(
+                        "  - %s -> added location in '%s' (dry run)",
+                        tarinfo.name,
+                        archive_name,
+                    )
+                else:
+                    to_add.append((tarinfo.name, result["name"]))
+                last_path = path
+            if not add_locations(session, args.registry_url, archive_name, to_add):
+                return
+        if index_writer is not None:
+            index_writer.commit()
+            log.info("- wrote member index to %s", index)
+
+
+def add_locations(session, registry_url, archive_name, to_add):
+    """Add archive_name as a location for each (member, resource_id) in to_add.
+
+    The requests are made concurrently. Returns False if any of them failed.
+
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    import httpx
+
+    def add_location(resource_id):
+        url, params = registry.add_location(registry_url, resource_id, archive_name)
+        r = session.post(url, json=params)
+        r.raise_for_status()
+
+    ok = True
+    with ThreadPoolExecutor() as executor:
+        futures = [executor.submit(add_location, id) for _, id in to_add]
+        for (member_name, _), future in zip(to_add, futures):
+            try:
+                future.result()
+                log.info("  - %s -> added location in '%s'", member_name, archive_name)
+            except httpx.HTTPStatusError as e:
+                registry.log_error(e)
+                ok = False
+    return ok
+
+
+def export_tar(args):
+    """Write resources from a neurobank archive to a tar file, verifying hashes on the way"""
+
+    import tarfile
+
+    from nbank import tape_archive
+
+    try:
+        archive_cfg = archive.get_config(args.path)
+    except FileNotFoundError:
+        log.error(f"error: {args.path} is not a valid neurobank archive")
+        return 1
+    if args.index is None and args.tar.is_char_device():
+        log.error("error: use --index to specify where to write the index")
+        return 1
+    index = args.index or tape_archive.index_path(args.tar)
+    registry_url = args.registry_url or archive_cfg["registry"]
+    archive_path = archive_cfg["path"]  # this will resolve the path
+    ids = list(args.id)
+    if args.resources is not None:
+        with open(args.resources) as fp:
+            ids.extend(iter_ids(fp))
+    if ids:
+        resources = (
+            archive.resource_path(archive_cfg, resource_id) for resource_id in ids
+        )
+    else:
+        resources = archive.iter_resources(archive_path)
+    log.info("registry: %s", registry_url)
+    log.info("source archive: %s", archive_path)
+    log.info("destination file: %s", args.tar)
+    exported = []
+    n_err = 0
+    n_bytes = 0
+    with contextlib.ExitStack() as stack:
+        session = stack.enter_context(core.open_session(args.auth))
+        # stream mode writes in full records, which is friendlier to tape drives
+        tarf = stack.enter_context(
+            tarfile.open(args.tar, "w|", format=tarfile.PAX_FORMAT)
+        )
+        index_writer = stack.enter_context(tape_archive.IndexWriter(index))
+        for paths in util.batched(resources, registry._bulk_query_size):
+            url, query = registry.get_resource_bulk(
+                registry_url, [path.stem for path in paths]
+            )
+            hashes = {
+                result["name"]: result["sha1"]
+                for result in util.query_registry_bulk(session, url, query)
+            }
+            for path in paths:
+                resource_id = path.stem
+                if resource_id not in hashes:
+                    log.error("  ✗ %s -> '%s' not in the registry", path, resource_id)
+                    n_err += 1
+                    continue
+                try:
+                    path = archive.resolve_extension(path)
+                except FileNotFoundError:
+                    log.error("  ✗ '%s' is not in the archive", resource_id)
+                    n_err += 1
+                    continue
+                arcname = str(path.relative_to(archive_path))
+                sha1, members = tape_archive.write_resource(tarf, path, arcname)
+                index_writer.add(members[0], sha1=sha1)
+                for tarinfo in members[1:]:
+                    index_writer.add(tarinfo)
+                n_bytes += sum(tarinfo.size for tarinfo in members)
+                if hashes[resource_id] is None:
+                    log.info("  - %s -> %s (no hash in registry)", path, arcname)
+                elif sha1 != hashes[resource_id]:
+                    log.error("  ✗ %s -> %s FAILED to match hash!", path, arcname)
+                    n_err += 1
+                    continue
+                else:
+                    log.info("  - %s -> %s", path, arcname)
+                exported.append((arcname, resource_id))
+            # the member list is not needed when writing, so don't let it grow
+            tarf.members.clear()
+        index_writer.commit()
+    log.info(
+        "\nExported %d resources (%d bytes) to %s; errors: %d",
+        len(exported),
+        n_bytes,
+        args.tar,
+        n_err,
+    )
+    log.info("- wrote member index to %s", index)
+    if args.register is not None:
+        tape_name, file_number = args.register
+        with core.open_session(args.auth) as session:
+            archive_name = create_tape_archive(
+                session, registry_url, tape_name, int(file_number), args.archive_name
+            )
+            if archive_name is None or not add_locations(
+                session, registry_url, archive_name, exported
+            ):
+                return 1
+    return 1 if n_err else 0
 
 
 def prune_archive(args):
-    """Remove files from a neurobank archive, but only if they're stored somewhere else"""
+    """Remove files from a neurobank archive, but only if they're stored somewhere else
+
+    Locations are looked up in bulk, and the registry updates and file
+    deletions are run concurrently. Files are only deleted after the archive has
+    been removed as a location and the registry confirms that the resource is
+    still stored somewhere else. If the other locations disappeared in the
+    meantime (e.g. because another archive was being pruned), the location is
+    restored and the file is kept.
+
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    import httpx
+
     if args.dry_run:
         log.info("DRY RUN")
     log.info("registry: %s", args.registry_url)
-    with open(args.resources) as fp, httpx.Client(auth=args.auth) as session:
+    archive_name = args.archive_name
+    with open(args.resources) as fp, core.open_session(
+        args.auth
+    ) as session, ThreadPoolExecutor(args.jobs) as executor:
         # check that the archive is on the local machine
-        url, _ = registry.get_archive(args.registry_url, args.archive_name)
+        url, _ = registry.get_archive(args.registry_url, archive_name)
         result = util.query_registry(session, url)
         if result is None:
-            log.error("No such archive '%s' in the registry", args.archive_name)
+            log.error("No such archive '%s' in the registry", archive_name)
             return
         if result["scheme"] not in archive.Resource.schemes:
-            log.error("'%s' is not a neurobank archive ", args.archive_name)
+            log.error("'%s' is not a neurobank archive ", archive_name)
             return
         if not Path(result["root"]).is_dir():
             log.error(
                 "The archive '%s' is not on this host (%s) ",
-                args.archive_name,
+                archive_name,
                 result["root"],
             )
             return
-        log.info("pruning archive: %s (%s)", args.archive_name, result["root"])
-        for line in fp:
-            resource_id = line.strip()
-            if len(resource_id) == 0 or resource_id.startswith("#"):
-                continue
-            log.info("%s:", resource_id)
-            url, query = registry.get_locations(args.registry_url, resource_id)
-            response = util.query_registry(session, url, query)
-            if response is None:
-                log.error("✗ %s: not in registry", resource_id)
-                continue
-            locations = {loc["archive_name"]: loc for loc in response}
-            locations.pop("registry", None)  # remove registry pseudo-location
-            if args.archive_name not in locations:
-                log.info("  ✗ not in this archive")
-            elif len(locations) < 2:
-                log.info("  ✗ this archive is the only location for this resource")
+        log.info("pruning archive: %s (%s)", archive_name, result["root"])
+
+        def other_locations(record):
+            names = {loc["archive_name"] for loc in record["locations"]}
+            # remove registry pseudo-location
+            return names - {"registry", archive_name}
+
+        def remove_location(resource_id):
+            url, _ = registry.get_location(args.registry_url, resource_id, archive_name)
+            r = session.delete(url)
+            if r.status_code != httpx.codes.NO_CONTENT:
+                log.info(
+                    "  ✗ %s: unable to remove from registry: %s",
+                    resource_id,
+                    error_detail(r),
+                )
+                return False
+            log.info("  - %s: removed %s", resource_id, url)
+            return True
+
+        def restore_location(resource_id):
+            url, params = registry.add_location(
+                args.registry_url, resource_id, archive_name
+            )
+            try:
+                r = session.post(url, json=params)
+            except httpx.HTTPError as err:
+                detail = str(err)
+            else:
+                if r.is_success:
+                    log.error(
+                        "  ✗ %s: other locations were removed while pruning; "
+                        "location restored",
+                        resource_id,
+                    )
+                    return
+                detail = error_detail(r)
+            log.error(
+                "  ✗ %s: other locations were removed while pruning, "
+                "and the location could not be restored: %s",
+                resource_id,
+                detail,
+            )
+
+        def delete_file(resource):
+            if resource.path.is_dir():
+                size = sum(p.stat().st_size for p in resource.path.rglob("*"))
             else:
+                size = resource.path.stat().st_size
+            resource.unlink()
+            log.info("  - %s: deleted %s", resource.id, resource.path)
+            return size
+
+        n_seen = n_pruned = n_errors = n_bytes = 0
+        start = time.monotonic()
+        for chunk in util.batched(iter_ids(fp), registry._bulk_query_size):
+            n_seen += len(chunk)
+            to_prune = {}
+            missing = set(chunk)
+            url, query = registry.get_locations_bulk(args.registry_url, chunk)
+            for record in util.query_registry_bulk(session, url, query):
+                resource_id = record["name"]
+                missing.discard(resource_id)
+                locations = {loc["archive_name"]: loc for loc in record["locations"]}
+                if archive_name not in locations:
+                    log.info("  ✗ %s: not in this archive", resource_id)
+                    continue
+                if not other_locations(record):
+                    log.info(
+                        "  ✗ %s: this archive is the only location for this resource",
+                        resource_id,
+                    )
+                    continue
                 # this can throw FileNotFound but that shouldn't happen unless
                 # something is really wrong
-                resource = util.parse_location(locations[args.archive_name])
+                resource = util.parse_location(locations[archive_name])
                 if resource is None:
-                    log.error("  ✗ resource is not actually present in archive!")
-                    continue
-                if not args.dry_run and not resource.deletable:
-                    log.info("  ✗ insufficient permissions to delete")
-                    continue
-                url, query = registry.get_location(
-                    args.registry_url, resource_id, args.archive_name
-                )
-                req = session.build_request("DELETE", url)
-                if not args.dry_run:
-                    r = session.send(req)
-                    if r.status_code != httpx.codes.NO_CONTENT:
-                        log.info(
-                            "  ✗ unable to remove from registry: %s", r.json()["detail"]
-                        )
-                        continue
-                log.info("  - removed %s", req.url)
-                if not args.dry_run:
-                    resource.unlink()
-                log.info("  - deleted %s", resource.path)
+                    log.error(
+                        "  ✗ %s: resource is not actually present in archive!",
+                        resource_id,
+                    )
+                    n_errors += 1
+                elif not args.dry_run and not resource.deletable:
+                    log.info("  ✗ %s: insufficient permissions to delete", resource_id)
+                    n_errors += 1
+                else:
+                    to_prune[resource_id] = resource
+            for resource_id in missing:
+                log.error("  ✗ %s: not in registry", resource_id)
+
+            if args.dry_run:
+                for resource_id, resource in to_prune.items():
+                    log.info("  - %s: would delete %s", resource_id, resource.path)
+                n_pruned += len(to_prune)
+            else:
+                removed = [
+                    resource_id
+                    for resource_id, ok in zip(
+                        to_prune, executor.map(remove_location, to_prune)
+                    )
+                    if ok
+                ]
+                n_errors += len(to_prune) - len(removed)
+                # confirm that there's still another copy before deleting anything
+                to_delete = []
+                if removed:
+                    url, query = registry.get_locations_bulk(args.registry_url, removed)
+                    located = {
+                        record["name"]
+                        for record in util.query_registry_bulk(session, url, query)
+                        if other_locations(record)
+                    }
+                    to_restore = [id for id in removed if id not in located]
+                    to_delete = [to_prune[id] for id in removed if id in located]
+                    n_errors += len(to_restore)
+                    for _ in executor.map(restore_location, to_restore):
+                        pass
+                n_bytes += sum(executor.map(delete_file, to_delete))
+                n_pruned += len(to_delete)
+            log.info(
+                "- processed %d resources; pruned %d (%.1f/s)",
+                n_seen,
+                n_pruned,
+                rate(n_seen, start),
+            )
+        log.info(
+            "\nResources processed: %d; pruned: %d (%d bytes); errors: %d; "
+            "elapsed time: %.1f s (%.1f resources/s)",
+            n_seen,
+            n_pruned,
+            n_bytes,
+            n_errors,
+            time.monotonic() - start,
+            rate(n_seen, start),
+        )
 
 
 def import_tar(args):
     """Import files from a tar file into a neurobank archive"""
+
+    import shutil
+    import tarfile
+
+    import httpx
+
     try:
         archive_cfg = archive.get_config(args.dest)
     except FileNotFoundError:
@@ -812,7 +1731,7 @@ def import_tar(args):
     archive_path = archive_cfg["path"]  # this will resolve the path
     pfix = archive.permission_fixer(archive_cfg)  # used to fix permissions
     log.info("registry: %s", registry_url)
-    with httpx.Client(auth=args.auth) as session, tarfile.open(args.tar) as tarf:
+    with core.open_session(args.auth) as session, tarfile.open(args.tar) as tarf:
         url, params = registry.find_archive_by_path(registry_url, archive_path)
         archive_info = util.query_registry_first(session, url, params)
         if archive_info is None:
@@ -891,26 +1810,73 @@ def import_tar(args):
                 log.info("  - %s -> %s (dry run)", file_path, dest_path)
 
 
-def verify_file_hash(args):
-    from nbank.util import id_from_fname
+def plan_tape_recall(args):
+    ids = list(args.id)
+    if args.resources is not None:
+        with open(args.resources) as fp:
+            ids.extend(iter_ids(fp))
+    plan = core.plan_recall(args.registry_url, ids, index_dir=args.index_dir)
+    for step in plan["steps"]:
+        if args.json_out:
+            for resource in step["resources"]:
+                json.dump(
+                    {
+                        "tape": step["tape"],
+                        "file_index": step["file_index"],
+                        "archive": step["archive"],
+                        **resource,
+                    },
+                    fp=sys.stdout,
+                )
+                sys.stdout.write("\n")
+        else:
+            print(
+                f"{step['tape']}:{step['file_index']}\t"
+                f"({step['archive']}: {len(step['resources'])} resources)"
+            )
+            for resource in step["resources"]:
+                print(f"  {resource.get('member', resource['id'])}")
+    for field, msg in (
+        ("online", "available without recall"),
+        ("unavailable", "not stored on tape or anywhere else"),
+        ("missing", "not in the registry"),
+    ):
+        if plan[field]:
+            log.info("%d resources %s:", len(plan[field]), msg)
+            for resource_id in plan[field]:
+                if args.json_out:
+                    json.dump({"id": resource_id, "status": field}, fp=sys.stdout)
+                    sys.stdout.write("\n")
+                else:
+                    log.info("  - %s", resource_id)
+    return 1 if plan["unavailable"] or plan["missing"] else 0
 
-    for path in args.files:
-        if not path.exists():
-            print(f"{path}: no such file or directory")
-            continue
-        test_id = id_from_fname(path)
-        try:
-            if core.verify(args.registry_url, path, id=test_id):
-                print(f"{path}: OK")
-            else:
-                print(f"{path}: FAILED to match record for {test_id}")
-        except ValueError:
-            i = 0
-            for resource in core.verify(args.registry_url, path):
-                print(f"{path}: matches registry resource {resource['name']}")
-                i += 1
-            if i == 0:
-                print(f"{path}: no matches in registry")
+
+def verify_file_hash(args):
+    messages = {
+        "ok": "OK",
+        "mismatch": "FAILED to match record for {id}",
+        "unmatched": "no matches in registry",
+        "missing": "no such file or directory",
+        "error": "unable to read file ({error})",
+    }
+    n_failed = 0
+    for result in core.verify_many(
+        args.registry_url, args.files, max_workers=args.jobs
+    ):
+        status = result["status"]
+        if status not in ("ok", "matched"):
+            n_failed += 1
+        if args.json_out:
+            json.dump(result, fp=sys.stdout)
+            sys.stdout.write("\n")
+        elif status == "matched":
+            for name in result["matches"]:
+                print(f"{result['path']}: matches registry resource {name}")
+        else:
+            print(f"{result['path']}: {messages[status].format(**result)}")
+        sys.stdout.flush()
+    return 1 if n_failed else 0
 
 
 # Variables:
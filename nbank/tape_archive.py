@@ -4,23 +4,244 @@
 Copyright (C) 2025 Dan Meliza <dan@meliza.org>
 """
 
+import json
 import logging
-from pathlib import Path
-from typing import Optional
+import tarfile
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path, PurePosixPath
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from nbank import instrument
+from nbank.types import NotFetchableError
 
 log = logging.getLogger("nbank")  # root logger
 
+_index_suffix = ".idx"
+# cache of loaded indices, keyed by tar path; values are (mtime, index)
+_index_cache: Dict[Path, tuple] = {}
+
+
+def tar_name(tape_name: str, file_index: int) -> str:
+    """Returns the default file name for a local copy of a tape archive"""
+    return f"{tape_name}-{file_index}.tar"
+
+
+def index_path(tar_path: Path) -> Path:
+    """Returns the path of the member offset index for a tar file"""
+    return tar_path.with_name(tar_path.name + _index_suffix)
+
+
+def index_entry(tarinfo: tarfile.TarInfo) -> Dict:
+    """Returns the index entry for a tar member.
+
+    `offset` is the position of the member's header (including any extended
+    headers), which is where tarfile needs to start reading. `offset_data` and
+    `size` give the location of the contents of regular files.
+
+    """
+    return {
+        "name": tarinfo.name,
+        "type": "dir" if tarinfo.isdir() else "file" if tarinfo.isreg() else "other",
+        "offset": tarinfo.offset,
+        "offset_data": tarinfo.offset_data,
+        "size": tarinfo.size,
+    }
+
+
+def build_index(tarf: tarfile.TarFile) -> Iterator[Dict]:
+    """Scans the members of an open tar file, yielding an index entry for each"""
+    for tarinfo in tarf:
+        yield index_entry(tarinfo)
+
+
+def write_index(path: Path, entries: Iterable[Dict]) -> int:
+    """Writes index entries to path as line-delimited JSON. Returns number of entries"""
+    n = 0
+    with open(path, "w") as fp:
+        for entry in entries:
+            json.dump(entry, fp)
+            fp.write("\n")
+            n += 1
+    return n
+
+
+class IndexWriter:
+    """Writes an index incrementally while a tar file is being scanned or written.
+
+    Entries are written to a temporary file, which is only moved into place
+    when `commit()` is called. This ensures that an incomplete scan does not
+    leave behind a truncated index. Use as a context manager.
+
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.tmp_path = path.with_name(path.name + ".tmp")
+        self.n_entries = 0
+        self._fp = open(self.tmp_path, "w")
+
+    def add(self, tarinfo: tarfile.TarInfo, **extra) -> Dict:
+        """Add an entry for tarinfo to the index. Returns the entry"""
+        entry = index_entry(tarinfo)
+        entry.update(extra)
+        json.dump(entry, self._fp)
+        self._fp.write("\n")
+        self.n_entries += 1
+        return entry
+
+    def commit(self) -> None:
+        self._fp.close()
+        self.tmp_path.replace(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if not self._fp.closed:
+            self._fp.close()
+            self.tmp_path.unlink()
+
+
+def read_index(path: Path) -> Dict[str, Dict]:
+    """Reads an index file, returning a dict mapping resource ids to entries."""
+    with open(path) as fp:
+        return index_by_id(json.loads(line) for line in fp)
+
+
+def index_by_id(entries: Iterable[Dict]) -> Dict[str, Dict]:
+    """Returns a dict mapping resource ids to index entries.
+
+    Resource ids are the basenames of the members without extensions. If more
+    than one member has the same id (e.g. for files in a directory resource),
+    the first one in the tar file is used.
+
+    """
+    index = {}
+    for entry in entries:
+        index.setdefault(Path(entry["name"]).stem, entry)
+    return index
+
+
+def load_index(tar_path: Path) -> Dict[str, Dict]:
+    """Returns the member index for tar_path, building it if needed.
+
+    If the sidecar index file does not exist, the tar file is scanned and an
+    attempt is made to write the sidecar so that the scan only happens once.
+    Indices are cached in memory for as long as the tar file is not modified.
+
+    """
+    mtime = tar_path.stat().st_mtime
+    try:
+        cached_mtime, index = _index_cache[tar_path]
+        if cached_mtime == mtime:
+            return index
+    except KeyError:
+        pass
+    idx_path = index_path(tar_path)
+    if idx_path.exists():
+        index = read_index(idx_path)
+    else:
+        log.info("building member index for %s", tar_path)
+        with tarfile.open(tar_path) as tarf:
+            entries = list(build_index(tarf))
+        try:
+            write_index(idx_path, entries)
+        except OSError:
+            log.debug("unable to write index to %s", idx_path)
+        index = index_by_id(entries)
+    _index_cache[tar_path] = (mtime, index)
+    return index
+
+
+class _HashingReader:
+    """Wraps a binary file object to compute a hash of the data as it is read"""
+
+    def __init__(self, fp: IO[bytes], hash):
+        self.fp = fp
+        self.hash = hash
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fp.read(size)
+        self.hash.update(data)
+        return data
+
+
+@instrument.timed("tar_member", nbytes=lambda result, *args, **kwargs: result[0].size)
+def _add_member(
+    tarf: tarfile.TarFile, path: Path, arcname: str, method: str
+) -> Tuple[tarfile.TarInfo, Optional[str]]:
+    """Adds path to tarf. Returns the TarInfo and a hash of the contents for files.
+
+    The `offset` and `offset_data` attributes of the returned TarInfo are set
+    to the location of the member in the tar file.
+
+    """
+    import hashlib
+
+    tarinfo = tarf.gettarinfo(path, arcname)
+    tarinfo.offset = tarf.offset
+    digest = None
+    if tarinfo.isreg():
+        hash = hashlib.new(method)
+        with open(path, "rb") as fp:
+            tarf.addfile(tarinfo, _HashingReader(fp, hash))
+        digest = hash.hexdigest()
+    else:
+        tarf.addfile(tarinfo)
+        if tarinfo.issym() and path.is_file():
+            # links are stored as links, but they're hashed using the target
+            hash = hashlib.new(method)
+            with open(path, "rb") as fp:
+                reader = _HashingReader(fp, hash)
+                while reader.read(65536):
+                    pass
+            digest = hash.hexdigest()
+    # the data are padded out to a multiple of the block size
+    n_blocks = -(-tarinfo.size // tarfile.BLOCKSIZE) if tarinfo.isreg() else 0
+    tarinfo.offset_data = tarf.offset - n_blocks * tarfile.BLOCKSIZE
+    return tarinfo, digest
+
+
+def write_resource(
+    tarf: tarfile.TarFile, path: Path, arcname: str, method: str = "sha1"
+) -> Tuple[str, List[tarfile.TarInfo]]:
+    """Adds a resource to a tar file, hashing the data as it is written.
+
+    path can be a regular file or a directory. Returns the hash of the resource
+    (which will be the same as `util.hash`) and a list of the TarInfo objects
+    that were added, with offsets set so they can be added to an index.
+
+    """
+    import hashlib
+
+    tarinfo, digest = _add_member(tarf, path, arcname, method)
+    if not tarinfo.isdir():
+        return digest, [tarinfo]
+    # this has to match util.hash_directory
+    members = [tarinfo]
+    hashes = []
+    for fn in sorted(path.rglob("*")):
+        fn_rel = fn.relative_to(path)
+        tarinfo, digest = _add_member(tarf, fn, f"{arcname}/{fn_rel}", method)
+        members.append(tarinfo)
+        if digest is not None:
+            hashes.append(f"{fn_rel}={digest}")
+    return hashlib.new(method, "\n".join(hashes).encode("utf-8")).hexdigest(), members
+
 
 class Resource:
     """A resource stored on a tape.
 
     The `root` field of the location is interpreted as
     `name_of_tape`:`file_index`. The `alt_base` parameter can be set to point to
-    a tar file on a local file system.
+    a tar file on a local file system, or to a directory containing tar files
+    named `name_of_tape-file_index.tar`. Resources can then be fetched directly
+    from the tar file using a member offset index (see `load_index`).
 
     """
 
-    local: False
+    local = False
 
     def __init__(self, root: str, id: str, alt_base: Optional[Path] = None):
         try:
@@ -30,7 +251,6 @@ class Resource:
             raise ValueError("Tape resources must have the form 'name:index'") from err
         self.alt_base = alt_base
         self.id = id
-        # TODO: set local to True if alt_base is set?
 
     def __str__(self):
         return f"tape://{self.tape_name}:{self.file_index}/{self.id}"
@@ -38,4 +258,175 @@ class Resource:
     def __repr__(self):
         return f"<tape-archive resource: {self.id} @ {self}>"
 
-    # TODO: implement fetch when alt_base is set?
+    @property
+    def tar_path(self) -> Path:
+        """The path of the local tar file that contains the resource"""
+        if self.alt_base is None:
+            raise NotFetchableError("no local copy of the tape archive (set alt_base)")
+        base = Path(self.alt_base)
+        if base.is_dir():
+            return base / tar_name(self.tape_name, self.file_index)
+        return base
+
+    def index_entry(self) -> Dict:
+        """Returns the index entry for the resource in the local tar file"""
+        tar_path = self.tar_path
+        if not tar_path.is_file():
+            raise NotFetchableError(f"tar file {tar_path} does not exist")
+        try:
+            return load_index(tar_path)[self.id]
+        except KeyError as err:
+            raise NotFetchableError(f"{self.id} is not in {tar_path}") from err
+
+    @contextmanager
+    def open_tar(self) -> Iterator[tarfile.TarFile]:
+        """Opens the local tar file starting at the header of the resource.
+
+        The first member returned by the TarFile's `next()` method will be the
+        resource.
+
+        """
+        entry = self.index_entry()
+        with open(self.tar_path, "rb") as fp:
+            fp.seek(entry["offset"])
+            with tarfile.open(fileobj=fp, mode="r:") as tarf:
+                yield tarf
+
+    @contextmanager
+    def open(self) -> Iterator[IO[bytes]]:
+        """Opens the resource for reading without extracting it from the tar file"""
+        with self.open_tar() as tarf:
+            tarinfo = tarf.next()
+            reader = tarf.extractfile(tarinfo)
+            if reader is None:
+                raise IsADirectoryError(f"{self} is not a regular file")
+            with reader:
+                yield reader
+
+    @instrument.timed("tar_fetch", nbytes=instrument.result_size)
+    def fetch(self, target: Path) -> Path:
+        import shutil
+
+        with self.open_tar() as tarf:
+            members = iter(tarf)
+            tarinfo = next(members)
+            base = PurePosixPath(tarinfo.name)
+            if base.is_absolute() or ".." in base.parts:
+                raise NotFetchableError(f"{self}: unsafe member name {tarinfo.name}")
+            if target.is_dir():
+                target = target / base.name
+            if tarinfo.isreg():
+                with instrument.span("tar_member", member=tarinfo.name) as span, open(
+                    target, "wb"
+                ) as fp, tarf.extractfile(tarinfo) as reader:
+                    shutil.copyfileobj(reader, fp)
+                    span.bytes = tarinfo.size
+                return target
+            if not tarinfo.isdir():
+                raise NotFetchableError(f"{self} is not a file or directory")
+            # directory resources: members follow the directory entry
+            target.mkdir()
+            for member in members:
+                path = PurePosixPath(member.name)
+                if base not in path.parents:
+                    break
+                # tars that nbank didn't write may have names that escape target
+                parts = path.relative_to(base).parts
+                if ".." in parts:
+                    raise NotFetchableError(f"{self}: unsafe member name {member.name}")
+                dest = target.joinpath(*parts)
+                if member.isdir():
+                    dest.mkdir(parents=True, exist_ok=True)
+                elif member.isreg():
+                    dest.parent.mkdir(parents=True, exist_ok=True)
+                    with instrument.span(
+                        "tar_member", member=member.name
+                    ) as span, tarf.extractfile(member) as reader, open(
+                        dest, "wb"
+                    ) as fp:
+                        shutil.copyfileobj(reader, fp)
+                        span.bytes = member.size
+            return target
+
+
+def plan_recall(
+    records: Iterable[Dict], index_dir: Optional[Path] = None
+) -> Dict[str, List]:
+    """Generates a schedule for recalling resources from tape.
+
+    records: a sequence of location records, as returned by the bulk locations
+             endpoint (i.e. dicts with `name` and `locations` fields).
+    index_dir: a directory to search for member indices for the tape archives.
+               The indices should be named `name_of_tape-file_index.tar.idx`.
+
+    Resources that have a location that is not on tape do not need to be
+    recalled. If a resource is on more than one tape, the tape that holds the
+    most requested resources is used, to minimize the number of tape mounts.
+
+    Returns a dict with the following fields:
+
+    - `steps`: a list with one entry for each tape file that needs to be read,
+      sorted by tape name and file index. Each step has the `tape`,
+      `file_index`, and `archive` name, and a list of `resources`, sorted by
+      member offset if an index was available, otherwise by name.
+    - `online`: names of resources that do not need to be recalled
+    - `unavailable`: names of resources that have no usable location
+
+    """
+    candidates = {}
+    online = []
+    unavailable = []
+    for record in records:
+        tapes = []
+        for loc in record["locations"]:
+            if loc["scheme"] != "tape":
+                continue
+            try:
+                res = Resource(loc["root"], loc["resource_name"])
+            except ValueError:
+                log.debug("invalid tape location: %s", loc)
+                continue
+            tapes.append((res.tape_name, res.file_index, loc["archive_name"]))
+        # the registry pseudo-location doesn't provide a copy of the data
+        if any(
+            loc["scheme"] != "tape" and loc["archive_name"] != "registry"
+            for loc in record["locations"]
+        ):
+            online.append(record["name"])
+        elif tapes:
+            candidates[record["name"]] = tapes
+        else:
+            unavailable.append(record["name"])
+
+    tape_counts = Counter(tape[0] for tapes in candidates.values() for tape in tapes)
+    steps = {}
+    for name, tapes in candidates.items():
+        tape = min(tapes, key=lambda t: (-tape_counts[t[0]], t[0], t[1]))
+        steps.setdefault(tape, []).append({"id": name})
+
+    indices = {}
+    for tape, resources in steps.items():
+        if index_dir is not None:
+            idx_path = index_path(index_dir / tar_name(*tape[:2]))
+            if idx_path.exists():
+                indices[tape] = read_index(idx_path)
+        index = indices.get(tape, {})
+        for resource in resources:
+            entry = index.get(resource["id"])
+            if entry is not None:
+                resource.update(member=entry["name"], offset=entry["offset"])
+        resources.sort(key=lambda r: (r.get("offset", -1), r["id"]))
+
+    return {
+        "steps": [
+            {
+                "tape": tape[0],
+                "file_index": tape[1],
+                "archive": tape[2],
+                "resources": steps[tape],
+            }
+            for tape in sorted(steps)
+        ],
+        "online": online,
+        "unavailable": unavailable,
+    }
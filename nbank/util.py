@@ -9,21 +9,26 @@ import json
 import logging
 from pathlib import Path
 from typing import (
+    TYPE_CHECKING,
     Any,
+    Callable,
     Dict,
+    Iterable,
     Iterator,
     List,
     Mapping,
     Optional,
     Sequence,
+    Tuple,
     Union,
 )
 
-from httpx import Client
-
-from nbank import archive, tape_archive
+from nbank import archive, instrument
 from nbank.types import FetchableResource, NotFetchableError, Resource
 
+if TYPE_CHECKING:
+    from httpx import Client
+
 log = logging.getLogger("nbank")  # root logger
 
 
@@ -32,7 +37,7 @@ class HttpResource(FetchableResource):
 
     schemes = ("http", "https")
 
-    def __init__(self, location: Mapping[str, str], session: Optional[Client] = None):
+    def __init__(self, location: Mapping[str, str], session: Optional["Client"] = None):
         from urllib.parse import urlunparse
 
         assert location["scheme"] in (
@@ -76,11 +81,12 @@ class HttpResource(FetchableResource):
         return target
 
 
+@instrument.timed("parse_location")
 def parse_location(
     location: Mapping[str, str],
     *,
     alt_base: Optional[Path] = None,
-    http_session: Optional[Client] = None,
+    http_session: Optional["Client"] = None,
 ) -> Optional[Resource]:
     """Parse a location dict and return a Resource or None if the location is invalid.
 
@@ -99,6 +105,8 @@ def parse_location(
     elif scheme in ("http", "https"):
         return HttpResource(location, http_session)
     elif scheme == "tape":
+        from nbank import tape_archive
+
         return tape_archive.Resource(
             location["root"], location["resource_name"], alt_base
         )
@@ -120,6 +128,9 @@ def id_from_fname(fname: Union[Path, str]) -> str:
     return id
 
 
+@instrument.timed(
+    "hash", nbytes=lambda result, fname, *args, **kwargs: instrument.path_size(fname)
+)
 def hash(fname: Path, method: str = "sha1") -> str:
     """Returns a hash of the contents of fname using method.
 
@@ -166,8 +177,52 @@ def hash_directory(path: Path, method: str = "sha1") -> str:
     return hashlib.new(method, "\n".join(hashes).encode("utf-8")).hexdigest()
 
 
+@instrument.timed(
+    "hash_copy", nbytes=lambda result, src, *args, **kwargs: instrument.path_size(src)
+)
+def hash_copy(
+    src: Path, dest: Path, methods: Sequence[str] = ("sha1",)
+) -> Dict[str, str]:
+    """Copies the regular file src to dest and returns hashes of the contents.
+
+    The source is only read once, so this is about twice as fast as hashing and
+    then copying when the files are on different file systems. The contents of
+    dest are synced to disk before returning, and the access mode and
+    timestamps of src are copied. Returns a dict with the hexdigest for each of
+    the hash methods. Raises OSError if fewer bytes were copied than were in
+    src when it was opened.
+
+    """
+    import hashlib
+    import os
+    import shutil
+
+    block_size = 1 << 20
+    hashes = {method: hashlib.new(method) for method in methods}
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    copied = 0
+    with open(src, "rb") as ifp, open(dest, "wb") as ofp:
+        size = os.fstat(ifp.fileno()).st_size
+        while True:
+            n = ifp.readinto(buf)
+            if not n:
+                break
+            for hash in hashes.values():
+                hash.update(view[:n])
+            ofp.write(view[:n])
+            copied += n
+        ofp.flush()
+        os.fsync(ofp.fileno())
+    if copied < size:
+        raise OSError(f"only copied {copied} of {size} bytes from {src}")
+    shutil.copystat(src, dest)
+    return {method: hash.hexdigest() for method, hash in hashes.items()}
+
+
+@instrument.timed("query_registry")
 def query_registry(
-    session: Client,
+    session: "Client",
     url: str,
     params: Optional[Mapping[str, Any]] = None,
     auth: Optional[str] = None,
@@ -186,24 +241,26 @@ def query_registry(
 
 
 def query_registry_paginated(
-    session: Client, url: str, params: Optional[Mapping[str, Any]] = None
+    session: "Client", url: str, params: Optional[Mapping[str, Any]] = None
 ) -> Iterator[Dict]:
     """Perform GET request(s) to yield records from a paginated endpoint"""
-    r = session.get(url, params=params, headers={"Accept": "application/json"})
-    r.raise_for_status()
-    for d in r.json():
-        yield d
-    while "next" in r.links:
-        url = r.links["next"]["url"]
-        # parameters are already part of the URL
-        r = session.get(url, headers={"Accept": "application/json"})
+    # generators are suspended while the caller works, so they can't nest spans
+    with instrument.span("query_registry_paginated", nest=False, url=url):
+        r = session.get(url, params=params, headers={"Accept": "application/json"})
         r.raise_for_status()
         for d in r.json():
             yield d
+        while "next" in r.links:
+            url = r.links["next"]["url"]
+            # parameters are already part of the URL
+            r = session.get(url, headers={"Accept": "application/json"})
+            r.raise_for_status()
+            for d in r.json():
+                yield d
 
 
 def query_registry_first(
-    session: Client, url: str, params: Optional[Mapping[str, Any]] = None
+    session: "Client", url: str, params: Optional[Mapping[str, Any]] = None
 ) -> Dict:
     """Perform a GET response to a url and return the first result or None"""
     try:
@@ -213,17 +270,181 @@ def query_registry_first(
 
 
 def query_registry_bulk(
-    session: Client, url: str, query: Mapping[str, Any], auth: Optional[str] = None
+    session: "Client", url: str, query: Mapping[str, Any], auth: Optional[str] = None
 ) -> List[Dict]:
     """Perform a POST request to a bulk query url. These endpoints all stream line-delimited json"""
-    with session.stream("POST", url, json=query, auth=auth) as r:
+    with instrument.span("query_registry_bulk", nest=False, url=url), session.stream(
+        "POST", url, json=query, auth=auth
+    ) as r:
         r.raise_for_status()
         for line in r.iter_lines():
             yield json.loads(line)
 
 
+def query_registry_bulk_chunked(
+    session: "Client",
+    make_query: Callable[[List[str]], Tuple[str, Mapping[str, Any]]],
+    ids: Iterable[str],
+    *,
+    chunk_size: int,
+    max_workers: int = 4,
+    tries: int = 3,
+    key: str = "name",
+) -> Iterator[Dict]:
+    """Perform a bulk query in chunks, with the chunks running concurrently.
+
+    make_query is called with each chunk of ids and needs to return a url and
+    query for a bulk endpoint (e.g., `registry.get_resource_bulk`). Records are
+    yielded as they arrive from any of the chunks, so the order is not
+    preserved. Only max_workers chunks are requested at a time. If a chunk fails,
+    it is retried on its own (skipping any records that were already yielded) up
+    to a total of `tries` attempts before the error is raised. Records with the
+    same value for `key` are only yielded once.
+
+    """
+    import queue
+    import threading
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    messages = queue.SimpleQueue()
+    cancelled = threading.Event()
+    chunks = batched(ids, chunk_size)
+    retries = deque()
+
+    def worker(chunk, attempt):
+        try:
+            url, query = make_query(chunk)
+            for record in query_registry_bulk(session, url, query):
+                if cancelled.is_set():
+                    return
+                messages.put(("record", record))
+        except Exception as err:
+            messages.put(("failed", (chunk, attempt, err)))
+        else:
+            messages.put(("done", None))
+
+    def next_chunk():
+        if retries:
+            return retries.popleft()
+        chunk = next(chunks, None)
+        return None if chunk is None else (chunk, 1)
+
+    yielded = set()
+    in_flight = 0
+    with ThreadPoolExecutor(max_workers) as executor:
+        try:
+            while True:
+                while in_flight < max_workers:
+                    item = next_chunk()
+                    if item is None:
+                        break
+                    executor.submit(worker, *item)
+                    in_flight += 1
+                if in_flight == 0:
+                    return
+                kind, value = messages.get()
+                if kind == "record":
+                    if value[key] not in yielded:
+                        yielded.add(value[key])
+                        yield value
+                    continue
+                in_flight -= 1
+                if kind == "failed":
+                    chunk, attempt, err = value
+                    if attempt >= tries:
+                        raise err
+                    log.debug("   - bulk query failed (%s), retrying chunk", err)
+                    remaining = [id for id in chunk if id not in yielded]
+                    if remaining:
+                        retries.append((remaining, attempt + 1))
+        finally:
+            cancelled.set()
+
+
+def request_with_retry(
+    session: "Client",
+    method: str,
+    url: str,
+    *,
+    tries: int = 3,
+    backoff: float = 0.5,
+    **kwargs,
+):
+    """Send a request, retrying on connection errors and 5xx responses.
+
+    Waits backoff seconds before the first retry and doubles the wait after each
+    subsequent failure. Returns the last response; the caller is responsible for
+    checking its status.
+
+    """
+    import time
+
+    from httpx import TransportError
+
+    for attempt in range(tries):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            r = session.request(method, url, **kwargs)
+        except TransportError as err:
+            if attempt + 1 == tries:
+                raise
+            log.debug("   - %s %s failed (%s), retrying", method, url, err)
+            continue
+        if r.status_code < 500 or attempt + 1 == tries:
+            return r
+        log.debug("   - %s %s returned %d, retrying", method, url, r.status_code)
+
+
+def batched(iterable: Iterable[Any], n: int) -> Iterator[List[Any]]:
+    """Split iterable into lists of length n. The last list may be shorter.
+
+    This is used to break up bulk queries so that the request bodies don't get
+    too large and so that processing can start before the input is exhausted.
+
+    """
+    from itertools import islice
+
+    if n < 1:
+        raise ValueError("n must be at least one")
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, n))
+        if not batch:
+            return
+        yield batch
+
+
+def map_unordered(
+    executor, fn, iterable: Iterable[Any], max_pending: int
+) -> Iterator[Any]:
+    """Apply fn to each item of iterable in executor and yield results as they complete.
+
+    Unlike Executor.map, results are yielded in completion order, and no more than
+    max_pending tasks are submitted at a time, so iterable can be very large (or
+    lazy) without queuing everything up front. Exceptions raised by fn are
+    re-raised when the corresponding result is yielded.
+
+    """
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    pending = set()
+    for item in iterable:
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        pending.add(executor.submit(fn, item))
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+@instrument.timed("fetch_resource", nbytes=instrument.result_size)
 def fetch_resource(
-    session: Client,
+    session: "Client",
     locations: Sequence[dict],
     target: Path,
     *,
@@ -262,8 +483,12 @@ def fetch_resource(
 
 
 __all__ = [
+    "batched",
+    "map_unordered",
     "parse_location",
     "query_registry",
     "query_registry_bulk",
+    "query_registry_bulk_chunked",
     "query_registry_paginated",
+    "request_with_retry",
 ]
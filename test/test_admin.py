@@ -0,0 +1,164 @@
+# -*- mode: python -*-
+import argparse
+import json
+
+import pytest
+import respx
+
+from nbank import admin, archive, registry, util
+from test.test_registry import base_url, bulk_url
+
+
+@pytest.fixture
+def mocked_api():
+    with respx.mock(assert_all_called=True, assert_all_mocked=True) as respx_mock:
+        yield respx_mock
+
+
+def ndjson_stream(data):
+    return (json.dumps(item).encode() + b"\n" for item in data)
+
+
+@pytest.fixture
+def tmp_archive(tmp_path):
+    cfg = archive.create(tmp_path / "archive", base_url)
+    for name in ("dummy_1", "dummy_2", "dummy_3"):
+        src = tmp_path / name
+        src.write_text(f"contents of {name}")
+        archive.store_resource(cfg, src)
+    return cfg
+
+
+def location(cfg, name):
+    return {
+        "archive_name": "archive",
+        "scheme": "neurobank",
+        "root": str(cfg["path"]),
+        "resource_name": name,
+    }
+
+
+def test_update_hashes(mocked_api, tmp_archive, tmp_path):
+    hashes = {
+        name: util.hash(archive.resource_path(tmp_archive, name))
+        for name in ("dummy_1", "dummy_2")
+    }
+    ids_file = tmp_path / "ids.txt"
+    ids_file.write_text("dummy_1\ndummy_2\ndummy_3\n")
+    progress = tmp_path / "progress.ndjson"
+    # dummy_3 was done in a previous run
+    progress.write_text(
+        json.dumps({"name": "dummy_3", "sha1": "abcd", "status": "updated"}) + "\n"
+    )
+    mocked_api.post(
+        registry.url_join(bulk_url, "locations/"),
+        json={"names": ["dummy_1", "dummy_2"]},
+    ).respond(
+        stream=ndjson_stream(
+            [
+                {
+                    "name": "dummy_1",
+                    "sha1": hashes["dummy_1"],
+                    "locations": [location(tmp_archive, "dummy_1")],
+                },
+                {
+                    "name": "dummy_2",
+                    "sha1": "wrong",
+                    "locations": [location(tmp_archive, "dummy_2")],
+                },
+            ]
+        )
+    )
+    patched = mocked_api.patch(
+        registry.full_url(base_url, "dummy_2"), json={"sha1": hashes["dummy_2"]}
+    ).respond(json={})
+    args = argparse.Namespace(
+        registry_url=base_url,
+        auth=None,
+        dry_run=False,
+        jobs=2,
+        progress=progress,
+        resources=ids_file,
+    )
+    admin.update_hashes(args)
+    assert patched.call_count == 1
+    with open(progress) as fp:
+        results = {r["name"]: r["status"] for r in map(json.loads, fp)}
+    assert results == {
+        "dummy_1": "unchanged",
+        "dummy_2": "updated",
+        "dummy_3": "updated",
+    }
+
+
+def test_delete_resources(mocked_api, tmp_archive, tmp_path):
+    import httpx
+
+    ids_file = tmp_path / "ids.txt"
+    ids_file.write_text("dummy_1\n# a comment\ndummy_2\ndummy_4\n")
+    output = tmp_path / "results.ndjson"
+    mocked_api.post(
+        registry.url_join(bulk_url, "locations/"),
+        json={"names": ["dummy_1", "dummy_2", "dummy_4"]},
+    ).respond(
+        stream=ndjson_stream(
+            [
+                {"name": name, "locations": [location(tmp_archive, name)]}
+                for name in ("dummy_1", "dummy_2")
+            ]
+        )
+    )
+    deleted = mocked_api.delete(registry.full_url(base_url, "dummy_1")).respond(
+        httpx.codes.NO_CONTENT
+    )
+    # the first attempt to delete dummy_2 fails but the retry succeeds
+    retried = mocked_api.delete(registry.full_url(base_url, "dummy_2")).mock(
+        side_effect=[httpx.Response(503), httpx.Response(httpx.codes.NO_CONTENT)]
+    )
+    args = argparse.Namespace(
+        registry_url=base_url,
+        auth=None,
+        dry_run=False,
+        jobs=2,
+        tries=2,
+        output=output,
+        resources=ids_file,
+    )
+    admin.delete_resources(args)
+    assert deleted.call_count == 1
+    assert retried.call_count == 2
+    with open(output) as fp:
+        results = {r["name"]: r for r in map(json.loads, fp)}
+    assert {name: r["status"] for name, r in results.items()} == {
+        "dummy_1": "deleted",
+        "dummy_2": "deleted",
+        "dummy_4": "not-found",
+    }
+    assert len(results["dummy_1"]["unlinked"]) == 1
+    with pytest.raises(FileNotFoundError):
+        archive.resource_path(tmp_archive, "dummy_1", resolve_ext=True)
+    assert archive.resource_path(tmp_archive, "dummy_3", resolve_ext=True).exists()
+
+
+def test_delete_resources_dry_run(mocked_api, tmp_archive, tmp_path):
+    ids_file = tmp_path / "ids.txt"
+    ids_file.write_text("dummy_1\n")
+    output = tmp_path / "results.ndjson"
+    mocked_api.post(registry.url_join(bulk_url, "locations/")).respond(
+        stream=ndjson_stream(
+            [{"name": "dummy_1", "locations": [location(tmp_archive, "dummy_1")]}]
+        )
+    )
+    args = argparse.Namespace(
+        registry_url=base_url,
+        auth=None,
+        dry_run=True,
+        jobs=2,
+        tries=1,
+        output=output,
+        resources=ids_file,
+    )
+    admin.delete_resources(args)
+    (result,) = map(json.loads, output.read_text().splitlines())
+    assert result["status"] == "dry-run"
+    assert archive.resource_path(tmp_archive, "dummy_1", resolve_ext=True).exists()
@@ -1,7 +1,7 @@
 # -*- mode: python -*-
 import pytest
 
-from nbank import archive
+from nbank import archive, util
 
 dummy_registry = "https://localhost:8000/neurobank"
 
@@ -81,6 +81,71 @@ def test_parse_neurobank_location(tmp_archive, tmp_path):
     )
 
 
+def test_stage_and_store_resource(tmp_archive, tmp_path):
+    name = "dummy_1"
+    src = tmp_path / f"{name}.wav"
+    src.write_text("contents")
+    staged, sha1 = archive.stage_resource(tmp_archive, src, name)
+    assert src.exists()
+    assert staged.parent == archive.resource_path(tmp_archive, name).parent
+    assert staged.suffix == ".wav"
+    assert sha1 == util.hash(src)
+    # staged copies are hidden
+    assert list(archive.iter_resources(tmp_archive["path"])) == []
+    with pytest.raises(FileNotFoundError):
+        archive.resource_path(tmp_archive, name, resolve_ext=True)
+    path = archive.store_resource(tmp_archive, staged, name)
+    assert path == archive.resource_path(tmp_archive, name, resolve_ext=True)
+    assert path.name == "dummy_1.wav"
+    assert list(archive.iter_resources(tmp_archive["path"])) == [path]
+
+
+def test_stage_resource_hash_mismatch(tmp_archive, tmp_path):
+    src = tmp_path / "dummy_1"
+    src.write_text("contents")
+    with pytest.raises(ValueError):
+        archive.stage_resource(tmp_archive, src, "dummy_1", sha1="0" * 40)
+    stub_dir = archive.resource_path(tmp_archive, "dummy_1").parent
+    assert list(stub_dir.iterdir()) == []
+
+
+def test_store_resource_concurrently(tmp_archive, tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def store(ext):
+        src = tmp_path / f"dummy_1.{ext}"
+        src.write_text(str(ext))
+        try:
+            return archive.store_resource(tmp_archive, src, "dummy_1")
+        except KeyError:
+            return None
+
+    with ThreadPoolExecutor(8) as executor:
+        stored = [path for path in executor.map(store, range(16)) if path is not None]
+    assert len(stored) == 1
+    assert list(archive.iter_resources(tmp_archive["path"])) == stored
+
+
+def test_fix_permissions(tmp_dir_archive, tmp_path):
+    src = tmp_path / "dummy_dir"
+    (src / "sub").mkdir(parents=True)
+    (src / "sub" / "data").write_text("contents")
+    (src / "link").symlink_to("sub/data")
+    tgt = archive.store_resource(tmp_dir_archive, src, "dummy_dir")
+    assert tgt.stat().st_mode & 0o2000
+    for path in (tgt, tgt / "sub", tgt / "sub" / "data"):
+        path.chmod(0o777)
+    counts = archive.fix_permissions(tmp_dir_archive, dry_run=True)
+    # resources, stub dir and its lock file, resource, sub, data, link
+    assert counts == {"checked": 7, "changed": 3, "failed": 0}
+    assert (tgt / "sub" / "data").stat().st_mode & 0o777 == 0o777
+    counts = archive.fix_permissions(tmp_dir_archive, max_workers=2)
+    assert counts["changed"] == 3
+    assert (tgt / "sub" / "data").stat().st_mode & 0o7777 == 0o775
+    assert (tgt / "sub").stat().st_mode & 0o7777 == 0o2775
+    assert archive.fix_permissions(tmp_dir_archive)["changed"] == 0
+
+
 def test_store_and_fetch_resource(tmp_archive, tmp_path):
     name = "dummy_1"
     src = tmp_path / name
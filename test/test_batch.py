@@ -0,0 +1,107 @@
+# -*- mode: python -*-
+import io
+import json
+
+import pytest
+import respx
+
+from nbank import batch, registry, script
+from test.test_registry import base_url
+
+
+@pytest.fixture
+def mocked_api():
+    with respx.mock(assert_all_called=True, assert_all_mocked=True) as respx_mock:
+        yield respx_mock
+
+
+def test_read_records():
+    fp = io.StringIO(
+        '{"op": "info", "id": "dummy_1"}\n\n{"op": "info", "rid": "x"}\nnot json\n[1]\n'
+    )
+    records = list(batch.read_records(fp))
+    assert [r["rid"] for r in records] == [1, "x", 4, 5]
+    assert "error" in records[2]
+    assert "error" in records[3]
+
+
+def test_execute_errors():
+    assert batch.execute({"rid": 1, "op": "explode"}) == {
+        "rid": 1,
+        "op": "explode",
+        "error": "unknown operation: explode",
+    }
+    result = batch.execute({"rid": 2, "op": "info", "id": "dummy_1"})
+    assert result["error"] == "no registry url"
+    result = batch.execute({"rid": 3, "op": "info"}, base_url)
+    assert result["error"] == "missing field: id"
+    result = batch.execute({"rid": 4, "op": ["info"], "id": "dummy_1"}, base_url)
+    assert result["error"] == "unknown operation: ['info']"
+    result = batch.execute({"rid": 5, "op": "info", "id": 1}, base_url)
+    assert result["error"] == "id must be a string"
+    record = {"rid": 6, "op": "modify", "id": "dummy_1", "metadata": [1]}
+    assert batch.execute(record, base_url)["error"] == "metadata must be an object"
+    record = {"rid": 7, "op": "deposit", "archive": "x", "files": [1]}
+    assert batch.execute(record)["error"] == "files must be an array of strings"
+    record = {"rid": 8, "op": "deposit", "archive": "x"}
+    assert batch.execute(record)["error"] == "missing field: file or files"
+
+
+def test_execute_operation_errors(monkeypatch):
+    def fail(record, registry_url):
+        raise KeyError("sha1")
+
+    monkeypatch.setitem(batch.operations, "info", fail)
+    result = batch.execute({"rid": 1, "op": "info", "id": "dummy_1"})
+    assert result["error"] == "KeyError: 'sha1'"
+
+    def fail(record, registry_url):
+        raise TypeError("unsupported operand")
+
+    monkeypatch.setitem(batch.operations, "info", fail)
+    result = batch.execute({"rid": 1, "op": "info", "id": "dummy_1"})
+    assert result["error"] == "TypeError: unsupported operand"
+
+
+def test_batch_operations(mocked_api, tmp_path, capsys):
+    mocked_api.get(registry.full_url(base_url, "dummy_1")).respond(
+        json={"name": "dummy_1", "sha1": "abcd"}
+    )
+    mocked_api.get(registry.full_url(base_url, "dummy_2")).respond(404)
+    mocked_api.patch(
+        registry.full_url(base_url, "dummy_1"), json={"metadata": {"tag": "x"}}
+    ).respond(json={"name": "dummy_1", "metadata": {"tag": "x"}})
+    mocked_api.get(
+        registry.url_join(base_url, "resources", "dummy_1", "locations/")
+    ).respond(
+        json=[
+            {
+                "scheme": "https",
+                "root": "localhost:8000/neurobank/download",
+                "resource_name": "dummy_1",
+            }
+        ]
+    )
+    ops = tmp_path / "ops.ndjson"
+    ops.write_text(
+        "\n".join(
+            json.dumps(op)
+            for op in [
+                {"op": "info", "id": "dummy_1", "rid": "a"},
+                {"op": "info", "id": "dummy_2"},
+                {"op": "modify", "id": "dummy_1", "metadata": {"tag": "x"}},
+                {"op": "locate", "id": "dummy_1"},
+            ]
+        )
+    )
+    status = script.main(["-r", base_url, "batch", "-j", "2", str(ops)])
+    results = {
+        r["rid"]: r for r in map(json.loads, capsys.readouterr().out.splitlines())
+    }
+    assert status == 1
+    assert results["a"]["result"]["sha1"] == "abcd"
+    assert results[2]["error"] == "dummy_2 not found"
+    assert results[3]["result"]["metadata"] == {"tag": "x"}
+    assert results[4]["result"]["locations"] == [
+        "https://localhost:8000/neurobank/download/dummy_1/"
+    ]
@@ -0,0 +1,25 @@
+# -*- mode: python -*-
+import json
+
+from benchmarks import __main__ as bench
+
+
+def test_run_benchmarks(tmp_path):
+    output = tmp_path / "results.jsonl"
+    args = ["run", "-s", "20", "-n", "3", "-r", "1", "-o", str(output)]
+    assert bench.main([*args, "--workdir", str(tmp_path)]) == 0
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [r["benchmark"] for r in results] == list(bench.benchmarks)
+    by_name = {r["benchmark"]: r for r in results}
+    assert by_name["search"]["items"] == 20
+    assert by_name["locate"]["calls"] == 3
+    assert by_name["deposit"]["items"] == 3
+    assert all(r["items_per_s"] > 0 for r in results)
+
+
+def test_main_configures_logging_once(tmp_path):
+    results = tmp_path / "results.jsonl"
+    results.write_text("")
+    for _ in range(2):
+        assert bench.main(["compare", str(results), str(results)]) == 0
+    assert len(bench.log.handlers) == 1
@@ -0,0 +1,77 @@
+# -*- mode: python -*-
+import threading
+
+import pytest
+import respx
+
+from nbank import daemon, registry
+from test.test_registry import base_url
+
+
+@pytest.fixture
+def mocked_api():
+    with respx.mock(assert_all_called=True, assert_all_mocked=True) as respx_mock:
+        yield respx_mock
+
+
+@pytest.fixture
+def running_daemon(tmp_path, monkeypatch):
+    monkeypatch.delenv("NBANK_NO_DAEMON", raising=False)
+    path = tmp_path / "nbank.sock"
+    server = threading.Thread(target=daemon.serve, args=(path,))
+    server.start()
+    # wait for the socket to be ready
+    for _ in range(100):
+        if daemon.request({"command": "ping"}, path=path) is not None:
+            break
+        server.join(0.01)
+    yield path
+    daemon.request({"command": "stop"}, path=path)
+    server.join()
+
+
+def test_can_forward():
+    assert daemon.can_forward(["-r", "info", "locate", "dummy_1"])
+    assert daemon.can_forward(["--debug", "info", "dummy_1"])
+    assert not daemon.can_forward(["-a", "user:pwd", "info", "dummy_1"])
+    assert not daemon.can_forward(["deposit", "archive", "dummy_1"])
+    assert not daemon.can_forward(["archive", "prune", "live", "ids.txt"])
+    assert not daemon.can_forward(["--version"])
+
+
+def test_forward_without_daemon(tmp_path):
+    assert daemon.forward(["info", "dummy_1"], path=tmp_path / "nbank.sock") is None
+
+
+def test_forward_to_daemon(mocked_api, running_daemon, tmp_path, capsys):
+    mocked_api.post(registry.url_join(base_url, "bulk", "resources/")).respond(
+        stream=(b'{"name": "dummy_1", "sha1": "abcd"}\n' for _ in range(1))
+    )
+    status = daemon.forward(
+        ["-r", base_url, "info", "dummy_1", "dummy_2"], path=running_daemon
+    )
+    assert status == 0
+    out = capsys.readouterr().out
+    assert '"sha1": "abcd"' in out
+    assert '"error": "not found"' in out
+
+
+def test_forward_error_status(running_daemon, capsys):
+    status = daemon.forward(["info", "--not-an-option"], path=running_daemon)
+    assert status == 2
+    assert "error: the following arguments are required" in capsys.readouterr().err
+
+
+def test_socket_permissions(running_daemon):
+    assert running_daemon.stat().st_mode & 0o777 == 0o600
+
+
+def test_stalled_client(running_daemon, monkeypatch):
+    import socket
+
+    monkeypatch.setattr(daemon, "_client_timeout", 0.1)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(running_daemon))
+        # never finishes sending the request
+        sock.sendall(b'{"command": ')
+        assert daemon.request({"command": "ping"}, path=running_daemon) is not None
@@ -0,0 +1,128 @@
+# -*- mode: python -*-
+
+import httpx
+import pytest
+import respx
+
+from nbank import instrument, util
+
+
+@pytest.fixture
+def stats():
+    instrument.reset()
+    instrument.enable()
+    yield
+    instrument.disable()
+    instrument.reset()
+
+
+def test_disabled_records_nothing(tmp_path):
+    src = tmp_path / "dummy"
+    src.write_text("contents of dummy")
+    util.hash(src)
+    assert instrument.summary() == {}
+
+
+def test_timed_hash(stats, tmp_path):
+    src = tmp_path / "dummy"
+    src.write_text("contents of dummy")
+    util.hash(src)
+    util.hash(src)
+    with pytest.raises(FileNotFoundError):
+        util.hash(tmp_path / "missing")
+    summary = instrument.summary()["hash"]
+    assert summary["count"] == 3
+    assert summary["errors"] == 1
+    assert summary["bytes"] == 2 * len("contents of dummy")
+    assert sum(summary["histogram"].values()) == 3
+
+
+def test_span(stats):
+    with instrument.span("copy") as span:
+        span.bytes = 100
+    with pytest.raises(ValueError), instrument.span("copy"):
+        raise ValueError
+    summary = instrument.summary()["copy"]
+    assert summary["count"] == 2
+    assert summary["errors"] == 1
+    assert summary["bytes"] == 100
+
+
+def test_quantiles():
+    stats = instrument.OperationStats()
+    for elapsed in (0.0005,) * 90 + (0.3,) * 10:
+        stats.add(elapsed)
+    assert stats.quantile(0.5) == 0.001
+    assert stats.quantile(0.99) == 0.3
+
+
+def test_http_hooks(stats):
+    url = "https://meliza.org/neurobank/resources/"
+    with respx.mock() as mock:
+        mock.get(url).respond(json=[{"name": "dummy"}])
+        mock.post(url).respond(400, json={"name": ["invalid"]})
+        with httpx.Client(event_hooks=instrument.event_hooks()) as client:
+            client.get(url)
+            client.post(url, json={"name": "dummy"})
+    summary = instrument.summary()
+    assert summary["http GET"]["count"] == 1
+    assert summary["http GET"]["bytes"] > 0
+    assert summary["http POST"]["errors"] == 1
+
+
+def test_format_summary(stats):
+    instrument.record("hash", 0.01, 1000)
+    lines = instrument.format_summary().splitlines()
+    assert lines[0].startswith("operation")
+    assert lines[1].startswith("hash")
+
+
+@pytest.fixture
+def trace():
+    instrument.start_trace()
+    yield
+    instrument.stop_trace()
+
+
+def test_trace_nesting(trace, tmp_path):
+    src = tmp_path / "dummy"
+    src.write_text("contents of dummy")
+    with instrument.span("deposit", file="dummy"):
+        util.hash(src)
+    with instrument.span("cleanup"):
+        pass
+    events = {event["name"]: event for event in instrument.stop_trace()}
+    assert events["deposit"]["args"]["parent_id"] is None
+    assert events["deposit"]["args"]["file"] == "dummy"
+    assert events["hash"]["args"]["parent_id"] == events["deposit"]["args"]["span_id"]
+    assert events["hash"]["args"]["bytes"] == len("contents of dummy")
+    assert events["cleanup"]["args"]["parent_id"] is None
+    assert events["hash"]["ts"] >= events["deposit"]["ts"]
+    assert not instrument.summary()
+
+
+def test_trace_requests(trace, tmp_path):
+    import json
+
+    url = "https://meliza.org/neurobank/resources/"
+    with respx.mock() as mock:
+        mock.get(url).respond(json=[{"name": "dummy"}])
+        with instrument.span("lookup"), httpx.Client(
+            event_hooks=instrument.event_hooks()
+        ) as client:
+            client.get(url)
+    path = tmp_path / "trace.json"
+    instrument.write_trace(path, instrument.stop_trace())
+    events = json.loads(path.read_text())["traceEvents"]
+    lookup, request = sorted(events, key=lambda event: event["args"]["span_id"])
+    assert request["name"] == "http GET"
+    assert request["ph"] == "X"
+    assert request["args"]["status"] == 200
+    assert request["args"]["parent_id"] == lookup["args"]["span_id"]
+
+
+def test_disabled_span():
+    assert not instrument.is_tracing()
+    with instrument.span("copy") as span:
+        span.bytes = 100
+    assert instrument.summary() == {}
@@ -0,0 +1,250 @@
+# -*- mode: python -*-
+import httpx
+import pytest
+
+from nbank import archive, core, registry, util
+from nbank.journal import Journal
+
+
+def test_journal_latest_record(tmp_path):
+    path = tmp_path / "state" / "journal.ndjson"
+    with Journal(path) as journal:
+        journal.append({"id": "a", "state": "queued"})
+        journal.append({"id": "b", "state": "queued"})
+        journal.append({"id": "a", "state": "done", "path": tmp_path})
+    state = Journal(path).load()
+    assert list(state) == ["a", "b"]
+    assert state["a"] == {"id": "a", "state": "done", "path": str(tmp_path)}
+
+
+def test_journal_incomplete_record(tmp_path):
+    path = tmp_path / "journal.ndjson"
+    path.write_bytes(b'{"id": "a", "state": "queued"}\n{"id": "a", "sta')
+    with Journal(path) as journal:
+        assert journal.load() == {"a": {"id": "a", "state": "queued"}}
+        journal.append({"id": "b", "state": "queued"})
+    assert list(Journal(path).load()) == ["a", "b"]
+
+
+def test_journal_compact(tmp_path):
+    path = tmp_path / "journal.ndjson"
+    with Journal(path) as journal, Journal(path) as other:
+        for id in ("a", "b", "c"):
+            journal.append({"id": id, "state": "queued"})
+        journal.append({"id": "b", "state": "done"})
+        assert journal.compact(lambda r: r["state"] != "done") == 2
+        assert len(path.read_text().splitlines()) == 2
+        # writers that opened the old file follow the replacement
+        other.append({"id": "d", "state": "queued"})
+        assert list(journal.load()) == ["a", "c", "d"]
+        assert journal.compact(lambda r: False) == 0
+        assert not path.exists()
+        journal.append({"id": "e", "state": "queued"})
+    assert list(Journal(path).load()) == ["e"]
+
+
+def test_journal_latest(tmp_path):
+    path = tmp_path / "journal.ndjson"
+    with Journal(path) as journal:
+        for id in ("a", "b", "c"):
+            journal.append({"id": id, "state": "queued"})
+        journal.append({"id": "a", "state": "done"})
+        latest = journal.latest()
+        assert next(latest) == {"id": "b", "state": "queued"}
+        # records added while reading are not included
+        journal.append({"id": "c", "state": "done"})
+        assert list(latest) == [
+            {"id": "c", "state": "queued"},
+            {"id": "a", "state": "done"},
+        ]
+    assert list(Journal(tmp_path / "missing.ndjson").latest()) == []
+
+
+@pytest.fixture
+def registry_url(tmp_path):
+    return f"sqlite://{tmp_path}/registry.db"
+
+
+@pytest.fixture
+def archive_path(tmp_path, registry_url):
+    path = tmp_path / "archive"
+    archive.create(path, registry_url)
+    url, params = registry.add_archive(registry_url, "archive", "neurobank", path)
+    with core.open_session() as session:
+        session.post(url, json=params).raise_for_status()
+    return path
+
+
+def make_files(tmp_path, *names):
+    src = tmp_path / "src"
+    src.mkdir(exist_ok=True)
+    for name in names:
+        (src / name).write_text(f"contents of {name}")
+    return [src / name for name in names]
+
+
+def test_queue_and_flush(tmp_path, registry_url, archive_path):
+    files = make_files(tmp_path, "dummy_1.wav", "dummy_2.wav")
+    sha1 = util.hash(files[0])
+    queued = list(core.queue_deposit(archive_path, files, experiment="a"))
+    assert [item["id"] for item in queued] == ["dummy_1", "dummy_2"]
+    assert not files[0].exists()
+    staged = archive_path / ".nbank" / "staging" / "dummy_1.wav"
+    assert util.hash(staged) == sha1
+    assert core.describe(registry_url, "dummy_1") is None
+    # queuing the same id again is skipped
+    (dup,) = make_files(tmp_path, "dummy_1.wav")
+    assert list(core.queue_deposit(archive_path, [dup])) == []
+
+    deposited = list(core.flush_deposits(archive_path, max_workers=2))
+    assert sorted(item["id"] for item in deposited) == ["dummy_1", "dummy_2"]
+    assert all("error" not in item for item in deposited)
+    record = core.describe(registry_url, "dummy_1")
+    assert record["sha1"] == sha1
+    assert record["metadata"] == {"experiment": "a"}
+    (resource,) = core.find(registry_url, "dummy_1")
+    assert resource.path == archive_path / "resources" / "du" / "dummy_1.wav"
+    assert not staged.exists()
+    assert not (archive_path / ".nbank" / "queue.ndjson").exists()
+    assert list(core.flush_deposits(archive_path)) == []
+
+
+def test_flush_interrupted(tmp_path, registry_url, archive_path):
+    files = make_files(tmp_path, "dummy_1", "dummy_2", "dummy_3")
+    sha1, _, sha1_3 = (util.hash(path) for path in files)
+    list(core.queue_deposit(archive_path, files))
+    with core.open_session() as session:
+        # an earlier flush registered dummy_1 and then died
+        url, params = registry.add_resource(
+            registry_url, "dummy_1", None, "archive", sha1
+        )
+        session.post(url, json=params).raise_for_status()
+        # and someone else took dummy_2
+        url, params = registry.add_resource(registry_url, "dummy_2", None, "archive")
+        session.post(url, json=params).raise_for_status()
+        # and dummy_3 is already in another archive
+        url, params = registry.add_archive(
+            registry_url, "other", "neurobank", tmp_path / "other"
+        )
+        session.post(url, json=params).raise_for_status()
+        url, params = registry.add_resource(
+            registry_url, "dummy_3", None, "other", sha1_3
+        )
+        session.post(url, json=params).raise_for_status()
+    results = {item["id"]: item for item in core.flush_deposits(archive_path)}
+    assert "error" not in results["dummy_1"]
+    assert "error" not in results["dummy_3"]
+    locations = core.describe(registry_url, "dummy_3")["locations"]
+    assert sorted(locations) == ["archive", "other"]
+    assert "error" in results["dummy_2"]
+    remaining = Journal(archive_path / ".nbank" / "queue.ndjson").load()
+    assert list(remaining) == ["dummy_2"]
+    assert (archive_path / ".nbank" / "staging" / "dummy_2").exists()
+
+
+def test_deposit_resume(tmp_path, registry_url, archive_path, monkeypatch):
+    files = make_files(tmp_path, "dummy_1", "dummy_2", "dummy_3")
+    store_resource = archive.store_resource
+
+    def crash_on_dummy_2(cfg, src, id):
+        if id == "dummy_2":
+            raise RuntimeError("killed")
+        return store_resource(cfg, src, id)
+
+    monkeypatch.setattr(archive, "store_resource", crash_on_dummy_2)
+    with pytest.raises(RuntimeError):
+        list(core.deposit(archive_path, files, resume=True))
+    assert core.describe(registry_url, "dummy_2") is not None
+    monkeypatch.setattr(archive, "store_resource", store_resource)
+
+    hashed = []
+    hash = util.hash
+    monkeypatch.setattr(util, "hash", lambda path: hashed.append(path) or hash(path))
+    deposited = list(core.deposit(archive_path, files, resume=True))
+    assert [item["id"] for item in deposited] == ["dummy_2", "dummy_3"]
+    assert hashed == [files[2]]
+    (resource,) = core.find(registry_url, "dummy_2")
+    assert resource.path.exists()
+    assert not (archive_path / ".nbank" / "deposits.ndjson").exists()
+
+
+def test_deposit_resume_after_register(tmp_path, registry_url, archive_path):
+    (src,) = make_files(tmp_path, "dummy_1")
+    journal = archive_path / ".nbank" / "deposits.ndjson"
+    # a deposit that died after registering but before journaling it
+    with Journal(journal, key="source") as j:
+        j.append(
+            {
+                "source": str(src),
+                "id": "dummy_1",
+                "sha1": util.hash(src),
+                "size": src.stat().st_size,
+                "mtime_ns": src.stat().st_mtime_ns,
+                "state": "hashed",
+            }
+        )
+    url, params = registry.add_resource(
+        registry_url, "dummy_1", None, "archive", util.hash(src)
+    )
+    with core.open_session() as session:
+        session.post(url, json=params).raise_for_status()
+    with pytest.raises(httpx.HTTPStatusError):
+        list(core.deposit(archive_path, [src]))
+    (item,) = core.deposit(archive_path, [src], resume=True)
+    assert item["id"] == "dummy_1"
+    assert not src.exists()
+
+
+def test_deposit_resume_auto_id(tmp_path, registry_url, archive_path):
+    (src,) = make_files(tmp_path, "dummy_1")
+    sha1 = util.hash(src)
+    # a deposit that died after the registry assigned an id
+    with Journal(archive_path / ".nbank" / "deposits.ndjson", key="source") as j:
+        j.append(
+            {
+                "source": str(src),
+                "id": None,
+                "sha1": sha1,
+                "size": src.stat().st_size,
+                "mtime_ns": src.stat().st_mtime_ns,
+                "state": "hashed",
+            }
+        )
+    url, params = registry.add_resource(registry_url, None, None, "archive", sha1)
+    with core.open_session() as session:
+        r = session.post(url, json=params)
+        r.raise_for_status()
+    (item,) = core.deposit(archive_path, [src], auto_id=True, resume=True)
+    assert item["id"] == r.json()["name"]
+    assert [r["name"] for r in core.search(registry_url, sha1=sha1)] == [item["id"]]
+
+
+def test_deposit_journal_only_on_resume(tmp_path, registry_url, archive_path):
+    files = make_files(tmp_path, "dummy_1", "dummy_2")
+    (item,) = core.deposit(archive_path, files[:1])
+    assert item["id"] == "dummy_1"
+    assert not (archive_path / ".nbank").exists()
+
+
+def test_deposit_resume_without_journal(
+    tmp_path, registry_url, archive_path, monkeypatch
+):
+    def read_only(cfg, name=None):
+        raise PermissionError("read-only")
+
+    monkeypatch.setattr(archive, "state_dir", read_only)
+    (src,) = make_files(tmp_path, "dummy_1")
+    (item,) = core.deposit(archive_path, [src], resume=True)
+    assert item["id"] == "dummy_1"
+    assert not src.exists()
+
+
+def test_journal_permissions(tmp_path, registry_url, archive_path):
+    cfg = archive.get_config(archive_path)
+    journal = core._journal(cfg, "test.ndjson")
+    with journal:
+        journal.append({"id": "a", "state": "queued"})
+        journal.append({"id": "b", "state": "done"})
+        assert journal.path.stat().st_mode & 0o777 == 0o664
+        journal.compact(lambda r: r["state"] != "done")
+        assert journal.path.stat().st_mode & 0o777 == 0o664
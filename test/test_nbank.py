@@ -36,6 +36,18 @@ def mocked_api():
         yield respx_mock
 
 
+@pytest.fixture
+def thread_workers(monkeypatch):
+    """Runs deposit_parallel workers in threads so they see the mocked registry"""
+    from concurrent import futures
+
+    monkeypatch.setattr(
+        futures,
+        "ProcessPoolExecutor",
+        lambda jobs, mp_context=None: futures.ThreadPoolExecutor(jobs),
+    )
+
+
 @pytest.fixture
 def netrc_auth(tmp_path):
     auth_str = "machine localhost\nlogin {}\npassword {}\n".format(*auth)
@@ -73,6 +85,24 @@ def test_deposit_resource(mocked_api, tmp_archive, tmp_path):
     assert items == [{"source": src, "id": name}]
 
 
+def test_deposit_with_shared_session(mocked_api, tmp_archive, tmp_path):
+    root = tmp_archive["path"]
+    lookup = mocked_api.get(
+        archives_url, params={"scheme": "neurobank", "root": str(root)}
+    ).respond(json=[{"name": archive_name, "root": str(root)}])
+    for name in ("dummy_1", "dummy_2"):
+        mocked_api.post(resource_url, json__name=name).respond(json={"name": name})
+    with core.shared_session(auth):
+        for name in ("dummy_1", "dummy_2"):
+            src = tmp_path / name
+            src.write_text(f"contents of {name}")
+            items = list(core.deposit(root, files=[src], dtype="dummy-dtype"))
+            assert items == [{"source": src, "id": name}]
+    # the archive lookup is cached while the shared session is open
+    assert lookup.call_count == 1
+    assert core._shared_client is None
+
+
 @pytest.mark.skip(reason="not implemented")
 def test_deposit_uuid_resource():
     # TO DO: verify that deposit assigns resources a valid UUID
@@ -166,6 +196,251 @@ def test_deposit_resource_registry_duplicate(mocked_api, tmp_archive, tmp_path):
         _ = list(core.deposit(root, files=[src], dtype=dtype, hash=False))
 
 
+def test_deposit_from_other_filesystem(mocked_api, tmp_archive, tmp_path, monkeypatch):
+    root = tmp_archive["path"]
+    monkeypatch.setattr(core, "_other_filesystem", lambda cfg, src: True)
+    hashed = []
+    monkeypatch.setattr(util, "hash", hashed.append)
+    files = []
+    for name in ("dummy_1.wav", "dummy_2.wav"):
+        files.append(tmp_path / name)
+        files[-1].write_text(f"contents of {name}")
+    sha1 = util.hash_copy(files[0], tmp_path / "copy")["sha1"]
+    mocked_api.get(
+        archives_url, params={"scheme": "neurobank", "root": str(root)}
+    ).respond(json=[{"name": archive_name, "root": str(root)}])
+    registered = mocked_api.post(resource_url, json__name="dummy_1").respond(
+        201, json={"name": "dummy_1"}
+    )
+    # dummy_2 is taken
+    mocked_api.post(resource_url, json__name="dummy_2").respond(
+        400, json={"name": ["resource with this name already exists."]}
+    )
+    deposit = core.deposit(root, files, hash=True)
+    assert next(deposit)["id"] == "dummy_1"
+    with pytest.raises(httpx.HTTPStatusError):
+        next(deposit)
+    assert hashed == []
+    assert json.loads(registered.calls.last.request.content)["sha1"] == sha1
+    stored = archive.resource_path(tmp_archive, "dummy_1", resolve_ext=True)
+    assert util.hash_copy(stored, tmp_path / "copy")["sha1"] == sha1
+    assert not files[0].exists()
+    # the failed deposit doesn't leave a copy behind
+    assert files[1].exists()
+    assert list(stored.parent.glob(".dummy*")) == []
+
+
+def test_deposit_parallel(mocked_api, tmp_archive, tmp_path, thread_workers):
+    root = tmp_archive["path"]
+    files = []
+    for i in range(6):
+        files.append(tmp_path / f"dummy_{i}.wav")
+        files[-1].write_text(f"contents of dummy_{i}")
+    files.append(tmp_path / "missing.wav")
+    mocked_api.get(
+        archives_url, params={"scheme": "neurobank", "root": str(root)}
+    ).respond(json=[{"name": archive_name, "root": str(root)}])
+    registered = []
+
+    def register(request):
+        registered.append(json.loads(request.content)["name"])
+        return httpx.Response(201, json={"name": registered[-1]})
+
+    mocked_api.post(resource_url).mock(side_effect=register)
+    deposited = list(core.deposit_parallel(root, files, 2, chunk_size=2))
+    names = [f"dummy_{i}" for i in range(6)]
+    assert sorted(item["id"] for item in deposited) == names
+    assert sorted(registered) == names
+    assert all(
+        archive.resource_path(tmp_archive, name, resolve_ext=True).exists()
+        for name in names
+    )
+    assert not any(path.exists() for path in files)
+
+
+def test_plan_deposit(mocked_api, tmp_archive, tmp_path):
+    root = tmp_archive["path"]
+    files = []
+    for name in ("dummy_1.wav", "dummy_1.json", "bad name.wav", "dummy_2", "dummy_3"):
+        files.append(tmp_path / name)
+        files[-1].write_text(f"contents of {name}")
+    files.append(tmp_path / "missing.wav")
+    mocked_api.get(
+        archives_url, params={"scheme": "neurobank", "root": str(root)}
+    ).respond(json=[{"name": archive_name, "root": str(root)}])
+    mocked_api.get(registry.url_join(base_url, "datatypes/")).respond(
+        json=[{"name": "wav", "content_type": "audio/wav"}]
+    )
+    mocked_api.post(
+        registry.url_join(bulk_url, "resources/"),
+        json={"names": ["dummy_1", "dummy_2", "dummy_3"]},
+    ).respond(stream=(json.dumps({"name": "dummy_2"}).encode() + b"\n",))
+    mocked_api.post(
+        registry.url_join(bulk_url, "resources/"), json={"names": ["dummy_1"]}
+    ).respond(stream=())
+    plan = core.plan_deposit(root, files, dtype="wav", hash=True)
+    assert plan["errors"] == []
+    assert plan["archive_name"] == archive_name
+    errors = {item["source"].name: item.get("error") for item in plan["files"]}
+    assert errors["dummy_1.wav"] is None
+    assert "same identifier" in errors["dummy_1.json"]
+    assert "not a valid identifier" in errors["bad name.wav"]
+    assert "already registered" in errors["dummy_2"]
+    assert errors["dummy_3"] is None
+    assert "does not exist" in errors["missing.wav"]
+    assert (plan["n_files"], plan["n_errors"]) == (2, 4)
+    size = files[0].stat().st_size + files[4].stat().st_size
+    assert plan["bytes_to_move"] == plan["bytes_to_hash"] == size
+    assert plan["bytes_to_copy"] == 0
+    # nothing was changed
+    assert all(path.exists() for path in files[:5])
+    plan = core.plan_deposit(root, files[:1], dtype="mp3")
+    assert plan["errors"] == ["unknown dtype 'mp3'"]
+
+
+def test_deposit_dedupe(mocked_api, tmp_archive, tmp_path):
+    root = tmp_archive["path"]
+    existing = tmp_path / "dummy_0.wav"
+    existing.write_text("contents of dummy_0")
+    sha1_0 = util.hash(existing)
+    stored = archive.store_resource(tmp_archive, existing)
+    files = []
+    for name, contents in (
+        ("dummy_1.wav", "contents of dummy_0"),
+        ("dummy_2.wav", "contents of dummy_2"),
+        ("dummy_3.wav", "contents of dummy_2"),
+    ):
+        files.append(tmp_path / name)
+        files[-1].write_text(contents)
+    sha1_2 = util.hash(files[1])
+    mocked_api.get(
+        archives_url, params={"scheme": "neurobank", "root": str(root)}
+    ).respond(json=[{"name": archive_name, "root": str(root)}])
+    mocked_api.get(resource_url, params={"sha1": sha1_0}).respond(
+        json=[{"name": "dummy_0"}]
+    )
+    mocked_api.get(resource_url, params={"sha1": sha1_2}).respond(json=[])
+    registered = []
+
+    def register(request):
+        registered.append(json.loads(request.content))
+        return httpx.Response(201, json={"name": registered[-1]["name"]})
+
+    mocked_api.post(resource_url).mock(side_effect=register)
+    results = {
+        item["source"].name: item for item in core.deposit(root, files, dedupe="skip")
+    }
+    assert results["dummy_1.wav"]["duplicate_of"] == "dummy_0"
+    assert files[0].exists()
+    # dummy_2 and dummy_3 are hashed concurrently, so either could be deposited
+    del results["dummy_1.wav"]
+    (deposited,) = (item for item in results.values() if item["id"] is not None)
+    (duplicate,) = (item for item in results.values() if item["id"] is None)
+    assert duplicate["duplicate_of"] == deposited["id"]
+    assert duplicate["source"].exists()
+    # the hashes of deposited files are registered
+    assert [(r["name"], r["sha1"]) for r in registered] == [(deposited["id"], sha1_2)]
+
+    mocked_api.get(
+        registry.url_join(registry.full_url(base_url, "dummy_0") + "locations/")
+    ).respond(
+        json=[{"scheme": "neurobank", "root": str(root), "resource_name": "dummy_0"}]
+    )
+    (item,) = core.deposit(root, files[:1], dedupe="link")
+    assert item["link"] == stored
+    assert files[0].is_symlink()
+    assert files[0].resolve() == stored
+
+
+def test_deposit_dedupe_from_other_filesystem(
+    mocked_api, tmp_archive, tmp_path, monkeypatch
+):
+    root = tmp_archive["path"]
+    src = tmp_path / "dummy_1.wav"
+    src.write_text("contents of dummy_1")
+    sha1 = util.hash(src)
+    mocked_api.get(
+        archives_url, params={"scheme": "neurobank", "root": str(root)}
+    ).respond(json=[{"name": archive_name, "root": str(root)}])
+    mocked_api.get(resource_url, params={"sha1": sha1}).respond(json=[])
+    mocked_api.post(
+        resource_url,
+        json={
+            "name": "dummy_1",
+            "locations": [archive_name],
+            "sha1": sha1,
+            "metadata": {},
+        },
+    ).respond(201, json={"name": "dummy_1"})
+    monkeypatch.setattr(core, "_other_filesystem", lambda cfg, src: True)
+    hashed = []
+    hash = util.hash
+    monkeypatch.setattr(util, "hash", lambda path: hashed.append(path) or hash(path))
+    monkeypatch.setattr(util, "hash_copy", hashed.append)
+    (item,) = core.deposit(root, [src], dedupe="skip")
+    assert item["id"] == "dummy_1"
+    # the file is only hashed once, by find_duplicates
+    assert hashed == [src]
+    stored = archive.resource_path(tmp_archive, "dummy_1", resolve_ext=True)
+    assert util.hash(stored) == sha1
+
+
+def test_deposit_parallel_dedupe(mocked_api, tmp_archive, tmp_path, thread_workers):
+    root = tmp_archive["path"]
+    files = []
+    for i in range(6):
+        files.append(tmp_path / f"dummy_{i}.wav")
+        files[-1].write_text(f"contents of dummy_{0 if i < 4 else i}")
+    mocked_api.get(
+        archives_url, params={"scheme": "neurobank", "root": str(root)}
+    ).respond(json=[{"name": archive_name, "root": str(root)}])
+    registered = {}
+
+    def register(request):
+        data = json.loads(request.content)
+        registered[data["sha1"]] = data["name"]
+        return httpx.Response(201, json={"name": data["name"]})
+
+    def search(request):
+        sha1 = request.url.params["sha1"]
+        found = [{"name": registered[sha1]}] if sha1 in registered else []
+        return httpx.Response(200, json=found)
+
+    mocked_api.post(resource_url).mock(side_effect=register)
+    mocked_api.get(resource_url).mock(side_effect=search)
+    # each file is in its own chunk, so duplicates are handled in different workers
+    results = list(core.deposit_parallel(root, files, 2, chunk_size=1, dedupe="skip"))
+    deposited = {item["id"] for item in results if item["id"] is not None}
+    duplicates = [item for item in results if item["id"] is None]
+    assert len(deposited) == 3
+    assert len(duplicates) == 3
+    assert all(item["duplicate_of"] in deposited for item in duplicates)
+    assert sorted(registered.values()) == sorted(deposited)
+
+
+def test_archive_duplicates(mocked_api, tmp_archive, tmp_path):
+    root = tmp_archive["path"]
+    for name, contents in (("dummy_3", "contents of 3"), ("dummy_4", "contents of 1")):
+        src = tmp_path / name
+        src.write_text(contents)
+        archive.store_resource(tmp_archive, src)
+    sha1 = util.hash(root / "resources" / "du" / "dummy_4")
+    mocked_api.get(
+        archives_url, params={"scheme": "neurobank", "root": str(root)}
+    ).respond(json=[{"name": archive_name, "root": str(root)}])
+    # resources deposited without hashes are hashed in the archive
+    mocked_api.get(resource_url, params={"location": archive_name}).respond(
+        json=[
+            {"name": "dummy_1", "sha1": sha1},
+            {"name": "dummy_2", "sha1": sha1},
+            {"name": "dummy_3", "sha1": None},
+            {"name": "dummy_4", "sha1": None},
+            {"name": "dummy_5", "sha1": "abc23"},
+        ]
+    )
+    assert core.archive_duplicates(root) == {sha1: ["dummy_1", "dummy_2", "dummy_4"]}
+
+
 def test_describe_resource(mocked_api):
     name = "dummy_2"
     data = {"you": "found me"}
@@ -259,6 +534,43 @@ def test_verify_resource_by_id(mocked_api, tmp_path):
     assert core.verify(base_url, src, name)
 
 
+def test_verify_many(mocked_api, tmp_path):
+    files = {}
+    for name in ("dummy_1", "dummy_2", "dummy_3", "bad name", "dummy_5"):
+        files[name] = tmp_path / f"{name}.txt"
+        files[name].write_text(f"contents of {name}")
+    hashes = {name: util.hash(path) for name, path in files.items()}
+    mocked_api.post(
+        registry.url_join(bulk_url, "resources/"),
+        json={"names": ["dummy_1", "dummy_2", "dummy_3", "dummy_5"]},
+    ).respond(
+        stream=(
+            json.dumps(item).encode() + b"\n"
+            for item in [
+                {"name": "dummy_1", "sha1": hashes["dummy_1"]},
+                {"name": "dummy_2", "sha1": "wrong"},
+            ]
+        )
+    )
+    mocked_api.get(resource_url, params={"sha1": hashes["dummy_3"]}).respond(
+        json=[{"name": "dummy_3_copy"}]
+    )
+    mocked_api.get(resource_url, params={"sha1": hashes["bad name"]}).respond(json=[])
+    mocked_api.get(resource_url, params={"sha1": hashes["dummy_5"]}).respond(json=[])
+    paths = [*files.values(), tmp_path / "dummy_6.txt"]
+    results = {r["path"]: r for r in core.verify_many(base_url, paths, chunk_size=10)}
+    status = {name: results[str(path)]["status"] for name, path in files.items()}
+    assert status == {
+        "dummy_1": "ok",
+        "dummy_2": "mismatch",
+        "dummy_3": "matched",
+        "bad name": "unmatched",
+        "dummy_5": "unmatched",
+    }
+    assert results[str(files["dummy_3"])]["matches"] == ["dummy_3_copy"]
+    assert results[str(tmp_path / "dummy_6.txt")]["status"] == "missing"
+
+
 def test_update_metadata(mocked_api):
     name = "dummy_11"
     metadata = {"new": "value"}
@@ -285,3 +597,109 @@ def test_update_with_netrc(mocked_api, netrc_auth):
     )
     updated = list(core.update(base_url, name, auth=netrc_auth, **metadata))
     assert updated == [{"metadata": metadata, "name": name}]
+
+
+def test_update_many_bulk(mocked_api):
+    records = [
+        "dummy_1",
+        {"name": "dummy_2", "metadata": {"other": 1}},
+        {"name": "dummy_3", "metadata": {"new": None}},
+    ]
+    mocked_api.patch(
+        registry.url_join(bulk_url, "resources/"),
+        json={
+            "resources": [
+                {"name": "dummy_1", "metadata": {"new": "value"}},
+                {"name": "dummy_2", "metadata": {"new": "value", "other": 1}},
+                {"name": "dummy_3", "metadata": {"new": None}},
+            ]
+        },
+    ).respond(
+        stream=(
+            json.dumps(item).encode() + b"\n"
+            for item in [
+                {"name": "dummy_1", "metadata": {"new": "value"}},
+                {"name": "dummy_2", "metadata": {"new": "value", "other": 1}},
+            ]
+        )
+    )
+    updated = list(core.update_many(base_url, records, auth=auth, new="value"))
+    assert updated[2] == {"name": "dummy_3", "error": "not found"}
+    assert [u["name"] for u in updated] == ["dummy_1", "dummy_2", "dummy_3"]
+
+
+def test_update_many_without_bulk(mocked_api):
+    names = ["dummy_1", "dummy_2", "dummy_3"]
+    metadata = {"new": "value"}
+    mocked_api.patch(registry.url_join(bulk_url, "resources/")).respond(
+        403, json={"detail": "You do not have permission to perform this action."}
+    )
+    for name in names[:2]:
+        mocked_api.patch(
+            registry.full_url(base_url, name), json={"metadata": metadata}
+        ).respond(json={"name": name, "metadata": metadata})
+    mocked_api.patch(registry.full_url(base_url, "dummy_3")).respond(404)
+    updated = list(core.update_many(base_url, iter(names), auth=auth, **metadata))
+    assert sorted(updated, key=lambda r: r["name"]) == [
+        {"name": "dummy_1", "metadata": metadata},
+        {"name": "dummy_2", "metadata": metadata},
+        {"name": "dummy_3", "error": "not found"},
+    ]
+
+
+def test_update_many_bulk_invalid(mocked_api):
+    names = ["dummy_1", "dummy_2"]
+    bulk = mocked_api.patch(registry.url_join(bulk_url, "resources/")).respond(
+        400, json={"metadata": ["invalid value"]}
+    )
+    mocked_api.patch(registry.full_url(base_url, "dummy_1")).respond(
+        json={"name": "dummy_1", "metadata": {"new": "value"}}
+    )
+    mocked_api.patch(registry.full_url(base_url, "dummy_2")).respond(
+        400, json={"metadata": ["invalid value"]}
+    )
+    updated = list(core.update_many(base_url, names, auth=auth, new="value"))
+    assert bulk.call_count == 1
+    assert updated == [
+        {"name": "dummy_1", "metadata": {"new": "value"}},
+        {"name": "dummy_2", "error": {"metadata": ["invalid value"]}},
+    ]
+
+
+def test_update_many_permission_denied(mocked_api):
+    mocked_api.patch(registry.full_url(base_url, "dummy_1")).respond(
+        403, json={"detail": "permission denied"}
+    )
+    with pytest.raises(httpx.HTTPStatusError):
+        list(core.update(base_url, "dummy_1", auth=auth, new="value"))
+
+
+def test_plan_recall(mocked_api):
+    names = ["dummy_1", "dummy_2"]
+    data = [
+        {
+            "name": "dummy_1",
+            "locations": [
+                {
+                    "archive_name": "tape_1-3",
+                    "scheme": "tape",
+                    "root": "tape_1:3",
+                    "resource_name": "dummy_1",
+                }
+            ],
+        }
+    ]
+    stream = (json.dumps(item).encode() + b"\n" for item in data)
+    mocked_api.post(
+        registry.url_join(bulk_url, "locations/"), json={"names": names}
+    ).respond(stream=stream)
+    plan = core.plan_recall(base_url, names)
+    assert plan["steps"] == [
+        {
+            "tape": "tape_1",
+            "file_index": 3,
+            "archive": "tape_1-3",
+            "resources": [{"id": "dummy_1"}],
+        }
+    ]
+    assert plan["missing"] == ["dummy_2"]
@@ -0,0 +1,116 @@
+# -*- mode: python -*-
+import httpx
+import pytest
+
+from nbank import archive, core, registry, registry_server, util
+
+
+@pytest.fixture
+def registry_url(tmp_path):
+    return f"sqlite://{tmp_path}/registry.db"
+
+
+@pytest.fixture
+def session():
+    with core.open_session() as session:
+        yield session
+
+
+@pytest.fixture
+def archive_path(tmp_path, registry_url, session):
+    path = tmp_path / "archive"
+    archive.create(path, registry_url, require_hash=False)
+    url, params = registry.add_archive(registry_url, "archive", "neurobank", path)
+    session.post(url, json=params).raise_for_status()
+    return path
+
+
+def add_files(tmp_path, *names):
+    src = tmp_path / "src"
+    src.mkdir(exist_ok=True)
+    files = []
+    for name in names:
+        path = src / name
+        path.write_text(f"contents of {name}")
+        files.append(path)
+    return files
+
+
+def test_deposit_and_find(tmp_path, registry_url, archive_path):
+    files = add_files(tmp_path, "dummy_1.wav", "dummy_2.wav")
+    deposited = list(core.deposit(archive_path, files, hash=True, experiment="a"))
+    assert [item["id"] for item in deposited] == ["dummy_1", "dummy_2"]
+    (resource,) = core.find(registry_url, "dummy_1")
+    assert resource.path == archive_path / "resources" / "du" / "dummy_1.wav"
+    record = core.describe(registry_url, "dummy_2")
+    assert record["sha1"] == util.hash(resource.path.with_name("dummy_2.wav"))
+    assert record["locations"] == ["archive"]
+    assert record["metadata"] == {"experiment": "a"}
+    assert core.describe(registry_url, "dummy_3") is None
+    (match,) = core.verify(registry_url, resource.path)
+    assert match["name"] == "dummy_1"
+
+
+def test_search_pages(tmp_path, registry_url, archive_path, monkeypatch):
+    monkeypatch.setattr(registry_server, "page_size", 2)
+    files = add_files(tmp_path, *(f"dummy_{i}" for i in range(5)))
+    list(core.deposit(archive_path, files[:3], index=1))
+    list(core.deposit(archive_path, files[3:], index=2))
+    names = [r["name"] for r in core.search(registry_url, location="archive")]
+    assert names == [f"dummy_{i}" for i in range(5)]
+    assert len(list(core.search(registry_url, metadata__index=1))) == 3
+    assert len(list(core.search(registry_url, metadata__index__neq=1))) == 2
+    assert len(list(core.search(registry_url, name="y_4"))) == 1
+
+
+def test_bulk_endpoints(tmp_path, registry_url, archive_path, session):
+    files = add_files(tmp_path, "dummy_1", "dummy_2")
+    list(core.deposit(archive_path, files))
+    records = list(core.describe_many(registry_url, "dummy_1", "dummy_2", "dummy_3"))
+    assert sorted(r["name"] for r in records) == ["dummy_1", "dummy_2"]
+    updated = list(
+        core.update_many(
+            registry_url,
+            ["dummy_1", {"name": "dummy_3", "metadata": {"b": 2}}],
+            a=1,
+        )
+    )
+    assert updated[0]["metadata"] == {"a": 1}
+    assert updated[1] == {"name": "dummy_3", "error": "not found"}
+    url, query = registry.get_locations_bulk(registry_url, ["dummy_1", "dummy_2"])
+    locations = {
+        r["name"]: r["locations"] for r in util.query_registry_bulk(session, url, query)
+    }
+    assert locations["dummy_2"][0]["root"] == str(archive_path)
+
+
+def test_errors(registry_url, archive_path, session):
+    url, params = registry.add_resource(registry_url, "dummy_1", "wav", "archive")
+    r = session.post(url, json=params)
+    assert r.status_code == 400
+    assert "dtype" in r.json()
+    url, params = registry.add_resource(registry_url, "dummy_1", None, "nowhere")
+    assert session.post(url, json=params).status_code == 400
+    url, params = registry.add_resource(registry_url, "dummy_1", None, "archive")
+    assert session.post(url, json=params).status_code == 201
+    assert session.post(url, json=params).status_code == 400
+    url, _ = registry.get_location(registry_url, "dummy_1", "archive")
+    assert session.delete(url).status_code == 204
+    assert session.delete(url).status_code == 404
+    url, _ = registry.get_resource(registry_url, "dummy_1")
+    assert session.put(url).status_code == 405
+    assert session.delete(url).status_code == 204
+    assert session.get(url).status_code == 404
+
+
+def test_wsgi_app(tmp_path):
+    base_url = "http://testserver/neurobank/"
+    app = registry_server.RegistryApp(tmp_path / "registry.db", prefix="/neurobank/")
+    with httpx.Client(transport=httpx.WSGITransport(app=app)) as session:
+        url, params = registry.add_datatype(base_url, "wav", "audio/wav")
+        assert session.post(url, json=params).status_code == 201
+        url, params = registry.get_datatypes(base_url)
+        (dtype,) = util.query_registry_paginated(session, url, params)
+        assert dtype == {"name": "wav", "content_type": "audio/wav"}
+        url, params = registry.get_info(base_url)
+        assert util.query_registry(session, url, params)["name"] == "neurobank-sqlite"
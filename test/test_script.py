@@ -0,0 +1,488 @@
+# -*- mode: python -*-
+import io
+import json
+import sys
+import tarfile
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+import respx
+
+from nbank import registry, script, tape_archive
+from test.test_registry import archives_url, base_url, bulk_url
+
+
+@pytest.fixture
+def mocked_api():
+    with respx.mock(assert_all_called=True, assert_all_mocked=True) as respx_mock:
+        yield respx_mock
+
+
+@pytest.fixture(autouse=True)
+def netrc_home(tmp_path, monkeypatch):
+    home = tmp_path / "home"
+    home.mkdir()
+    netrc = home / ".netrc"
+    netrc.write_text("machine localhost\nlogin dmeliza\npassword dummy_pw!\n")
+    netrc.chmod(0o600)
+    monkeypatch.setenv("HOME", str(home))
+    return home
+
+
+def ndjson_stream(data):
+    return (json.dumps(item).encode() + b"\n" for item in data)
+
+
+@pytest.fixture
+def tar_of_resources(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    tar_path = tmp_path / "resources.tar"
+    with tarfile.open(tar_path, "w") as tarf:
+        for name in ("dummy_1.wav", "dummy_2.wav", "unknown.wav"):
+            path = src / name
+            path.write_text(f"contents of {name}")
+            tarf.add(path, arcname=f"resources/du/{name}")
+    return tar_path
+
+
+def test_register_tar(mocked_api, tar_of_resources):
+    archive_name = "tape_1-3"
+    mocked_api.post(archives_url).respond(201, json={"name": archive_name})
+    mocked_api.post(registry.url_join(bulk_url, "resources/")).respond(
+        stream=ndjson_stream(
+            [
+                {"name": "dummy_1", "locations": ["live"]},
+                {"name": "dummy_2", "locations": ["live", archive_name]},
+            ]
+        )
+    )
+    added = mocked_api.post(
+        registry.url_join(base_url, "resources", "dummy_1", "locations/"),
+        json={"archive_name": archive_name},
+    ).respond(201, json={})
+    script.main(
+        [
+            "-r",
+            base_url,
+            "archive",
+            "register-tar",
+            "tape_1",
+            "3",
+            str(tar_of_resources),
+        ]
+    )
+    assert added.call_count == 1
+    assert tape_archive.index_path(tar_of_resources).exists()
+
+
+def test_register_tar_dry_run(mocked_api, tar_of_resources):
+    mocked_api.post(registry.url_join(bulk_url, "resources/")).respond(
+        stream=ndjson_stream([{"name": "dummy_1", "locations": ["live"]}])
+    )
+    script.main(
+        [
+            "-r",
+            base_url,
+            "archive",
+            "register-tar",
+            "-y",
+            "tape_1",
+            "3",
+            str(tar_of_resources),
+        ]
+    )
+
+
+def test_export_tar(mocked_api, tmp_path):
+    from nbank import archive, util
+
+    cfg = archive.create(tmp_path / "archive", base_url)
+    hashes = {}
+    for name in ("dummy_1.wav", "dummy_2.wav", "dummy_3.wav"):
+        src = tmp_path / name
+        src.write_text(f"contents of {name}")
+        hashes[src.stem] = util.hash(src)
+        archive.store_resource(cfg, src)
+    # registry has the wrong hash for dummy_2 and doesn't know about dummy_3
+    mocked_api.post(registry.url_join(bulk_url, "resources/")).respond(
+        stream=ndjson_stream(
+            [
+                {"name": "dummy_1", "sha1": hashes["dummy_1"]},
+                {"name": "dummy_2", "sha1": hashes["dummy_1"]},
+            ]
+        )
+    )
+    mocked_api.post(archives_url).respond(201, json={"name": "tape_1-4"})
+    added = mocked_api.post(
+        registry.url_join(base_url, "resources", "dummy_1", "locations/"),
+        json={"archive_name": "tape_1-4"},
+    ).respond(201, json={})
+    tar_path = tmp_path / "export.tar"
+    status = script.main(
+        [
+            "-r",
+            base_url,
+            "archive",
+            "export-tar",
+            "--register",
+            "tape_1",
+            "4",
+            str(cfg["path"]),
+            str(tar_path),
+        ]
+    )
+    assert status == 1
+    assert added.call_count == 1
+    with tarfile.open(tar_path) as tarf:
+        assert sorted(tarf.getnames()) == [
+            "resources/du/dummy_1.wav",
+            "resources/du/dummy_2.wav",
+        ]
+    index = tape_archive.read_index(tape_archive.index_path(tar_path))
+    assert index["dummy_1"]["sha1"] == hashes["dummy_1"]
+    resource = tape_archive.Resource("tape_1:4", "dummy_1", alt_base=tar_path)
+    with resource.open() as fp:
+        assert fp.read() == b"contents of dummy_1.wav"
+
+
+def test_prune_archive(mocked_api, tmp_path):
+    import httpx
+
+    from nbank import archive
+
+    archive_name = "live"
+    cfg = archive.create(tmp_path / "archive", base_url)
+    root = str(cfg["path"])
+    for name in ("dummy_1", "dummy_2", "dummy_3"):
+        src = tmp_path / name
+        src.write_text(f"contents of {name}")
+        archive.store_resource(cfg, src)
+    ids_file = tmp_path / "ids.txt"
+    ids_file.write_text("dummy_1\n# a comment\ndummy_2\ndummy_3\ndummy_4\n")
+
+    def location(name, archive_name, scheme="tape", root="tape_1:3"):
+        return {
+            "archive_name": archive_name,
+            "scheme": scheme,
+            "root": root,
+            "resource_name": name,
+        }
+
+    mocked_api.get(registry.url_join(archives_url, f"{archive_name}/")).respond(
+        json={"name": archive_name, "scheme": "neurobank", "root": root}
+    )
+    locations_url = registry.url_join(bulk_url, "locations/")
+    mocked_api.post(
+        locations_url, json={"names": ["dummy_1", "dummy_2", "dummy_3", "dummy_4"]}
+    ).respond(
+        stream=ndjson_stream(
+            [
+                {
+                    "name": name,
+                    "locations": [
+                        location(name, archive_name, "neurobank", root),
+                        location(name, "tape_1-3"),
+                    ],
+                }
+                for name in ("dummy_1", "dummy_2")
+            ]
+            + [
+                {
+                    "name": "dummy_3",
+                    "locations": [location("dummy_3", archive_name, "neurobank", root)],
+                }
+            ]
+        )
+    )
+    deleted = [
+        mocked_api.delete(
+            registry.url_join(
+                base_url, "resources", name, "locations", f"{archive_name}/"
+            )
+        ).respond(httpx.codes.NO_CONTENT)
+        for name in ("dummy_1", "dummy_2")
+    ]
+    # the tape location for dummy_2 disappeared after the first check
+    mocked_api.post(locations_url, json={"names": ["dummy_1", "dummy_2"]}).respond(
+        stream=ndjson_stream(
+            [
+                {"name": "dummy_1", "locations": [location("dummy_1", "tape_1-3")]},
+                {"name": "dummy_2", "locations": []},
+            ]
+        )
+    )
+    restored = mocked_api.post(
+        registry.url_join(base_url, "resources", "dummy_2", "locations/"),
+        json={"archive_name": archive_name},
+    ).respond(201, json={})
+    script.main(["-r", base_url, "archive", "prune", archive_name, str(ids_file)])
+    assert all(route.call_count == 1 for route in deleted)
+    assert restored.call_count == 1
+    with pytest.raises(FileNotFoundError):
+        archive.resource_path(cfg, "dummy_1", resolve_ext=True)
+    assert archive.resource_path(cfg, "dummy_2", resolve_ext=True).exists()
+    assert archive.resource_path(cfg, "dummy_3", resolve_ext=True).exists()
+
+
+def test_prune_archive_registry_errors(mocked_api, tmp_path):
+    import httpx
+
+    from nbank import archive
+
+    archive_name = "live"
+    cfg = archive.create(tmp_path / "archive", base_url)
+    root = str(cfg["path"])
+    names = ("dummy_1", "dummy_2", "dummy_3")
+    for name in names:
+        src = tmp_path / name
+        src.write_text(f"contents of {name}")
+        archive.store_resource(cfg, src)
+    ids_file = tmp_path / "ids.txt"
+    ids_file.write_text("\n".join(names))
+
+    def locations(name, *archives):
+        return [
+            {
+                "archive_name": archive,
+                "scheme": "neurobank" if archive == archive_name else "tape",
+                "root": root if archive == archive_name else "tape_1:3",
+                "resource_name": name,
+            }
+            for archive in archives
+        ]
+
+    mocked_api.get(registry.url_join(archives_url, f"{archive_name}/")).respond(
+        json={"name": archive_name, "scheme": "neurobank", "root": root}
+    )
+    locations_url = registry.url_join(bulk_url, "locations/")
+    mocked_api.post(locations_url, json={"names": list(names)}).respond(
+        stream=ndjson_stream(
+            [
+                {"name": name, "locations": locations(name, archive_name, "tape_1-3")}
+                for name in names
+            ]
+        )
+    )
+
+    def location_url(name):
+        return registry.url_join(
+            base_url, "resources", name, "locations", f"{archive_name}/"
+        )
+
+    # the registry's error pages aren't JSON
+    mocked_api.delete(location_url("dummy_1")).respond(500, text="Server Error")
+    for name in ("dummy_2", "dummy_3"):
+        mocked_api.delete(location_url(name)).respond(httpx.codes.NO_CONTENT)
+    mocked_api.post(locations_url, json={"names": ["dummy_2", "dummy_3"]}).respond(
+        stream=ndjson_stream(
+            [
+                {"name": "dummy_2", "locations": []},
+                {"name": "dummy_3", "locations": locations("dummy_3", "tape_1-3")},
+            ]
+        )
+    )
+    restored = mocked_api.post(
+        registry.url_join(base_url, "resources", "dummy_2", "locations/")
+    ).respond(500, text="Server Error")
+    script.main(["-r", base_url, "archive", "prune", archive_name, str(ids_file)])
+    assert restored.call_count == 1
+    # a failed restore doesn't stop the other resources from being pruned
+    assert archive.resource_path(cfg, "dummy_1", resolve_ext=True).exists()
+    assert archive.resource_path(cfg, "dummy_2", resolve_ext=True).exists()
+    with pytest.raises(FileNotFoundError):
+        archive.resource_path(cfg, "dummy_3", resolve_ext=True)
+
+
+def test_modify_from_records(mocked_api, tmp_path, capsys):
+    records = tmp_path / "records.ndjson"
+    records.write_text(
+        json.dumps({"name": "dummy_2", "metadata": {"experiment": "b"}}) + "\n\n"
+    )
+    mocked_api.patch(
+        registry.url_join(bulk_url, "resources/"),
+        json={
+            "resources": [
+                {"name": "dummy_1", "metadata": {"tag": "x"}},
+                {"name": "dummy_2", "metadata": {"tag": "x", "experiment": "b"}},
+            ]
+        },
+    ).respond(
+        stream=ndjson_stream(
+            [
+                {"name": "dummy_1", "metadata": {"tag": "x"}},
+                {"name": "dummy_2", "metadata": {"tag": "x", "experiment": "b"}},
+            ]
+        )
+    )
+    script.main(
+        ["-r", base_url, "modify", "-k", "tag=x", "-f", str(records), "dummy_1"]
+    )
+    assert '"name": "dummy_2"' in capsys.readouterr().out
+
+
+def test_verify_exit_status(mocked_api, tmp_path, capsys):
+    from nbank import util
+
+    src = tmp_path / "dummy_1.wav"
+    src.write_text("contents of dummy_1")
+    mocked_api.post(registry.url_join(bulk_url, "resources/")).respond(
+        stream=ndjson_stream([{"name": "dummy_1", "sha1": util.hash(src)}])
+    )
+    assert script.main(["-r", base_url, "verify", str(src)]) == 0
+    assert capsys.readouterr().out == f"{src}: OK\n"
+    missing = tmp_path / "dummy_2.wav"
+    assert script.main(["-r", base_url, "verify", "-j", str(missing)]) == 1
+    assert json.loads(capsys.readouterr().out)["status"] == "missing"
+
+
+def test_startup_imports():
+    # the CLI is often called in shell loops, so building the parser should not
+    # import any of the heavy modules needed only by some subcommands
+    import subprocess
+    import sys
+
+    code = "import sys; from nbank import script; script.main([]); print(*sys.modules)"
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = set(proc.stdout.split())
+    for heavy in ("httpx", "tarfile", "concurrent.futures", "importlib.metadata"):
+        assert heavy not in modules
+    # importtime lines are "import time: self [us] | cumulative | module"
+    cumulative = {
+        fields[2].strip(): int(fields[1])
+        for fields in (
+            line.split("|") for line in proc.stderr.splitlines() if "|" in line
+        )
+        if fields[1].strip().isdigit()
+    }
+    # generous threshold to catch regressions without being flaky
+    assert cumulative["nbank.script"] < 500_000
+
+
+def test_stats_json(mocked_api, tmp_path):
+    from nbank import instrument, util
+
+    src = tmp_path / "dummy_1.wav"
+    src.write_text("contents of dummy_1")
+    mocked_api.post(registry.url_join(bulk_url, "resources/")).respond(
+        stream=ndjson_stream([{"name": "dummy_1", "sha1": util.hash(src)}])
+    )
+    stats = tmp_path / "stats.json"
+    script.main(["-r", base_url, "--stats-json", str(stats), "verify", str(src)])
+    summary = json.loads(stats.read_text())
+    assert summary["hash"]["count"] == 1
+    assert summary["http POST"]["count"] == 1
+    assert not instrument.is_enabled()
+
+
+def test_trace(mocked_api, tmp_path):
+    from nbank import instrument, util
+
+    src = tmp_path / "dummy_1.wav"
+    src.write_text("contents of dummy_1")
+    mocked_api.post(registry.url_join(bulk_url, "resources/")).respond(
+        stream=ndjson_stream([{"name": "dummy_1", "sha1": util.hash(src)}])
+    )
+    trace = tmp_path / "trace.json"
+    script.main(["-r", base_url, "--trace", str(trace), "verify", str(src)])
+    events = json.loads(trace.read_text())["traceEvents"]
+    names = {event["name"] for event in events}
+    assert {"hash", "http POST", "query_registry_bulk"} <= names
+    assert not instrument.is_tracing()
+
+
+def test_iter_paths():
+    stream = io.BytesIO(b" a.wav\n\nb c.wav \nlast")
+    assert list(script.iter_paths(stream)) == [
+        Path("a.wav"),
+        Path("b c.wav"),
+        Path("last"),
+    ]
+    stream = io.BytesIO(b" a.wav\0new\nline.wav\0\0")
+    assert list(script.iter_paths(stream, b"\0")) == [
+        Path(" a.wav"),
+        Path("new\nline.wav"),
+    ]
+
+
+class ChunkedStream:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+
+    def read1(self, n):
+        return next(self.chunks, b"")
+
+
+def test_deposit_from_stdin(tmp_path, monkeypatch, capsys):
+    registry_url = f"sqlite://{tmp_path}/registry.db"
+    archive_path = tmp_path / "archive"
+    assert script.main(["-r", registry_url, "init", str(archive_path)]) is None
+    src = tmp_path / "odd\nname"
+    src.mkdir()
+    files = [src / f"dummy_{i}.wav" for i in range(3)]
+    for path in files:
+        path.write_text(path.name)
+
+    def chunks():
+        yield bytes(files[0]) + b"\0" + bytes(files[1])[:5]
+        # the first file is deposited before the rest of the input is read
+        assert not files[0].exists()
+        yield bytes(files[1])[5:] + b"\0" + bytes(files[2])
+
+    monkeypatch.setattr(sys, "stdin", SimpleNamespace(buffer=ChunkedStream(chunks())))
+    status = script.main(
+        ["-r", registry_url, "deposit", "-@", "-0", "-j", str(archive_path), "-"]
+    )
+    assert status == 0
+    out = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [item["id"] for item in out] == ["dummy_0", "dummy_1", "dummy_2"]
+    assert out[1]["source"] == str(files[1])
+
+
+def test_deposit_files_after_options(monkeypatch):
+    parsed = []
+    monkeypatch.setattr(script, "store_resources", parsed.append)
+    script.main(["deposit", "archive", "-k", "a=b", "f1", "f2", "--", "-f3"])
+    (args,) = parsed
+    assert args.directory == Path("archive")
+    assert args.file == [Path("f1"), Path("f2"), Path("-f3")]
+    assert args.metadata == {"a": "b"}
+
+
+def test_queue_and_flush(tmp_path, capsys):
+    registry_url = f"sqlite://{tmp_path}/registry.db"
+    archive_path = tmp_path / "archive"
+    script.main(["-r", registry_url, "init", str(archive_path)])
+    src = tmp_path / "dummy_1.wav"
+    src.write_text("contents of dummy_1")
+    status = script.main(["deposit", "-Q", str(archive_path), str(src)])
+    assert status == 0
+    assert not src.exists()
+    status = script.main(["flush", "-j", "--jobs", "2", str(archive_path)])
+    assert status == 0
+    (item,) = (json.loads(line) for line in capsys.readouterr().out.splitlines())
+    assert item["id"] == "dummy_1"
+    assert script.main(["flush", str(archive_path)]) == 0
+
+
+def test_plan_tape_recall(mocked_api, capsys):
+    tape_location = {
+        "archive_name": "tape_1-3",
+        "scheme": "tape",
+        "root": "tape_1:3",
+        "resource_name": "dummy_1",
+    }
+    mocked_api.post(registry.url_join(bulk_url, "locations/")).respond(
+        stream=ndjson_stream([{"name": "dummy_1", "locations": [tape_location]}])
+    )
+    status = script.main(["-r", base_url, "tape", "plan", "-j", "dummy_1", "dummy_2"])
+    assert status == 1
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert records[0]["id"] == "dummy_1"
+    assert records[1] == {"id": "dummy_2", "status": "missing"}
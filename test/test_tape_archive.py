@@ -0,0 +1,227 @@
+# -*- mode: python -*-
+import io
+import tarfile
+
+import pytest
+
+from nbank import tape_archive, util
+from nbank.types import NotFetchableError
+
+tape_name = "tape_1"
+file_index = 3
+
+
+@pytest.fixture
+def tar_of_resources(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "dummy_1.wav").write_text("contents of dummy_1")
+    (src / "dummy_2.json").write_text('{"foo": 10}\n')
+    (src / "dummy_3").mkdir()
+    (src / "dummy_3" / "data.txt").write_text("a directory resource")
+    (src / "dummy_3" / "sub").mkdir()
+    (src / "dummy_3" / "sub" / "more.txt").write_text("nested file")
+    tar_path = tmp_path / tape_archive.tar_name(tape_name, file_index)
+    with tarfile.open(tar_path, "w", format=tarfile.PAX_FORMAT) as tarf:
+        for name in ("dummy_1.wav", "dummy_3", "dummy_2.json"):
+            tarf.add(src / name, arcname=f"resources/du/{name}")
+    return tar_path
+
+
+def test_build_and_read_index(tar_of_resources):
+    with tarfile.open(tar_of_resources) as tarf:
+        n = tape_archive.write_index(
+            tape_archive.index_path(tar_of_resources), tape_archive.build_index(tarf)
+        )
+    assert n == 6
+    index = tape_archive.read_index(tape_archive.index_path(tar_of_resources))
+    assert index["dummy_1"]["name"] == "resources/du/dummy_1.wav"
+    assert index["dummy_3"]["type"] == "dir"
+    with open(tar_of_resources, "rb") as fp:
+        entry = index["dummy_2"]
+        fp.seek(entry["offset_data"])
+        assert fp.read(entry["size"]) == b'{"foo": 10}\n'
+
+
+def test_index_writer_commit(tar_of_resources):
+    idx_path = tape_archive.index_path(tar_of_resources)
+    with tape_archive.IndexWriter(idx_path) as writer, tarfile.open(
+        tar_of_resources
+    ) as tarf:
+        for tarinfo in tarf:
+            writer.add(tarinfo)
+        writer.commit()
+    assert writer.n_entries == 6
+    assert "dummy_2" in tape_archive.read_index(idx_path)
+
+
+def test_index_writer_no_commit(tar_of_resources):
+    idx_path = tape_archive.index_path(tar_of_resources)
+    with tape_archive.IndexWriter(idx_path) as writer, tarfile.open(
+        tar_of_resources
+    ) as tarf:
+        writer.add(tarf.next())
+    assert not idx_path.exists()
+    assert not writer.tmp_path.exists()
+
+
+def test_fetch_file_from_tar(tar_of_resources, tmp_path):
+    resource = tape_archive.Resource(
+        f"{tape_name}:{file_index}", "dummy_2", alt_base=tar_of_resources
+    )
+    target = tmp_path / "fetched"
+    target.mkdir()
+    fetched = resource.fetch(target)
+    assert fetched == target / "dummy_2.json"
+    assert fetched.read_text() == '{"foo": 10}\n'
+    # index is built on demand
+    assert tape_archive.index_path(tar_of_resources).exists()
+
+
+def test_open_file_in_tar_directory(tar_of_resources):
+    # alt_base can be a directory of tar files
+    resource = tape_archive.Resource(
+        f"{tape_name}:{file_index}", "dummy_1", alt_base=tar_of_resources.parent
+    )
+    with resource.open() as fp:
+        assert fp.read() == b"contents of dummy_1"
+
+
+def test_fetch_directory_from_tar(tar_of_resources, tmp_path):
+    resource = tape_archive.Resource(
+        f"{tape_name}:{file_index}", "dummy_3", alt_base=tar_of_resources
+    )
+    fetched = resource.fetch(tmp_path / "fetched")
+    assert (fetched / "data.txt").read_text() == "a directory resource"
+    assert (fetched / "sub" / "more.txt").read_text() == "nested file"
+    assert not (fetched / "dummy_2.json").exists()
+
+
+def test_fetch_directory_with_unsafe_names(tmp_path):
+    tar_path = tmp_path / tape_archive.tar_name(tape_name, file_index)
+    with tarfile.open(tar_path, "w", format=tarfile.PAX_FORMAT) as tarf:
+        for name in ("resources/du/dummy_3", "resources/du/dummy_3/../../../x"):
+            tarinfo = tarfile.TarInfo(name)
+            if name.endswith("x"):
+                tarinfo.size = 4
+                tarf.addfile(tarinfo, io.BytesIO(b"evil"))
+            else:
+                tarinfo.type = tarfile.DIRTYPE
+                tarf.addfile(tarinfo)
+    with tarfile.open(tar_path) as tarf:
+        tape_archive.write_index(
+            tape_archive.index_path(tar_path), tape_archive.build_index(tarf)
+        )
+    resource = tape_archive.Resource(
+        f"{tape_name}:{file_index}", "dummy_3", alt_base=tar_path
+    )
+    (tmp_path / "out").mkdir()
+    with pytest.raises(NotFetchableError):
+        resource.fetch(tmp_path / "out" / "fetched")
+    assert not (tmp_path / "x").exists()
+
+
+def test_fetch_missing_from_tar(tar_of_resources, tmp_path):
+    resource = tape_archive.Resource(
+        f"{tape_name}:{file_index}", "not_there", alt_base=tar_of_resources
+    )
+    with pytest.raises(NotFetchableError):
+        resource.fetch(tmp_path)
+
+
+def test_fetch_without_local_copy(tmp_path):
+    resource = tape_archive.Resource(f"{tape_name}:{file_index}", "dummy_1")
+    with pytest.raises(NotFetchableError):
+        resource.fetch(tmp_path)
+
+
+def test_fetch_resource_from_tape_location(tar_of_resources, tmp_path):
+    locations = [
+        {
+            "scheme": "tape",
+            "root": f"{tape_name}:{file_index}",
+            "resource_name": "dummy_1",
+        }
+    ]
+    target = tmp_path / "dummy_1.wav"
+    result = util.fetch_resource(
+        None, locations, target, alt_base=tar_of_resources.parent
+    )
+    assert result == target
+    assert target.read_text() == "contents of dummy_1"
+
+
+def tape_location(tape, index, name):
+    return {
+        "archive_name": f"{tape}-{index}",
+        "scheme": "tape",
+        "root": f"{tape}:{index}",
+        "resource_name": name,
+    }
+
+
+def test_plan_recall():
+    records = [
+        {"name": "res_c", "locations": [tape_location("tape_2", 1, "res_c")]},
+        {
+            "name": "res_b",
+            "locations": [
+                tape_location("tape_1", 5, "res_b"),
+                tape_location("tape_2", 4, "res_b"),
+            ],
+        },
+        {"name": "res_a", "locations": [tape_location("tape_2", 4, "res_a")]},
+        {
+            "name": "res_d",
+            "locations": [
+                tape_location("tape_1", 1, "res_d"),
+                {
+                    "archive_name": "live",
+                    "scheme": "neurobank",
+                    "root": "/home/data/live",
+                    "resource_name": "res_d",
+                },
+            ],
+        },
+        {"name": "res_e", "locations": []},
+    ]
+    plan = tape_archive.plan_recall(records)
+    # res_b should be recalled from tape_2 because that's already being mounted
+    assert [(s["tape"], s["file_index"]) for s in plan["steps"]] == [
+        ("tape_2", 1),
+        ("tape_2", 4),
+    ]
+    assert [r["id"] for r in plan["steps"][1]["resources"]] == ["res_a", "res_b"]
+    assert plan["online"] == ["res_d"]
+    assert plan["unavailable"] == ["res_e"]
+
+
+def test_plan_recall_with_index(tar_of_resources):
+    with tarfile.open(tar_of_resources) as tarf:
+        tape_archive.write_index(
+            tape_archive.index_path(tar_of_resources), tape_archive.build_index(tarf)
+        )
+    records = [
+        {"name": name, "locations": [tape_location(tape_name, file_index, name)]}
+        for name in ("dummy_2", "dummy_1", "dummy_3")
+    ]
+    plan = tape_archive.plan_recall(records, index_dir=tar_of_resources.parent)
+    (step,) = plan["steps"]
+    assert [r["id"] for r in step["resources"]] == ["dummy_1", "dummy_3", "dummy_2"]
+    assert step["resources"][2]["member"] == "resources/du/dummy_2.json"
+
+
+def test_write_resource_hashes(tmp_path):
+    src = tmp_path / "dummy_4"
+    (src / "sub").mkdir(parents=True)
+    (src / "data.txt").write_text("x" * 1000)
+    (src / "sub" / "more.txt").write_text("y" * 513)
+    tar_path = tmp_path / "out.tar"
+    with tarfile.open(tar_path, "w|", format=tarfile.PAX_FORMAT) as tarf:
+        sha1, members = tape_archive.write_resource(tarf, src, "resources/du/dummy_4")
+    assert sha1 == util.hash(src)
+    with tarfile.open(tar_path) as tarf:
+        for written, read in zip(members, tarf):
+            assert written.name == read.name
+            assert written.offset == read.offset
+            assert written.offset_data == read.offset_data
@@ -93,6 +93,19 @@ def test_hash_directory_detects_modified_file(tmp_path):
     assert hash1 != hash2
 
 
+def test_hash_copy(tmp_path):
+    src = tmp_path / "source.wav"
+    src.write_bytes(bytes(range(256)) * 8000)
+    src.chmod(0o640)
+    dest = tmp_path / "dest.wav"
+    hashes = util.hash_copy(src, dest, methods=("sha1", "md5"))
+    assert dest.read_bytes() == src.read_bytes()
+    assert hashes["sha1"] == util.hash(src)
+    assert hashes["md5"] == util.hash(src, method="md5")
+    assert dest.stat().st_mode == src.stat().st_mode
+    assert dest.stat().st_mtime_ns == src.stat().st_mtime_ns
+
+
 def test_parse_http_location():
     location = {
         "scheme": "https",
@@ -201,3 +214,56 @@ def test_fetch(mocked_api, tmp_path):
     mocked_api.get(url).respond(content=content)
     resource.fetch(p)
     assert p.read_text() == content
+
+
+def test_batched():
+    assert list(util.batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(util.batched([], 2)) == []
+    with pytest.raises(ValueError):
+        _ = list(util.batched(range(5), 0))
+
+
+def test_query_bulk_chunked(mocked_api):
+    url = "https://meliza.org/neurobank/bulk/resources/"
+    ids = [f"dummy_{i}" for i in range(7)]
+    requests = []
+
+    def respond(request):
+        names = json.loads(request.content)["names"]
+        requests.append(names)
+        if names == ids[:3] and requests.count(names) == 1:
+            return httpx.Response(500)
+        records = [{"name": name} for name in names if name != "dummy_5"]
+        return httpx.Response(
+            200, stream=(json.dumps(r).encode() + b"\n" for r in records)
+        )
+
+    mocked_api.post(url).mock(side_effect=respond)
+    result = util.query_registry_bulk_chunked(
+        httpx,
+        lambda chunk: (url, {"names": chunk}),
+        ids,
+        chunk_size=3,
+        max_workers=2,
+    )
+    assert sorted(r["name"] for r in result) == [
+        name for name in ids if name != "dummy_5"
+    ]
+    assert requests.count(ids[:3]) == 2
+    assert len(requests) == 4
+
+
+def test_query_bulk_chunked_gives_up(mocked_api):
+    url = "https://meliza.org/neurobank/bulk/resources/"
+    route = mocked_api.post(url).respond(500)
+    with pytest.raises(httpx.HTTPStatusError):
+        _ = list(
+            util.query_registry_bulk_chunked(
+                httpx,
+                lambda chunk: (url, {"names": chunk}),
+                ["dummy_1", "dummy_2"],
+                chunk_size=1,
+                tries=2,
+            )
+        )
+    assert route.call_count >= 2